@@ -0,0 +1,143 @@
+# -*-mode:python; mode:font-lock;-*-
+"""
+@file ComponentCache.py
+
+@brief Classes to keep a bounded number of loaded observations (likelihood
+       components) so that they can be reused, for example by the
+       overlapping windows of a sliding-window light curve, and to put a
+       likelihood object back in an earlier state.
+
+@author Stephen Fegan <sfegan@llr.in2p3.fr>
+
+$Id$
+"""
+
+import collections
+
+def _canonicalKey(f):
+    """Internal function which returns a hashable key for a dictionary
+    of observation files. Not intended for use outside of this package."""
+    keys = f.keys()
+    keys.sort()
+    return tuple(map(lambda k: (k, f[k]), keys))
+
+def _snapshotParams(like):
+    """Internal function which returns the values and free flags of all
+    the parameters of all the sources in a likelihood object. Not
+    intended for use outside of this package."""
+    snapshot = []
+    for sn in like.sourceNames():
+        src = like[sn]
+        for fn in src.funcs.keys():
+            func = src.funcs[fn]
+            for pn in func.paramNames:
+                p = func.getParam(pn)
+                snapshot.append((sn, fn, pn, p.getValue(), p.isFree()))
+    return snapshot
+
+def _restoreParams(like, snapshot):
+    """Internal function which resets the parameters of a likelihood
+    object to those of a snapshot. Not intended for use outside of this
+    package."""
+    sync_name = ""
+    for [ sn, fn, pn, value, free ] in snapshot:
+        if sync_name != "" and sync_name != sn:
+            like.syncSrcParams(sync_name)
+        p = like[sn].funcs[fn].getParam(pn)
+        p.setValue(value)
+        p.setFree(free)
+        sync_name = sn
+    if sync_name != "":
+        like.syncSrcParams(sync_name)
+
+def _components(like):
+    """Internal function which returns the list of the likelihood objects
+    that make up a SummedLikelihood, or a list of the likelihood object
+    itself. Not intended for use outside of this package."""
+    if hasattr(like, 'components'):
+        return like.components
+    return [ like ]
+
+class LikelihoodSnapshot:
+    """Class to record the state of a likelihood object (or of each
+    component of a SummedLikelihood), so that it can be put back in that
+    state after it has been fitted and some of its sources deleted
+    (through the deleteSource function of this class)."""
+    def __init__(self, like):
+        self.like = like
+        self.names = []
+        self.params = []
+        self.deleted = []
+        for comp in _components(like):
+            self.names.append(list(comp.sourceNames()))
+            self.params.append(_snapshotParams(comp))
+            self.deleted.append(dict())
+
+    def deleteSource(self, srcName):
+        """Delete a source from the likelihood object, keeping it so that
+        it can be put back by restore."""
+        components = _components(self.like)
+        for icomp in range(len(components)):
+            src = components[icomp].deleteSource(srcName)
+            self.deleted[icomp][srcName] = src
+        if hasattr(self.like, 'components'):
+            self.like.model = self.like.components[0].model
+
+    def restore(self):
+        """Put back deleted sources, in the original order, and reset the
+        parameters to those of the snapshot."""
+        components = _components(self.like)
+        for icomp in range(len(components)):
+            comp = components[icomp]
+            names = self.names[icomp]
+            srcs = self.deleted[icomp]
+            current = list(comp.sourceNames())
+            if current != names:
+                i = 0
+                while i<len(current) and i<len(names) and \
+                          current[i]==names[i]:
+                    i += 1
+                for sn in current[i:]:
+                    srcs[sn] = comp.deleteSource(sn)
+                for sn in names[i:]:
+                    comp.addSource(srcs[sn])
+            self.deleted[icomp] = dict()
+            _restoreParams(comp, self.params[icomp])
+        if hasattr(self.like, 'components'):
+            self.like.model = self.like.components[0].model
+
+class ComponentCache:
+    """Class to keep up to "maxsize" loaded observations, each a list of
+    [ obs, like ] as returned by the loadObs functions of LightCurve and
+    Spectrum, indexed by the dictionary of files of the observation. An
+    observation taken from the cache has its parameters reset to those
+    it had when it was loaded. Sources deleted from it must have been put
+    back before it is taken again, for example by restoring a
+    LikelihoodSnapshot of the (summed) likelihood that used it. The
+    least recently used observation is dropped when the cache is full."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.nload = 0
+        self.nreuse = 0
+
+    def get(self, f, loader, verbosity=0):
+        """Return the observation with files "f" from the cache, or load
+        it by calling loader(f, verbosity) if it is not present."""
+        key = _canonicalKey(f)
+        if self.entries.has_key(key):
+            entry = self.entries.pop(key)
+            self.entries[key] = entry
+            entry['snapshot'].restore()
+            self.nreuse += 1
+            if verbosity:
+                print 'Reusing loaded observation:',key
+            return [ entry['obs'], entry['snapshot'].like ]
+        [ obs, like ] = loader(f, verbosity)
+        self.nload += 1
+        if self.maxsize > 0:
+            self.entries[key] = dict(obs       = obs,
+                                     snapshot  = LikelihoodSnapshot(like))
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return [ obs, like ]
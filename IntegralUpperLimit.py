@@ -12,6 +12,43 @@ $Id$
 See help for IntegralUpperLimits.calc for full details.
 """
 
+# 2026-10-17: Move the global fit, freezing, caches and interval search
+# of calc_int and calc_chi2 into ProfileLikelihood, which can be shared
+# by both to calculate the two limits from one profile.
+
+# 2026-10-17: Add ul_rtol to calc_int, to choose the tolerances from the
+# required precision on the limit, and report the estimated error.
+
+# 2026-10-17: Keep the nuisance parameters in a _NuisanceCache, which
+# interpolates all of them at once and syncs each source only once.
+
+# 2026-10-17: Add posterior_grid to calc_int, to return the normalized
+# posterior and cumulative distribution in results["posterior"].
+
+# 2026-10-17: Build the cumulative distribution in calc_int once, as
+# arrays, and find the upper limit, the profile limits and the
+# probabilities of all the points of interest from it at once.
+
+# 2026-10-17: Record counters and timers of the evaluations made by
+# calc_int and calc_chi2 in results["instrumentation"].
+
+# 2026-10-17: Add calc_many to calculate the limits of many sources in
+# one likelihood from a single global fit.
+
+# 2026-10-17: Add "surrogate" integrator to calc_int, which extends the
+# idea of the approximate function used to find the integration limits
+# to the integration itself. See _surrogate_integrate.
+
+# 2026-10-17: Add "batch" integrator to calc_int, which uses the same
+# Gauss-Kronrod rule as QUADPACK but evaluates the likelihood at all
+# the nodes of a set of intervals at once, possibly in a pool of worker
+# processes (ProfileWorkers) each with its own likelihood object.
+
+# 2026-10-17: Add ProfileCache, which can be passed to calc_int and
+# calc_chi2 to reuse the optimizer evaluations of earlier calls on the
+# same likelihood and model. Remove mutable default caches from
+# _find_interval, which were shared between calls.
+
 # 2011-09-27: Whenever possible call the Python Likelihood classes
 # rather than the underlying C++ class - therefore, all references to
 # "like.logLike" removed. This allows the code to work with
@@ -32,65 +69,212 @@ See help for IntegralUpperLimits.calc for full details.
 # This makes Minuit quicker (at least when using strategy 0)
 
 import UnbinnedAnalysis
+import multiprocessing
+import numpy
 import scipy.integrate
 import scipy.interpolate
 import scipy.optimize
 import scipy.stats
 import math
+import time
 from LikelihoodState import LikelihoodState
 
+# Stack of the instrumentation records of the calculations in progress
+_instrumentation = []
+
+def _new_instrumentation():
+    """Internal function which returns an empty instrumentation record.
+    Not intended for use outside of this package."""
+    return dict(exact_calls         = 0,
+                exact_time          = 0.0,
+                approx_calls        = 0,
+                approx_time         = 0.0,
+                optvalue_cache_hits = 0,
+                nuisance_resets     = 0,
+                nuisance_guesses    = 0,
+                brent_calls         = 0,
+                brent_iterations    = 0,
+                integrand_calls     = 0,
+                integrate_time      = 0.0,
+                total_time          = 0.0)
+
+def _count(name, n=1):
+    """Internal function which adds n to a counter (or timer) of the
+    calculation in progress. Not intended for use outside of this
+    package."""
+    if _instrumentation:
+        _instrumentation[-1][name] += n
+
+def _start_instrumentation():
+    """Internal function which starts recording the evaluations made by
+    a calculation, returning its record. Not intended for use outside of
+    this package."""
+    record = _new_instrumentation()
+    record['total_time'] = -time.time()
+    _instrumentation.append(record)
+    return record
+
+def _stop_instrumentation(record):
+    """Internal function which stops recording the evaluations made by a
+    calculation, adding them to those of the calculation which called
+    it, if any. Records left by calculations which failed are dropped.
+    Not intended for use outside of this package."""
+    while _instrumentation and _instrumentation[-1] is not record:
+        _instrumentation.pop()
+    if _instrumentation:
+        _instrumentation.pop()
+    record['total_time'] += time.time()
+    if _instrumentation:
+        parent = _instrumentation[-1]
+        for name in record:
+            if name != 'total_time':
+                parent[name] += record[name]
+    return record
+
+def aggregate_instrumentation(records):
+    """Sum the instrumentation records (results['instrumentation']) of
+    many calculations, for example those of the time bins of a light
+    curve. Records which are None are ignored. The number of records
+    summed is returned as \"ncalc\"."""
+    total = _new_instrumentation()
+    total['ncalc'] = 0
+    for record in records:
+        if record == None:
+            continue
+        for name in record:
+            if total.has_key(name):
+                total[name] += record[name]
+        total['ncalc'] += 1
+    return total
+
+def _brentq(f, a, b, **kwargs):
+    """Internal function which calls the SciPy Brent root finder,
+    counting its iterations. Not intended for use outside of this
+    package."""
+    [x, r] = scipy.optimize.brentq(f, a, b, full_output=True, **kwargs)
+    _count('brent_calls')
+    _count('brent_iterations', r.iterations)
+    return x
+
+class _NuisanceCache:
+    """Internal class which keeps the values of the free parameters
+    found by the optimizer at each value of the normalization parameter,
+    as a sorted vector of values x and a matrix with one row of
+    parameters per value, so that all the parameters can be interpolated
+    at once. The free parameters are grouped by source so that they can
+    be set with one call to syncSrcParams per source. Not intended for
+    use outside of this package."""
+    def __init__(self):
+        self.x = numpy.zeros(0)
+        self.params = numpy.zeros((0,0))
+        self.layout = None
+
+    def __len__(self):
+        return len(self.x)
+
+    def keys(self):
+        return list(self.x)
+
+    def _index(self, x):
+        i = numpy.searchsorted(self.x, x)
+        if i < len(self.x) and self.x[i] == x:
+            return i
+        return None
+
+    def has_key(self, x):
+        return self._index(x) != None
+
+    def __getitem__(self, x):
+        i = self._index(x)
+        if i == None:
+            raise KeyError(x)
+        return self.params[i]
+
+    def __setitem__(self, x, params):
+        params = numpy.array(params, dtype=float)
+        i = numpy.searchsorted(self.x, x)
+        if i < len(self.x) and self.x[i] == x:
+            self.params[i] = params
+        elif len(self.x) == 0:
+            self.x = numpy.array([x], dtype=float)
+            self.params = params.reshape(1, len(params))
+        else:
+            self.x = numpy.insert(self.x, i, x)
+            self.params = numpy.insert(self.params, i, params, axis=0)
+
+    def interpolate(self, x):
+        """Return the parameters at x, interpolated linearly between the
+        values on either side of it, or those at the nearest end of the
+        cache if x is outside of it."""
+        if x >= self.x[-1]:
+            return self.params[-1]
+        elif x <= self.x[0]:
+            return self.params[0]
+        i = numpy.searchsorted(self.x, x)
+        w = (x-self.x[i-1])/(self.x[i]-self.x[i-1])
+        return self.params[i-1] + w*(self.params[i]-self.params[i-1])
+
+    def update_layout(self, like):
+        """Find the free parameters of the model, grouped by source, as
+        a list of [ srcName, iparams, icache ] with the indices of the
+        parameters in the model and in the rows of the cache, and their
+        bounds."""
+        layout = []
+        limlo = []
+        limhi = []
+        for iparam in range(len(like.model.params)):
+            p = like.model[iparam]
+            if p.isFree():
+                sn = like[iparam].srcName
+                if len(layout)==0 or layout[-1][0] != sn:
+                    layout.append([ sn, [], [] ])
+                layout[-1][1].append(iparam)
+                layout[-1][2].append(len(limlo))
+                lo, hi = p.getBounds()
+                limlo.append(lo)
+                limhi.append(hi)
+        self.layout = layout
+        self.limlo = numpy.array(limlo)
+        self.limhi = numpy.array(limhi)
+
+    def values(self, like):
+        """Return the values of the free parameters of the model,
+        finding them again in case the free parameters have changed."""
+        self.update_layout(like)
+        params = numpy.zeros(len(self.limlo))
+        for [ sn, iparams, icache ] in self.layout:
+            for i in range(len(iparams)):
+                params[icache[i]] = like.model[iparams[i]].value()
+        return params
+
+    def apply(self, like, params):
+        """Set the free parameters of the model to the given values,
+        limited to their bounds, syncing each source once."""
+        params = numpy.minimum(numpy.maximum(params, self.limlo), self.limhi)
+        for [ sn, iparams, icache ] in self.layout:
+            for i in range(len(iparams)):
+                like.model[iparams[i]].setValue(params[icache[i]])
+            like.syncSrcParams(sn)
+
 def _guess_nuisance(x, like, cache):
     """Internal function which guesses the value of a nuisance
     parameter before the optimizer is called by interpolating from
     previously found values. Not intended for use outside of this
     package."""
-    X = cache.keys()
-    X.sort()
-    if len(X)<2:
+    if len(cache)<2:
         return
-    elif x>max(X):
-        _reset_nuisance(max(X), like, cache)
-        return
-    elif x<min(X):
-        _reset_nuisance(min(X), like, cache)
-        return        
-    sync_name = ""
-    icache = 0
-    for iparam in range(len(like.model.params)):
-        if sync_name != like[iparam].srcName:
-            like.syncSrcParams(sync_name)
-            sync_name = ""
-        if(like.model[iparam].isFree()):
-            Y = []
-            for ix in X: Y.append(cache[ix][icache])
-            # Simple interpolation is best --- DO NOT use splines!
-            p = scipy.interpolate.interp1d(X,Y)(x).item()
-            limlo, limhi = like.model[iparam].getBounds()
-            p = max(limlo, min(p, limhi))
-            like.model[iparam].setValue(p)
-            sync_name = like[iparam].srcName
-            icache += 1
-    if sync_name != "":
-        like.syncSrcParams(sync_name)
+    _count('nuisance_guesses')
+    # Simple interpolation is best --- DO NOT use splines!
+    cache.apply(like, cache.interpolate(x))
 
 def _reset_nuisance(x, like, cache):
     """Internal function which sets the values of the nuisance
     parameters to those found in a previous iteration of the
     optimizer. Not intended for use outside of this package."""
-    sync_name = ""
-    icache = 0
-    if cache.has_key(x):
-        params = cache[x]
-        for iparam in range(len(like.model.params)):
-            if sync_name != like[iparam].srcName:
-                like.syncSrcParams(sync_name)
-                sync_name = ""
-            if(like.model[iparam].isFree()):
-                like.model[iparam].setValue(params[icache])
-                sync_name = like[iparam].srcName
-                icache += 1
-        if sync_name != "":
-            like.syncSrcParams(sync_name)
+    i = cache._index(x)
+    if i != None:
+        _count('nuisance_resets')
+        cache.apply(like, cache.params[i])
         return True
     return False
 
@@ -98,11 +282,52 @@ def _cache_nuisance(x, like, cache):
     """Internal function which caches the values of the nuisance
     parameters found after optimization so that they can be used
     again. Not intended for use outside of this package."""
-    params = []
+    cache[x] = cache.values(like)
+
+def _model_state(like, srcName, par):
+    """Internal function which returns a hashable summary of the state
+    of the model on which the profile likelihood of a parameter depends:
+    which parameters are free and the values of those that are not,
+    other than the parameter itself. Not intended for use outside of
+    this package."""
+    state = []
+    parname = par.getName()
     for iparam in range(len(like.model.params)):
-        if(like.model[iparam].isFree()):
-            params.append(like.model[iparam].value())
-    cache[x] = params
+        p = like.model[iparam]
+        if p.isFree():
+            state.append((iparam, True))
+        elif like[iparam].srcName == srcName and p.getName() == parname:
+            state.append((iparam, None))
+        else:
+            state.append((iparam, p.getValue()))
+    return tuple(state)
+
+class ProfileCache:
+    """Cache of the optimized values of the likelihood (and of the
+    nuisance parameters found by the optimizer) at the values of the
+    normalization parameter of a source at which the profile likelihood
+    has been evaluated. It can be passed to calc_int and calc_chi2 so
+    that repeated limits on the same likelihood, for example at a
+    different confidence level or by the other method, reuse the
+    evaluations already made rather than calling the optimizer again.
+    The values are kept separately for each likelihood object, source
+    and state of the model (which parameters are free and the values of
+    those that are not), so they are never used if the model changes."""
+    def __init__(self):
+        self.entries = dict()
+        self._likes = dict()
+
+    def caches(self, like, srcName, par):
+        """Return the dictionaries of optimum values and nuisance
+        parameters, indexed by value of the parameter "par" of source
+        srcName, for the current state of the model."""
+        # Keep a reference to the likelihood so its id is not reused
+        self._likes[id(like)] = like
+        key = (id(like), srcName, like.optimizer, like.tol,
+               _model_state(like, srcName, par))
+        if not self.entries.has_key(key):
+            self.entries[key] = [ dict(), _NuisanceCache() ]
+        return self.entries[key]
 
 def _loglike(x, like, par, srcName, offset, verbosity, no_optimizer,
              optvalue_cache, nuisance_cache):
@@ -121,7 +346,11 @@ def _loglike(x, like, par, srcName, offset, verbosity, no_optimizer,
     # approximate function or in the case when all parameters are frozen or
     # since some optimizers might have problems being called with nothing to do
     if no_optimizer:
-        return -like() - offset
+        t0 = time.time()
+        value = -like() - offset
+        _count('approx_calls')
+        _count('approx_time', time.time()-t0)
+        return value
 
     # Call the optimizer of the optimum value is not in the cache OR if
     # we fail to reset the nuisance parameters to those previously found
@@ -129,6 +358,7 @@ def _loglike(x, like, par, srcName, offset, verbosity, no_optimizer,
     if ((optvalue_cache == None) or (nuisance_cache == None) or
         (not optvalue_cache.has_key(x)) or
         (_reset_nuisance(x, like, nuisance_cache) == False)):
+        t0 = time.time()
         try:
             if(nuisance_cache != None):
                 _guess_nuisance(x, like, nuisance_cache)
@@ -140,9 +370,12 @@ def _loglike(x, like, par, srcName, offset, verbosity, no_optimizer,
             if(nuisance_cache != None):
                 _cache_nuisance(x, like, nuisance_cache)
         optvalue = -like()
+        _count('exact_calls')
+        _count('exact_time', time.time()-t0)
         if(optvalue_cache != None):
             optvalue_cache[x] = optvalue
     else:
+        _count('optvalue_cache_hits')
         optvalue = optvalue_cache[x]
     return optvalue - offset
 
@@ -153,6 +386,7 @@ def _integrand(x, f_of_x, like, par, srcName, maxval, verbosity,
 
     f = math.exp(_loglike(x,like,par,srcName,maxval,verbosity,no_optimizer,
                           optvalue_cache,nuisance_cache))
+    _count('integrand_calls')
     f_of_x[x] = f
     if verbosity:
         print "Function evaluation:", x, f
@@ -183,30 +417,447 @@ def _root(x, like, par, srcName, subval, verbosity,
         print "Exact function root evaluation:", x, f
     return f
 
-def _splintroot(xhi, yseek, xlo, spl_rep):
-    """Internal function used by the SciPy root finder to find the
-    point where integral of (spline) likelihood passes desired
-    threshold.  Not intended for use outside of this package."""
-    return scipy.interpolate.splint(xlo,xhi,spl_rep)-yseek
-
 def _splevroot(x, yseek, spl_rep):
     """Internal function used by the SciPy root finder to find the
     point where the (spline of the) log-likelihood passes desired
     threshold.  Not intended for use outside of this package."""
     return scipy.interpolate.splev(x, spl_rep)-yseek
 
-def _int1droot(x, yseek, int_rep):
-    """Internal function used by the SciPy root finder to find the
-    point where the (linear interpolation of the) log-likelihood
-    passes desired threshold.  Not intended for use outside of this
+def _first_crossing(X, Y, yseek):
+    """Internal function which returns the index i of the first point
+    of the tabulated function Y(X) which is on the other side of yseek
+    from Y[0], so that the first crossing is between X[i-1] and X[i].
+    Raises ValueError if Y never crosses yseek. Not intended for use
+    outside of this package."""
+    S = numpy.sign(Y - yseek)
+    i = numpy.nonzero(S[1:] != S[0])[0]
+    if len(i) == 0:
+        raise ValueError("function does not cross %g in [%g,%g]"
+                         %(yseek,X[0],X[-1]))
+    return i[0]+1
+
+def _linear_root(X, Y, yseek):
+    """Internal function which returns the first point where the linear
+    interpolation of the tabulated function Y(X) passes yseek. Not
+    intended for use outside of this package."""
+    i = _first_crossing(X, Y, yseek)
+    return X[i-1] + (yseek-Y[i-1])*(X[i]-X[i-1])/(Y[i]-Y[i-1])
+
+def _spline_root(X, spl_rep, yseek):
+    """Internal function which returns the first point in [X[0],X[-1]]
+    where a spline passes yseek. The spline is evaluated on all points
+    of X at once to bracket the crossing, which is then refined with
+    the SciPy root finder. Not intended for use outside of this
+    package."""
+    Y = scipy.interpolate.splev(X, spl_rep)
+    i = _first_crossing(X, Y, yseek)
+    if Y[i] == yseek:
+        return X[i]
+    return scipy.optimize.brentq(_splevroot, X[i-1], X[i],
+                                 args = (yseek, spl_rep))
+
+def _tolerances(cl, ul_rtol):
+    """Internal function which chooses the relative tolerance of the
+    integrator, the tolerance of the optimizer, the range of integration
+    in log likelihood and the number of iterations of the search for it
+    needed to find an upper limit with relative accuracy ul_rtol. The
+    probability beyond the limit, 1-cl, must be found to a fraction of
+    ul_rtol, since the probability density at the limit is typically
+    (1-cl)/limit or more. The error estimate of QUADPACK is pessimistic
+    so the integrator is started at that tolerance, and calc_int refines
+    it if necessary, but the probability outside the range of
+    integration is kept ten times smaller. Not intended for use outside
+    of this package."""
+    epsrel = (1.0-cl)*ul_rtol
+    tol = 0.1*ul_rtol
+    delta_log_like_limits = -math.log(0.1*epsrel)
+    nloopmax = max(2, int(math.ceil(-math.log10(ul_rtol)))+3)
+    return [ epsrel, tol, delta_log_like_limits, nloopmax ]
+
+def _distribution(P, xlo, xhi, X, Y, Cint, spl_irep, spl_arep, use_spline):
+    """Internal function which returns the normalized probability
+    density and cumulative probability at the points P, from the
+    spline of the function evaluations Y(X) and its antiderivative, or
+    from their linear interpolation and trapezoidal integral Cint. Not
+    intended for use outside of this package."""
+    if len(P) == 0:
+        return numpy.zeros(0), numpy.zeros(0)
+    if use_spline:
+        alo = scipy.interpolate.splev(xlo, spl_arep)
+        norm = scipy.interpolate.splev(xhi, spl_arep) - alo
+        pdf = numpy.maximum(scipy.interpolate.splev(P, spl_irep), 0)/norm
+        cdf = (scipy.interpolate.splev(P, spl_arep)-alo)/norm
+    else:
+        pdf = numpy.interp(P, X, Y)/Cint[-1]
+        cdf = numpy.interp(P, X, Cint)/Cint[-1]
+    inside = numpy.logical_and(P>xlo, P<xhi)
+    pdf = numpy.where(inside, pdf, 0.0)
+    cdf = numpy.where(P>=xhi, 1.0, numpy.where(P<=xlo, 0.0, cdf))
+    return pdf, cdf
+
+def _grid(X, xlo, xhi):
+    """Internal function which returns the points of X inside [xlo,xhi]
+    with the end points of the interval added. Not intended for use
+    outside of this package."""
+    X = X[numpy.logical_and(X>xlo, X<xhi)]
+    return numpy.concatenate(([xlo], X, [xhi]))
+
+def _param_state(like):
+    """Internal function which returns the values and free flags of all
+    the parameters of the model, so that they can be set on another
+    copy of the likelihood. Not intended for use outside of this
+    package."""
+    state = []
+    for iparam in range(len(like.model.params)):
+        p = like.model[iparam]
+        state.append((like[iparam].srcName, p.getName(), p.getValue(),
+                      p.isFree()))
+    return state
+
+def _set_param_state(like, state):
+    """Internal function which sets the values and free flags of all the
+    parameters of the model from a state found by _param_state. Not
+    intended for use outside of this package."""
+    if len(state) != len(like.model.params):
+        raise RuntimeError("Models of likelihood objects do not match")
+    sync_name = ""
+    for iparam in range(len(like.model.params)):
+        [sn, pn, value, free] = state[iparam]
+        if sync_name != "" and sync_name != sn:
+            like.syncSrcParams(sync_name)
+        p = like.model[iparam]
+        if like[iparam].srcName != sn or p.getName() != pn:
+            raise RuntimeError("Models of likelihood objects do not match")
+        p.setValue(value)
+        p.setFree(free)
+        sync_name = sn
+    if sync_name != "":
+        like.syncSrcParams(sync_name)
+
+# Likelihood object and profile cache of a worker process of
+# ProfileWorkers
+_worker_like = None
+_worker_cache = None
+
+def _worker_init(like_factory):
+    """Internal function which creates the likelihood object of a worker
+    process. Not intended for use outside of this package."""
+    global _worker_like, _worker_cache
+    _worker_like = like_factory()
+    _worker_cache = ProfileCache()
+
+def _worker_loglike(task):
+    """Internal function run by the worker processes to evaluate the
+    profile likelihood at one point, returning the point, the optimum
+    value, the nuisance parameters found and the time taken. Not
+    intended for use outside of this package."""
+    [state, optimizer, tol, srcName, x, no_optimizer, nuisance_cache] = task
+    like = _worker_like
+    like.optimizer = optimizer
+    like.tol = tol
+    _set_param_state(like, state)
+    par = like.normPar(srcName)
+    t0 = time.time()
+    optvalue = _loglike(x, like, par, srcName, 0, 0, no_optimizer,
+                        None, nuisance_cache)
+    if nuisance_cache == None:
+        nuisance_cache = _NuisanceCache()
+    return [x, optvalue, nuisance_cache.values(like), time.time()-t0]
+
+def _worker_limit(task):
+    """Internal function run by the worker processes to calculate the
+    upper limit of one source (see calc_many). Not intended for use
+    outside of this package."""
+    [state, optimizer, tol, method, srcName, kwargs] = task
+    like = _worker_like
+    like.optimizer = optimizer
+    like.tol = tol
+    _set_param_state(like, state)
+    if method == 'bayesian':
+        return calc_int(like, srcName, skip_global_opt=True,
+                        cache=_worker_cache, **kwargs)
+    return calc_chi2(like, srcName, skip_global_opt=True,
+                     cache=_worker_cache, **kwargs)
+
+class ProfileWorkers:
+    """Pool of worker processes, each holding its own copy of the
+    likelihood object, made by calling like_factory() (which must be
+    picklable, for example a function defined at module level), used by
+    calc_int to evaluate the profile likelihood at many points
+    concurrently, or by calc_many to calculate the limits of many
+    sources concurrently. The model of each copy is set to that of the
+    likelihood passed to calc_int before each evaluation, so the copies
+    must have the same sources and parameters. The pool can be used for
+    many calls to calc_int, and should be closed when it is no longer
+    needed."""
+    def __init__(self, like_factory, nworkers):
+        self.nworkers = nworkers
+        self.pool = multiprocessing.Pool(nworkers, _worker_init,
+                                         (like_factory,))
+
+    def map(self, tasks):
+        return self.pool.map(_worker_loglike, tasks)
+
+    def limits(self, tasks):
+        return self.pool.map(_worker_limit, tasks)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+# Nodes and weights of the 21 point Gauss-Kronrod rule, as used by the
+# QUADPACK routine QK21 (and so by scipy.integrate.quad). Only the
+# nodes in [0,1) are given, the Gauss nodes are those with odd index.
+_gk21_xgk = numpy.array([ 0.995657163025808080735527280689003,
+                          0.973906528517171720077964012084452,
+                          0.930157491355708226001207180059508,
+                          0.865063366688984510732096688423493,
+                          0.780817726586416897063717578345042,
+                          0.679409568299024406234327365114874,
+                          0.562757134668604683339000099272694,
+                          0.433395394129247190799265943165784,
+                          0.294392862701460198131126603103866,
+                          0.148874338981631210884826001129720,
+                          0.000000000000000000000000000000000 ])
+_gk21_wgk = numpy.array([ 0.011694638867371874278064396062192,
+                          0.032558162307964727478818972459390,
+                          0.054755896574351996031381300244580,
+                          0.075039674810919952767043140916190,
+                          0.093125454583697605535065465083366,
+                          0.109387158802297641899210590325805,
+                          0.123491976262065851077715474983126,
+                          0.134709217311473325928054001771707,
+                          0.142775938577060080797094273138717,
+                          0.147739104901338491374841515972068,
+                          0.149445554002916905664936468389821 ])
+_gk21_wg = numpy.array([ 0.066671344308688137593568809893332,
+                         0.149451349150580593145776339657697,
+                         0.219086362515982043995534934228163,
+                         0.269266719309996355091226921569469,
+                         0.295524224714752870173892994651338 ])
+
+def _gk21_nodes(a, b):
+    """Internal function which returns the 21 nodes of the Gauss-Kronrod
+    rule on [a,b]. Not intended for use outside of this package."""
+    c = 0.5*(a+b)
+    h = 0.5*(b-a)
+    return numpy.concatenate((c-h*_gk21_xgk[:-1], [ c ],
+                              c+h*_gk21_xgk[-2::-1]))
+
+def _gk21_rule(a, b, f):
+    """Internal function which returns the Kronrod estimate of the
+    integral over [a,b] and its error, estimated as in QUADPACK, given
+    the function values at the nodes returned by _gk21_nodes. Not
+    intended for use outside of this package."""
+    h = 0.5*(b-a)
+    w = numpy.concatenate((_gk21_wgk, _gk21_wgk[-2::-1]))
+    wg = numpy.zeros(21)
+    wg[1:10:2] = _gk21_wg
+    wg[11:20:2] = _gk21_wg[::-1]
+    resk = numpy.sum(w*f)
+    resg = numpy.sum(wg*f)
+    resabs = numpy.sum(w*abs(f))
+    resasc = numpy.sum(w*abs(f-0.5*resk))
+    abserr = abs((resk-resg)*h)
+    if resasc != 0 and abserr != 0:
+        abserr = resasc*abs(h)*min(1.0, (200.0*abserr/(resasc*abs(h)))**1.5)
+    eps = numpy.finfo(float).eps
+    abserr = max(abserr, 50*eps*resabs*abs(h))
+    return resk*h, abserr
+
+def _batch_integrate(xlo, xhi, f_of_x, like, par, srcName, maxval,
+                     verbosity, no_optimizer, optvalue_cache,
+                     nuisance_cache, epsrel, epsabs, points=(),
+                     workers=None, limit=50):
+    """Internal function which integrates the likelihood function with
+    an adaptive 21 point Gauss-Kronrod rule, as scipy.integrate.quad
+    does, but evaluating the function at all the nodes of a batch of
+    intervals at once, concurrently if a ProfileWorkers pool is given.
+    Every interval whose error is needed to meet the tolerance is
+    bisected in each round. Not intended for use outside of this
     package."""
-    return int_rep(x).item()-yseek
+    edges = [ xlo ]
+    for x in sorted(points):
+        if x > xlo and x < xhi:
+            edges.append(x)
+    edges.append(xhi)
+    intervals = zip(edges[:-1], edges[1:])
+    done = []
+    while True:
+        _batch_eval(numpy.concatenate(map(lambda i: _gk21_nodes(*i),
+                                          intervals)),
+                    f_of_x, like, par, srcName, maxval, verbosity,
+                    no_optimizer, optvalue_cache, nuisance_cache, workers)
+        for [a, b] in intervals:
+            f = numpy.array(map(lambda x: f_of_x[x], _gk21_nodes(a, b)))
+            [ival, ierr] = _gk21_rule(a, b, f)
+            done.append([ierr, a, b, ival])
+        ival = sum(map(lambda d: d[3], done))
+        ierr = sum(map(lambda d: d[0], done))
+        tol = max(epsabs, epsrel*abs(ival))
+        if ierr <= tol or len(done) >= limit:
+            break
+        # Bisect the intervals with the largest errors, as many as are
+        # needed to bring the error of the others within tolerance
+        done.sort()
+        intervals = []
+        while done and ierr > tol and len(done)+2*len(intervals) < limit:
+            [err, a, b, unused] = done.pop()
+            intervals.extend([ (a, 0.5*(a+b)), (0.5*(a+b), b) ])
+            ierr -= err
+        if verbosity:
+            print "Batch integration: %d intervals, refining %d"\
+                  %(len(done)+len(intervals)/2,len(intervals)/2)
+    return ival, ierr
+
+def _batch_eval(X, f_of_x, like, par, srcName, maxval, verbosity,
+                no_optimizer, optvalue_cache, nuisance_cache, workers):
+    """Internal function which evaluates the likelihood function at all
+    the points in X which have not been evaluated already, filling
+    f_of_x and the caches. Not intended for use outside of this
+    package."""
+    todo = []
+    for x in X:
+        if optvalue_cache.has_key(x):
+            f_of_x[x] = math.exp(optvalue_cache[x]-maxval)
+        elif not x in todo:
+            todo.append(x)
+    if not todo:
+        return
+    if workers == None or no_optimizer:
+        for x in todo:
+            _integrand(x, f_of_x, like, par, srcName, maxval, verbosity,
+                       no_optimizer, optvalue_cache, nuisance_cache)
+        return
+    state = _param_state(like)
+    tasks = map(lambda x: [state, like.optimizer, like.tol, srcName, x,
+                           no_optimizer, nuisance_cache], todo)
+    for [x, optvalue, nuisance, dt] in workers.map(tasks):
+        _count('exact_calls')
+        _count('exact_time', dt)
+        _count('integrand_calls')
+        optvalue_cache[x] = optvalue
+        nuisance_cache[x] = nuisance
+        f_of_x[x] = math.exp(optvalue-maxval)
+        if verbosity:
+            print "Function evaluation:", x, f_of_x[x]
+
+def _surrogate_correction(xk, dk):
+    """Internal function which returns a function interpolating the
+    difference between the exact and approximate log likelihood, known
+    at the points xk, with a spline of degree up to three. Not intended
+    for use outside of this package."""
+    if len(xk) == 1:
+        return lambda x: dk[0]+0*x
+    rep = scipy.interpolate.splrep(xk, dk, k=min(3,len(xk)-1), s=0)
+    return lambda x: scipy.interpolate.splev(x, rep)
+
+def _surrogate_integrate(xlo, xhi, fitval, f_of_x, like, par, srcName,
+                         maxval, verbosity, no_optimizer, optvalue_cache,
+                         nuisance_cache, cl, tol, npoint=201, nloopmax=10):
+    """Internal function which integrates a surrogate of the likelihood
+    function: the approximate function (with the nuisance parameters
+    kept at their values at the peak), which is cheap to evaluate, plus
+    a spline through its difference from the exact function at the
+    points where that is known. The exact function is evaluated where
+    it matters most for the limit, at the \"cl\" quantile of the
+    surrogate and in the middle of the widest gap in probability between
+    exact points, until the surrogate predicts it there to within
+    \"tol\" in log likelihood. The error returned bounds the error of
+    the integral from the largest difference between the surrogate and
+    the exact function at the points used to test it, and from the
+    difference between the trapezoid and Simpson rules on the grid. Not
+    intended for use outside of this package."""
+    X = numpy.linspace(xlo, xhi, npoint)
+    if no_optimizer:
+        # The approximate function is exact
+        for x in X:
+            _integrand(x, f_of_x, like, par, srcName, maxval, verbosity,
+                       True, None, None)
+        Y = map(lambda x: f_of_x[x], X)
+        ival = scipy.integrate.trapz(Y, X)
+        return ival, abs(ival - scipy.integrate.simps(Y, X))
+
+    approx_cache = dict()
+    def approx(x):
+        if not approx_cache.has_key(x):
+            _reset_nuisance(fitval, like, nuisance_cache)
+            approx_cache[x] = _loglike(x, like, par, srcName, maxval,
+                                       verbosity, True, None, None)
+        return approx_cache[x]
+    G = numpy.array(map(approx, X))
+
+    xk = []
+    for x in optvalue_cache.keys():
+        if x >= xlo and x <= xhi:
+            xk.append(x)
+    # The gaps between exact points need at least two of them, so add
+    # the peak and the ends of the range if the search for the limits
+    # left fewer in the range
+    for x in [ min(max(fitval, xlo), xhi), xhi, xlo ]:
+        if len(xk) >= 2:
+            break
+        if not x in xk:
+            _loglike(x, like, par, srcName, maxval, verbosity, False,
+                     optvalue_cache, nuisance_cache)
+            xk.append(x)
+
+    ival = None
+    iloop = 0
+    # Largest difference between the surrogate and the exact function
+    # at the test points; until some are tested assume it is "tol"
+    dev = tol
+    while True:
+        xk.sort()
+        dk = map(lambda x: optvalue_cache[x]-maxval-approx(x), xk)
+        corr = _surrogate_correction(xk, dk)
+        P = numpy.exp(G + corr(X))
+        C = numpy.zeros(npoint)
+        C[1:] = numpy.cumsum(0.5*(P[1:]+P[:-1])*numpy.diff(X))
+        ival = C[-1]
+        if iloop >= nloopmax:
+            break
+        Ck = numpy.interp(xk, X, C)
+        igap = numpy.argmax(numpy.diff(Ck))
+        xtest = [ numpy.interp(cl*ival, C, X), 0.5*(xk[igap]+xk[igap+1]) ]
+        converged = True
+        loop_dev = None
+        for x in xtest:
+            if optvalue_cache.has_key(x):
+                continue
+            y = _loglike(x, like, par, srcName, maxval, verbosity,
+                         False, optvalue_cache, nuisance_cache)
+            ypred = approx(x) + corr(x)
+            if verbosity:
+                print "Surrogate evaluation: %g, %g (predicted %g)"\
+                      %(x,y,ypred)
+            if abs(y-ypred) > tol:
+                converged = False
+            if loop_dev == None or abs(y-ypred) > loop_dev:
+                loop_dev = abs(y-ypred)
+            xk.append(x)
+        if loop_dev != None:
+            dev = loop_dev
+        iloop += 1
+        if converged:
+            break
+
+    for ix in range(npoint):
+        f_of_x[X[ix]] = P[ix]
+    for x in xk:
+        f_of_x[x] = math.exp(optvalue_cache[x]-maxval)
+    if dev < 700:
+        ierr = ival*(math.exp(dev)-1)
+    else:
+        ierr = float('inf')
+    ierr += abs(ival - scipy.integrate.simps(P, X))
+    return ival, ierr
 
 def _find_interval(like, par, srcName, no_optimizer,
                    maxval, fitval, limlo, limhi,
                    delta_log_like_limits = 2.71/2, verbosity = 0, tol = 0.01, 
                    no_lo_bound_search = False, nloopmax = 5,
-                   optvalue_cache = dict(), nuisance_cache = dict()):
+                   optvalue_cache = None, nuisance_cache = None):
     """Internal function to search for interval of the normalization
     parameter in which the log Likelihood is larger than predefined
     value. Used to find the upper limit in the profile method and to
@@ -214,6 +865,11 @@ def _find_interval(like, par, srcName, no_optimizer,
     the SciPy Brent method root finder to do the search. Use new fast
     method for up to nloopmax iterations then fall back to old method."""
 
+    if optvalue_cache == None:
+        optvalue_cache = dict()
+    if nuisance_cache == None:
+        nuisance_cache = _NuisanceCache()
+
     subval = maxval - delta_log_like_limits
     search_xtol = limlo*0.1
     search_ytol = tol
@@ -257,10 +913,10 @@ def _find_interval(like, par, srcName, no_optimizer,
         approx_cache = dict()
         approx_cache[xtst] = ytst
         if _approxroot(xrgt,approx_cache,like,par,srcName,subval,verbosity)<0:
-            xtst = scipy.optimize.brentq(_approxroot, xlft, xrgt,
-                                         xtol=search_xtol, 
-                                    args = (approx_cache,like,par,
-                                            srcName,subval,verbosity))
+            xtst = _brentq(_approxroot, xlft, xrgt,
+                           xtol=search_xtol, 
+                           args = (approx_cache,like,par,
+                                   srcName,subval,verbosity))
         else:
             xtst = xrgt
         ytst = _root(xtst, like, par,srcName, subval, verbosity,
@@ -294,10 +950,10 @@ def _find_interval(like, par, srcName, no_optimizer,
         if xrgt<limhi or \
                _root(xrgt, like, par, srcName, subval, verbosity,
                      no_optimizer, optvalue_cache, nuisance_cache)<0:
-            xhi = scipy.optimize.brentq(_root, xlft, xrgt, xtol=search_xtol,
-                                        args = (like,par,srcName,\
-                                                subval,verbosity,no_optimizer,
-                                                optvalue_cache,nuisance_cache))
+            xhi = _brentq(_root, xlft, xrgt, xtol=search_xtol,
+                          args = (like,par,srcName,\
+                                  subval,verbosity,no_optimizer,
+                                  optvalue_cache,nuisance_cache))
             pass
         yhi = _root(xhi, like, par, srcName, subval, verbosity,
                     no_optimizer, optvalue_cache, nuisance_cache)
@@ -323,10 +979,10 @@ def _find_interval(like, par, srcName, no_optimizer,
         approx_cache = dict()        
         approx_cache[xtst] = ytst
         if _approxroot(xlft,approx_cache,like,par,srcName,subval,verbosity)<0:
-            xtst = scipy.optimize.brentq(_approxroot, xlft, xrgt,
-                                         xtol=search_xtol, 
-                                         args = (approx_cache,like,par,
-                                                 srcName,subval,verbosity))
+            xtst = _brentq(_approxroot, xlft, xrgt,
+                           xtol=search_xtol, 
+                           args = (approx_cache,like,par,
+                                   srcName,subval,verbosity))
         else:
             xtst = xlft
         ytst = _root(xtst, like, par, srcName, subval, verbosity,
@@ -360,10 +1016,10 @@ def _find_interval(like, par, srcName, no_optimizer,
         if xlft>limlo or \
                _root(xlft, like, par, srcName, subval, verbosity,
                      no_optimizer, optvalue_cache, nuisance_cache)<0:
-            xlo = scipy.optimize.brentq(_root, xlft, xrgt, xtol=search_xtol,
-                                        args = (like,par,srcName,\
-                                                subval,verbosity,no_optimizer,
-                                                optvalue_cache,nuisance_cache))
+            xlo = _brentq(_root, xlft, xrgt, xtol=search_xtol,
+                          args = (like,par,srcName,\
+                                  subval,verbosity,no_optimizer,
+                                  optvalue_cache,nuisance_cache))
             pass
         ylo = _root(xlo, like, par, srcName, subval, verbosity,
                     no_optimizer, optvalue_cache, nuisance_cache)
@@ -374,6 +1030,138 @@ def _find_interval(like, par, srcName, no_optimizer,
     exact_root_evals += len(optvalue_cache)
     return [xlo, xhi, ylo, yhi, exact_root_evals, approx_root_evals]
 
+class ProfileLikelihood:
+    """Profile likelihood of the normalization parameter of a source,
+    shared by the upper limit methods. When it is created the global
+    maximum of the likelihood is found (unless skip_global_opt is
+    given), the other parameters are frozen if freeze_all is given, and
+    the parameter of interest is frozen. The object then keeps the state
+    of the likelihood before and at the maximum, the caches of the
+    optimum values and nuisance parameters, and does the search for the
+    points at which the likelihood has fallen by a given amount.
+
+    It can be passed to calc_int and calc_chi2 so that both limits are
+    calculated from the same profile without calling the optimizer
+    again for points already evaluated. Each of them puts the model
+    back at the maximum when it is done; call restore when finished to
+    put the likelihood back in its original state. The arguments are as
+    for calc_int, with tol the tolerance of the optimizer used for the
+    profile (by default that of the likelihood)."""
+    def __init__(self, like, srcName, verbosity=0, skip_global_opt=False,
+                 freeze_all=False, profile_optimizer=None, cache=None,
+                 tol=None):
+        self.like = like
+        self.srcName = srcName
+        self.verbosity = verbosity
+        self.saved_state = LikelihoodState(like)
+        self.original_optimizer = like.optimizer
+        self.original_tol = like.tol
+
+        # Optimizer uses verbosity level one smaller than given here
+        optverbosity = max(verbosity-1, 0)
+
+        par = like.normPar(srcName)
+        self.par = par
+
+        self.fitstat = None
+        if not skip_global_opt:
+            # Make sure desired parameter is free during global optimization
+            par.setFree(1)
+            like.syncSrcParams(srcName)
+
+            # Perform global optimization
+            if verbosity:
+                print "Finding global maximum"
+            try:
+                like.fit(optverbosity)
+                self.fitstat = like.optObject.getRetCode()
+                if verbosity and self.fitstat != 0:
+                    print "Minimizer returned with non-zero code: ",\
+                          self.fitstat
+            except RuntimeError:
+                print "Failed to find global maximum, results may be wrong"
+                pass
+            pass
+
+        if profile_optimizer != None:
+            like.optimizer = profile_optimizer
+        if tol != None:
+            like.tol = tol
+
+        # Store values of global fit
+        self.maxval = -like()
+        self.fitval = par.getValue()
+        self.fiterr = par.error()
+        self.limlo, self.limhi = par.getBounds()
+        if verbosity:
+            print "Maximum of %g with %s = %g +/- %g"\
+                  %(-self.maxval,srcName,self.fitval,self.fiterr)
+
+        # Freeze all other model parameters if requested (much faster!)
+        if(freeze_all):
+            for i in range(len(like.model.params)):
+                like.model[i].setFree(0)
+                like.syncSrcParams(like[i].srcName)
+
+        # Freeze the parameter of interest
+        par.setFree(0)
+        like.syncSrcParams(srcName)
+
+        # Set up the caches for the optimum values and nuisance parameters
+        if cache != None:
+            [self.optvalue_cache, self.nuisance_cache] = \
+                                  cache.caches(like, srcName, par)
+        else:
+            self.optvalue_cache = dict()
+            self.nuisance_cache = _NuisanceCache()
+        self.optvalue_cache[self.fitval] = self.maxval
+        _cache_nuisance(self.fitval, like, self.nuisance_cache)
+
+        # Test if all parameters are frozen (could be true if we froze
+        # them above or if they were frozen in the user's model
+        self.all_frozen = True
+        for i in range(len(like.model.params)):
+            if like.model[i].isFree():
+                self.all_frozen = False
+                break
+
+        self.peak_state = LikelihoodState(like)
+
+    def loglike(self, x):
+        """Return the profile log likelihood at x, relative to the value
+        at the maximum."""
+        return _loglike(x, self.like, self.par, self.srcName, self.maxval,
+                        self.verbosity, self.all_frozen,
+                        self.optvalue_cache, self.nuisance_cache)
+
+    def interval(self, delta_log_like, no_lo_bound_search=False, nloopmax=5):
+        """Find the interval around the maximum in which the log
+        likelihood is within delta_log_like of the maximum, returning
+        [ xlo, xhi, ylo, yhi, exact_root_evals, approx_root_evals ]."""
+        return _find_interval(self.like, self.par, self.srcName,
+                              self.all_frozen, self.maxval, self.fitval,
+                              self.limlo, self.limhi, delta_log_like,
+                              self.verbosity, self.like.tol,
+                              no_lo_bound_search, nloopmax,
+                              self.optvalue_cache, self.nuisance_cache)
+
+    def flux(self, x, emin, emax):
+        """Return the flux of the source with its normalization at x."""
+        self.par.setValue(x)
+        return self.like[self.srcName].flux(emin, emax)
+
+    def reset(self):
+        """Put the model back at the global maximum, with the parameter
+        of interest frozen, so that another limit can be calculated."""
+        self.peak_state.restore()
+
+    def restore(self):
+        """Put the likelihood back in the state it had before the
+        profile was created, with its original optimizer and tolerance."""
+        self.like.optimizer = self.original_optimizer
+        self.like.tol = self.original_tol
+        self.saved_state.restore()
+
 def calc(like, srcName, *args, **kwargs):
    print "IntegralUpperLimits.calc() is deprecated, use calc_int() instead"
    return calc_int(like, srcName, *args,**kwargs)
@@ -381,7 +1169,9 @@ def calc(like, srcName, *args, **kwargs):
 def calc_int(like, srcName, cl=0.95, verbosity=0,
              skip_global_opt=False, be_very_careful=False, freeze_all=False,
              delta_log_like_limits = 10.0, profile_optimizer = None,
-             emin=100, emax=3e5, poi_values = []):
+             emin=100, emax=3e5, poi_values = [], cache = None,
+             integrator = 'quad', workers = None, surrogate_tol = 0.01,
+             posterior_grid = None, ul_rtol = None, profile = None):
     """Calculate an integral upper limit by direct integration.
 
   Description:
@@ -454,15 +1244,73 @@ def calc_int(like, srcName, cl=0.95, verbosity=0,
         \"results.poi_probs\". This parameter must be a vector, and can be
         empty.
 
+    cache -- a ProfileCache in which to keep the evaluations of the
+        profile likelihood, so that they can be reused by later calls to
+        calc_int or calc_chi2 with the same likelihood object and model.
+
+    integrator -- method used to integrate the likelihood function:
+        \"quad\" to use scipy.integrate.quad, which evaluates the
+        function at one point at a time, \"batch\" to use the same
+        adaptive Gauss-Kronrod rule but evaluate the function at all the
+        points of a batch of intervals at once, concurrently if
+        \"workers\" is given, or \"surrogate\" to integrate a surrogate
+        made from the approximate likelihood, in which the other
+        parameters are kept at their values at the peak, and a spline
+        correction through the points where the exact likelihood is
+        known. The exact likelihood is then only evaluated where it
+        matters for the limit, until the surrogate predicts it to within
+        surrogate_tol.
+
+    workers -- a ProfileWorkers pool of processes, each with its own
+        copy of the likelihood, used to evaluate the function with the
+        \"batch\" integrator.
+
+    surrogate_tol -- tolerance on the log likelihood predicted by the
+        surrogate at the points where the exact likelihood is evaluated.
+
+    posterior_grid -- grid on which to tabulate the posterior
+        distribution: the number of points evenly spaced between the
+        integration limits, or a vector of values of the normalization
+        parameter. The table is computed from the evaluations made by the
+        integrator, with no further evaluation of the likelihood, and
+        returned in \"results.posterior\" as arrays of the parameter
+        value, flux, probability density (normalized to one over the
+        integration limits) per unit parameter and per unit flux, and
+        cumulative probability.
+
+    ul_rtol -- required relative accuracy on the limit. If given, the
+        tolerances of the integrator and of the optimizer, the range of
+        integration (overriding delta_log_like_limits) and the number of
+        iterations of the search for it are chosen to reach it, and the
+        integration is refined (up to three times) while the estimated
+        error on the limit is larger. A loose value gives a cheap limit.
+        With a shared profile, the tolerance of the optimizer is that
+        of the profile.
+
+    profile -- a ProfileLikelihood of the source, shared with other
+        calls to calc_int or calc_chi2. If given, the global maximum,
+        frozen parameters and caches are taken from it, and the options
+        skip_global_opt, freeze_all, profile_optimizer and cache are
+        ignored. The model is left at the maximum of the profile rather
+        than put back in its original state.
+
   Outputs: (limit, results)
 
     limit -- the flux limit found.
 
     results -- a dictionary of additional results from the
         calculation, such as the value of the peak, the profile of the
-        likelihood and two profile-likelihood upper-limits.
+        likelihood and two profile-likelihood upper-limits. The entry
+        \"instrumentation\" holds the number and time of the exact
+        (optimized) and approximate evaluations of the likelihood, cache
+        hits, Brent iterations and integrand evaluations. The entry
+        \"ul_rerr\" is the estimated relative error on the limit, which
+        does not include the error from the tolerance of the optimizer.
   """  
-    saved_state = LikelihoodState(like)
+    if integrator not in ('quad', 'batch', 'surrogate'):
+        raise NameError("Unknown integrator: \""+integrator+"\"")
+
+    instrumentation = _start_instrumentation()
 
     ###########################################################################
     #
@@ -478,72 +1326,38 @@ def calc_int(like, srcName, cl=0.95, verbosity=0,
     #
     ###########################################################################
 
-    # Optimizer uses verbosity level one smaller than given here
-    optverbosity = max(verbosity-1, 0)
+    # Choose the tolerances from the required precision on the limit
+    tol = None
+    nloopmax = 5
+    if ul_rtol != None:
+        [rtol_epsrel, tol, delta_log_like_limits, nloopmax] = \
+                      _tolerances(cl, ul_rtol)
+        surrogate_tol = min(surrogate_tol, ul_rtol)
 
     ###########################################################################
     #
-    # 1) Find the global maximum of the likelihood function using ST
+    # 1) Find the global maximum of the likelihood function using ST,
+    #    unless it was found by the ProfileLikelihood given
     #
     ###########################################################################
 
-    par = like.normPar(srcName)
-
-    fitstat = None
-    if not skip_global_opt:
-        # Make sure desired parameter is free during global optimization
-        par.setFree(1)
-        like.syncSrcParams(srcName)
-
-        # Perform global optimization
-        if verbosity:
-            print "Finding global maximum"
-        try:
-            like.fit(optverbosity)
-            fitstat = like.optObject.getRetCode()
-            if verbosity and fitstat != 0:
-                print "Minimizer returned with non-zero code: ",fitstat
-        except RuntimeError:
-            print "Failed to find global maximum, results may be wrong"
-            pass
-        pass
-    
-    original_optimizer = like.optimizer
-    if profile_optimizer != None:
-        like.optimizer = profile_optimizer
-
-    # Store values of global fit
-    maxval = -like()
-    fitval = par.getValue()
-    fiterr = par.error()
-    limlo, limhi = par.getBounds()
-    if verbosity:
-        print "Maximum of %g with %s = %g +/- %g"\
-              %(-maxval,srcName,fitval,fiterr)
-
-    # Freeze all other model parameters if requested (much faster!)
-    if(freeze_all):
-        for i in range(len(like.model.params)):
-            like.model[i].setFree(0)
-            like.syncSrcParams(like[i].srcName)
-
-    # Freeze the parameter of interest
-    par.setFree(0)
-    like.syncSrcParams(srcName)
-
-    # Set up the caches for the optimum values and nuisance parameters
-    optvalue_cache = dict()
-    nuisance_cache = dict()
-    optvalue_cache[fitval] = maxval
-    _cache_nuisance(fitval, like, nuisance_cache)
-
-    # Test if all parameters are frozen (could be true if we froze
-    # them above or if they were frozen in the user's model
-    all_frozen = True
-    for i in range(len(like.model.params)):
-        if like.model[i].isFree():
-            all_frozen = False
-            break
+    if profile == None:
+        profile = ProfileLikelihood(like, srcName, verbosity, skip_global_opt,
+                                    freeze_all, profile_optimizer, cache,
+                                    tol)
+        shared_profile = False
+    else:
+        shared_profile = True
+
+    par = profile.par
+    fitstat = profile.fitstat
+    maxval = profile.maxval
+    fitval = profile.fitval
+    fiterr = profile.fiterr
+    limlo, limhi = profile.limlo, profile.limhi
+    all_frozen = profile.all_frozen
+    optvalue_cache = profile.optvalue_cache
+    nuisance_cache = profile.nuisance_cache
 
     ###########################################################################
     #
@@ -557,10 +1371,7 @@ def calc_int(like, srcName, cl=0.95, verbosity=0,
               %(delta_log_like_limits)
 
     [xlo, xhi, ylo, yhi, exact_root_evals, approx_root_evals] = \
-    _find_interval(like, par, srcName, all_frozen,
-                   maxval, fitval, limlo, limhi,
-                   delta_log_like_limits, verbosity, like.tol,
-                   False, 5, optvalue_cache, nuisance_cache)
+          profile.interval(delta_log_like_limits, False, nloopmax)
 
     if poi_values != None and len(poi_values)>0:
         xlo = max(min(xlo, min(poi_values)/2.0), limlo)
@@ -583,6 +1394,7 @@ def calc_int(like, srcName, cl=0.95, verbosity=0,
     #
     points = []
     epsrel = (1.0-cl)*1e-3
+    epsabs = 1
     if be_very_careful:
         # In "be very careful" mode we explicitly tell "quad" that it
         # should examine more carefully the point at x=fitval, which
@@ -590,96 +1402,147 @@ def calc_int(like, srcName, cl=0.95, verbosity=0,
         # tolerance value, but that seems to have a secondary effect.
         points = [ fitval ]
         epsrel = (1.0-cl)*1e-8
+    if ul_rtol != None:
+        # The absolute tolerance would otherwise stop the integration
+        # of a function whose integral is of order one
+        epsrel = rtol_epsrel
+        epsabs = 0
 
     if verbosity:
         print "Integrating probability distribution"
 
-    nfneval = -len(optvalue_cache)
+    # In precision mode the integration is repeated with a tighter
+    # tolerance until the estimated error on the limit is small enough.
+    # The evaluations already made are reused through the caches.
     f_of_x = dict()
-    quad_ival, quad_ierr = \
-          scipy.integrate.quad(_integrand, xlo, xhi,\
-                               args = (f_of_x, like, par, srcName, maxval,\
-                                       verbosity, all_frozen,
-                                       optvalue_cache, nuisance_cache),\
-                               points=points, epsrel=epsrel, epsabs=1)
-    nfneval += len(optvalue_cache)
-
-    if verbosity:
-        print "Total integral: %g +/- %g (%d fcn evals)"\
-              %(quad_ival,quad_ierr,nfneval)
-
-    ###########################################################################
-    #
-    # 4) Calculate the upper limit by re-integrating the function using
-    #    the evaluations made by the adaptive integrator. Two schemes are
-    #    tried, splines to the function points and trapezoidal quadrature.
-    #
-    ###########################################################################
+    nrefine = 0
+    while True:
+        nfneval = -len(optvalue_cache)
+        _count('integrate_time', -time.time())
+        if integrator == 'batch':
+            quad_ival, quad_ierr = \
+                  _batch_integrate(xlo, xhi, f_of_x, like, par, srcName, maxval,
+                                   verbosity, all_frozen,
+                                   optvalue_cache, nuisance_cache,
+                                   epsrel, epsabs, points, workers)
+        elif integrator == 'surrogate':
+            quad_ival, quad_ierr = \
+                  _surrogate_integrate(xlo, xhi, fitval, f_of_x, like, par,
+                                       srcName, maxval, verbosity, all_frozen,
+                                       optvalue_cache, nuisance_cache, cl,
+                                       surrogate_tol)
+        else:
+            quad_ival, quad_ierr = \
+                  scipy.integrate.quad(_integrand, xlo, xhi,\
+                                       args = (f_of_x, like, par, srcName,\
+                                               maxval, verbosity, all_frozen,
+                                               optvalue_cache, nuisance_cache),\
+                                       points=points, epsrel=epsrel,
+                                       epsabs=epsabs)
+        _count('integrate_time', time.time())
+        nfneval += len(optvalue_cache)
 
-    # Calculation of the upper limit requires integrating up to
-    # various test points, and finding the one that contains the
-    # prescribed fraction of the probability. Using the "quad"
-    # function to do this by evaluating the likelihood function
-    # directly would be computationally prohibitive, it is preferable
-    # to use the function evaluations that have been saved in the
-    # "f_of_x" variable.
-
-    # We try 2 different integration approaches on this data:
-    # trapezoidal quadrature and integration of a fitted spline, with
-    # the expectation that the spline will be better, but that perhaps
-    # the trapezoidal might be more robust if the spline fit goes
-    # crazy. The method whose results are closest to those from "quad"
-    # is picked to do the search.
-    
-    # Organize values computed into two vectors x & y
-    x = f_of_x.keys()
-    x.sort()
-    y=[]
-    logy=[]
-    for xi in x:
-        y.append(f_of_x[xi])
-        logy.append(math.log(f_of_x[xi]))
-
-    # Evaluate upper limit using trapezoidal rule
-    trapz_ival = scipy.integrate.trapz(y,x)
-    cint = 0
-    Cint = [ 0 ]
-    for i in range(len(x)-1):
-        cint += 0.5*(f_of_x[x[i+1]]+f_of_x[x[i]])*(x[i+1]-x[i])
-        Cint.append(cint)
-    int_irep = scipy.interpolate.interp1d(x, Cint)
-    xlim_trapz = scipy.optimize.brentq(_int1droot, x[0], x[-1],
-                                       args = (cl*cint, int_irep))
-    ylim_trapz = int_irep(xlim_trapz).item()/cint
-
-    # Evaluate upper limit using spline
-    spl_irep = scipy.interpolate.splrep(x,y,xb=xlo,xe=xhi)
-    spl_ival = scipy.interpolate.splint(xlo,xhi,spl_irep)
-    xlim_spl = scipy.optimize.brentq(_splintroot, xlo, xhi, 
-                                     args = (cl*spl_ival, xlo, spl_irep))
-    ylim_spl = scipy.interpolate.splint(xlo,xlim_spl,spl_irep)/spl_ival
-
-    # Test which is closest to QUADPACK adaptive method: TRAPZ or SPLINE
-    if abs(spl_ival - quad_ival) < abs(trapz_ival - quad_ival):
-        # Evaluate upper limit using spline
         if verbosity:
-            print "Using spline integral: %g (delta=%g)"\
-                  %(spl_ival,abs(spl_ival/quad_ival-1))
-        xlim = xlim_spl
-        ylim = ylim_spl
-        if verbosity:
-            print "Spline search: %g (P=%g)"%(xlim,ylim)
-    else:
-        # Evaluate upper limit using trapezoidal rule
-        if verbosity:
-            print "Using trapezoidal integral: %g (delta=%g)"\
-                  %(trapz_ival,abs(trapz_ival/quad_ival-1))
-        xlim = xlim_trapz
-        ylim = ylim_trapz
+            print "Total integral: %g +/- %g (%d fcn evals)"\
+                  %(quad_ival,quad_ierr,nfneval)
+
+        #######################################################################
+        #
+        # 4) Calculate the upper limit by re-integrating the function using
+        #    the evaluations made by the adaptive integrator. Two schemes are
+        #    tried, splines to the function points and trapezoidal quadrature.
+        #
+        #######################################################################
+
+        # Calculation of the upper limit requires integrating up to
+        # various test points, and finding the one that contains the
+        # prescribed fraction of the probability. Using the "quad"
+        # function to do this by evaluating the likelihood function
+        # directly would be computationally prohibitive, it is preferable
+        # to use the function evaluations that have been saved in the
+        # "f_of_x" variable.
+
+        # We try 2 different integration approaches on this data:
+        # trapezoidal quadrature and integration of a fitted spline, with
+        # the expectation that the spline will be better, but that perhaps
+        # the trapezoidal might be more robust if the spline fit goes
+        # crazy. The method whose results are closest to those from "quad"
+        # is picked to do the search.
+        
+        # Organize values computed into two vectors x & y
+        x = f_of_x.keys()
+        x.sort()
+        X = numpy.array(x)
+        Y = numpy.array(map(lambda xi: f_of_x[xi], x))
+        logY = numpy.log(Y)
+
+        # Evaluate upper limit using trapezoidal rule. The cumulative
+        # integral is piecewise linear in x, so it can be inverted by
+        # interpolating x as a function of the cumulative integral
+        Cint = numpy.zeros(len(X))
+        Cint[1:] = numpy.cumsum(0.5*(Y[1:]+Y[:-1])*numpy.diff(X))
+        cint = Cint[-1]
+        trapz_ival = cint
+        xlim_trapz = numpy.interp(cl*cint, Cint, X)
+        ylim_trapz = numpy.interp(xlim_trapz, X, Cint)/cint
+
+        # Evaluate upper limit using spline, through its antiderivative
+        spl_irep = scipy.interpolate.splrep(X,Y,xb=xlo,xe=xhi)
+        spl_arep = scipy.interpolate.splantider(spl_irep)
+        spl_alo = scipy.interpolate.splev(xlo, spl_arep)
+        spl_ival = scipy.interpolate.splev(xhi, spl_arep) - spl_alo
+        xlim_spl = _spline_root(_grid(X, xlo, xhi), spl_arep,
+                                spl_alo + cl*spl_ival)
+        ylim_spl = \
+            (scipy.interpolate.splev(xlim_spl, spl_arep)-spl_alo)/spl_ival
+
+        # Test which is closest to QUADPACK adaptive method: TRAPZ or SPLINE
+        use_spline = abs(spl_ival - quad_ival) < abs(trapz_ival - quad_ival)
+        if use_spline:
+            # Evaluate upper limit using spline
+            if verbosity:
+                print "Using spline integral: %g (delta=%g)"\
+                      %(spl_ival,abs(spl_ival/quad_ival-1))
+            xlim = xlim_spl
+            ylim = ylim_spl
+            if verbosity:
+                print "Spline search: %g (P=%g)"%(xlim,ylim)
+        else:
+            # Evaluate upper limit using trapezoidal rule
+            if verbosity:
+                print "Using trapezoidal integral: %g (delta=%g)"\
+                      %(trapz_ival,abs(trapz_ival/quad_ival-1))
+            xlim = xlim_trapz
+            ylim = ylim_trapz
+            if verbosity:
+                print "Trapezoidal search: %g (P=%g)"%(xlim,cl)
+
+        # Estimate the relative error on the limit from the error on the
+        # probability beyond it: that of the integral, the difference
+        # between the integral used and that of QUADPACK, and the
+        # probability outside of the integration limits
+        pdf_lim = _distribution(numpy.array([xlim]), xlo, xhi, X, Y, Cint,
+                                spl_irep, spl_arep, use_spline)[0][0]
+        if use_spline:
+            ival = spl_ival
+        else:
+            ival = trapz_ival
+        perr = (abs(quad_ierr) + abs(ival-quad_ival))/quad_ival + \
+               math.exp(-delta_log_like_limits)
+        if pdf_lim > 0:
+            ul_rerr = perr/(pdf_lim*xlim)
+        else:
+            ul_rerr = float('inf')
         if verbosity:
-            print "Trapezoidal search: %g (P=%g)"%(xlim,cl)
+            print "Estimated relative error on limit: %g"%(ul_rerr)
 
-    like.optimizer = original_optimizer
+        if ul_rtol == None or ul_rerr <= ul_rtol or nrefine >= 3:
+            break
+        nrefine += 1
+        epsrel *= 0.1
+        surrogate_tol *= 0.1
+        if verbosity:
+            print "Refining integral with epsrel=%g"%(epsrel)
 
     ###########################################################################
     #
@@ -698,17 +1561,15 @@ def calc_int(like, srcName, cl=0.95, verbosity=0,
     # especially in "be_very_careful" mode, so fall back to a linear
     # interpolation if necessary
 
-    spl_drep = scipy.interpolate.splrep(x,logy,xb=xlo,xe=xhi)
-    spl_pflux1 = scipy.optimize.brentq(_splevroot, fitval, xhi, 
-                                       args = (profile_dlogL1, spl_drep))
-    spl_pflux2 = scipy.optimize.brentq(_splevroot, fitval, xhi, 
-                                       args = (profile_dlogL2, spl_drep))
+    spl_drep = scipy.interpolate.splrep(X,logY,xb=xlo,xe=xhi)
+    spl_grid = _grid(X, fitval, xhi)
+    spl_pflux1 = _spline_root(spl_grid, spl_drep, profile_dlogL1)
+    spl_pflux2 = _spline_root(spl_grid, spl_drep, profile_dlogL2)
 
-    int_drep = scipy.interpolate.interp1d(x,logy)
-    int_pflux1 = scipy.optimize.brentq(_int1droot, max(min(x),fitval), max(x), 
-                                       args = (profile_dlogL1, int_drep))
-    int_pflux2 = scipy.optimize.brentq(_int1droot, max(min(x),fitval), max(x), 
-                                       args = (profile_dlogL2, int_drep))
+    int_grid = _grid(X, max(X[0],fitval), X[-1])
+    int_dlogL = numpy.interp(int_grid, X, logY)
+    int_pflux1 = _linear_root(int_grid, int_dlogL, profile_dlogL1)
+    int_pflux2 = _linear_root(int_grid, int_dlogL, profile_dlogL2)
 
     if (2.0*abs(int_pflux1-spl_pflux1)/abs(int_pflux1+spl_pflux1) > 0.05 or \
         2.0*abs(int_pflux2-spl_pflux2)/abs(int_pflux2+spl_pflux2) > 0.05):
@@ -728,26 +1589,29 @@ def calc_int(like, srcName, cl=0.95, verbosity=0,
     #
     ###########################################################################
 
-    poi_probs = [];
-    poi_dlogL_interp = [];
-    poi_chi2_equiv = [];
-
-    for xval in poi_values:
-        dLogL = None
-        if(xval >= xhi):
-            pval = 1.0
-        elif(xval <= xlo):
-            pval = 0.0
-        # Same test as above to decide between TRAPZ and SPLINE
-        elif abs(spl_ival - quad_ival) < abs(trapz_ival - quad_ival):
-            pval = scipy.interpolate.splint(xlo,xval,spl_irep)/spl_ival
-            dlogL = scipy.interpolate.splev(xval, spl_drep)
+    # All points are evaluated at once, on the same representation
+    # (TRAPZ or SPLINE) as was used for the upper limit. The profile
+    # is not extrapolated, so points outside [xlo,xhi] have no dlogL
+
+    P = numpy.array(poi_values, dtype=float)
+    pval = _distribution(P, xlo, xhi, X, Y, Cint, spl_irep, spl_arep,
+                         use_spline)[1]
+    if len(P) == 0:
+        dlogL = numpy.zeros(0)
+    elif use_spline:
+        dlogL = scipy.interpolate.splev(P, spl_drep)
+    else:
+        dlogL = numpy.interp(P, X, logY)
+    inside = numpy.logical_and(P>xlo, P<xhi)
+
+    poi_probs = map(float, pval)
+    poi_dlogL_interp = []
+    for i in range(len(P)):
+        if inside[i]:
+            poi_dlogL_interp.append(float(dlogL[i]))
         else:
-            pval = int_irep(xval).item()/cint
-            dlogL = int_drep(xval).item()                
-        poi_probs.append(pval)
-        poi_dlogL_interp.append(dlogL)
-        poi_chi2_equiv.append(scipy.stats.chi2.isf(1-pval,1))
+            poi_dlogL_interp.append(None)
+    poi_chi2_equiv = map(float, scipy.stats.chi2.isf(1-pval,1))
 
     ###########################################################################
     #        
@@ -755,13 +1619,37 @@ def calc_int(like, srcName, cl=0.95, verbosity=0,
     #
     ###########################################################################
     
-    # Set the parameter value that corresponds to the desired C.L.
-    par.setValue(xlim)
+    # Evaluate the flux corresponding to the desired C.L.
+    ul_flux = profile.flux(xlim, emin, emax)
 
-    # Evaluate the flux corresponding to this upper limit.
-    ul_flux = like[srcName].flux(emin, emax)
+    if shared_profile:
+        profile.reset()
+    else:
+        profile.restore()
 
-    saved_state.restore()
+    ###########################################################################
+    #
+    # Tabulate the posterior distribution on the requested grid, from the
+    # same representation of the function. The flux is proportional to
+    # the normalization parameter, so the flux at the upper limit gives
+    # the conversion to flux units.
+    #
+    ###########################################################################
+
+    posterior = None
+    if posterior_grid != None:
+        if type(posterior_grid) == int:
+            G = numpy.linspace(xlo, xhi, posterior_grid)
+        else:
+            G = numpy.array(posterior_grid, dtype=float)
+        pdf, cdf = _distribution(G, xlo, xhi, X, Y, Cint, spl_irep, spl_arep,
+                                 use_spline)
+        flux_per_value = ul_flux/xlim
+        posterior = dict(value    = G,
+                         flux     = G*flux_per_value,
+                         pdf      = pdf,
+                         pdf_flux = pdf/flux_per_value,
+                         cdf      = cdf)
 
     # Pack up all the results
     results = dict(all_frozen       = all_frozen,
@@ -772,7 +1660,7 @@ def calc_int(like, srcName, cl=0.95, verbosity=0,
                    ul_spl           = xlim_spl,
                    int_limits       = [xlo, xhi],
                    profile_x        = x,
-                   profile_y        = y,
+                   profile_y        = list(Y),
                    peak_fitstatus   = fitstat,
                    peak_value       = fitval,
                    peak_dvalue      = fiterr,
@@ -787,14 +1675,20 @@ def calc_int(like, srcName, cl=0.95, verbosity=0,
                    poi_probs        = poi_probs,
                    poi_dlogL_interp = poi_dlogL_interp,
                    poi_chi2_equiv   = poi_chi2_equiv,
+                   posterior        = posterior,
+                   ul_rtol          = ul_rtol,
+                   ul_rerr          = ul_rerr,
+                   ul_nrefine       = nrefine,
                    flux_emin        = emin,
-                   flux_emax        = emax)
+                   flux_emax        = emax,
+                   instrumentation  = _stop_instrumentation(instrumentation))
 
     return ul_flux, results
 
 def calc_chi2(like, srcName, cl=0.95, verbosity=0,
               skip_global_opt=False, freeze_all=False,
-              profile_optimizer = None, emin=100, emax=3e5, poi_values = []):
+              profile_optimizer = None, emin=100, emax=3e5, poi_values = [],
+              cache = None, profile = None):
     """Calculate an integral upper limit by the profile likelihood (chi2) method.
 
   Description:
@@ -850,15 +1744,24 @@ def calc_chi2(like, srcName, cl=0.95, verbosity=0,
         \"results.poi_probs\". This parameter must be a vector, and can be
         empty.
 
+    cache -- a ProfileCache in which to keep the evaluations of the
+        profile likelihood, so that they can be reused by later calls to
+        calc_int or calc_chi2 with the same likelihood object and model.
+
+    profile -- a ProfileLikelihood of the source, shared with other
+        calls, as for calc_int.
+
   Outputs: (limit, results)
 
     limit -- the flux limit found.
 
     results -- a dictionary of additional results from the calculation,
-        such as the value of the peak value etc.
+        such as the value of the peak value etc. The entry
+        \"instrumentation\" holds counters and timers of the
+        evaluations made, as for calc_int.
   """
 
-    saved_state = LikelihoodState(like)
+    instrumentation = _start_instrumentation()
 
     ###########################################################################
     #
@@ -869,72 +1772,29 @@ def calc_chi2(like, srcName, cl=0.95, verbosity=0,
     #
     ###########################################################################
 
-    # Optimizer uses verbosity level one smaller than given here
-    optverbosity = max(verbosity-1, 0)
-
     ###########################################################################
     #
-    # 1) Find the global maximum of the likelihood function using ST
+    # 1) Find the global maximum of the likelihood function using ST,
+    #    unless it was found by the ProfileLikelihood given
     #
     ###########################################################################
 
-    par = like.normPar(srcName)
-
-    fitstat = None
-    if not skip_global_opt:
-        # Make sure desired parameter is free during global optimization
-        par.setFree(1)
-        like.syncSrcParams(srcName)
-
-        # Perform global optimization
-        if verbosity:
-            print "Finding global maximum"
-        try:
-            like.fit(optverbosity)
-            fitstat = like.optObject.getRetCode()
-            if verbosity and fitstat != 0:
-                print "Minimizer returned with non-zero code: ",fitstat
-        except RuntimeError:
-            print "Failed to find global maximum, results may be wrong"
-            pass
-        pass
-    
-    original_optimizer = like.optimizer
-    if profile_optimizer != None:
-        like.optimizer = profile_optimizer
-
-    # Store values of global fit
-    maxval = -like()
-    fitval = par.getValue()
-    fiterr = par.error()
-    limlo, limhi = par.getBounds()
-    if verbosity:
-        print "Maximum of %g with %s = %g +/- %g"\
-              %(-maxval,srcName,fitval,fiterr)
-
-    # Freeze all other model parameters if requested (much faster!)
-    if(freeze_all):
-        for i in range(len(like.model.params)):
-            like.model[i].setFree(0)
-            like.syncSrcParams(like[i].srcName)
-
-    # Freeze the parameter of interest
-    par.setFree(0)
-    like.syncSrcParams(srcName)
-
-    # Set up the caches for the optimum values and nuisance parameters
-    optvalue_cache = dict()
-    nuisance_cache = dict()
-    optvalue_cache[fitval] = maxval
-    _cache_nuisance(fitval, like, nuisance_cache)
-
-    # Test if all parameters are frozen (could be true if we froze
-    # them above or if they were frozen in the user's model
-    all_frozen = True
-    for i in range(len(like.model.params)):
-        if like.model[i].isFree():
-            all_frozen = False
-            break
+    if profile == None:
+        profile = ProfileLikelihood(like, srcName, verbosity, skip_global_opt,
+                                    freeze_all, profile_optimizer, cache)
+        shared_profile = False
+    else:
+        shared_profile = True
+
+    par = profile.par
+    fitstat = profile.fitstat
+    maxval = profile.maxval
+    fitval = profile.fitval
+    fiterr = profile.fiterr
+    limlo, limhi = profile.limlo, profile.limhi
+    all_frozen = profile.all_frozen
+    optvalue_cache = profile.optvalue_cache
+    nuisance_cache = profile.nuisance_cache
 
     ###########################################################################
     #
@@ -950,10 +1810,7 @@ def calc_chi2(like, srcName, cl=0.95, verbosity=0,
               %(delta_log_like)
 
     [xunused, xlim, yunused, ylim, exact_root_evals, approx_root_evals] = \
-    _find_interval(like, par, srcName, all_frozen,
-                   maxval, fitval, limlo, limhi,
-                   delta_log_like, verbosity, like.tol,
-                   True, 5, optvalue_cache, nuisance_cache)
+          profile.interval(delta_log_like, True)
 
     if verbosity:
         print "Limit: %g (%d full fcn evals and %d approx)"\
@@ -975,8 +1832,7 @@ def calc_chi2(like, srcName, cl=0.95, verbosity=0,
             dlogL = None
             pval = 0.0
         else:
-            dlogL = _loglike(xval, like, par, srcName, maxval, verbosity,
-                             all_frozen, optvalue_cache, nuisance_cache)
+            dlogL = profile.loglike(xval)
             if(xval<fitval):
                 pval = 0.5*(1-scipy.stats.chi2.cdf(-2*dlogL,1))
             else:
@@ -986,8 +1842,6 @@ def calc_chi2(like, srcName, cl=0.95, verbosity=0,
 
         poi_probs.append(pval)
         poi_dlogL.append(dlogL)
-    
-    like.optimizer = original_optimizer
 
     ###########################################################################
     #        
@@ -995,13 +1849,13 @@ def calc_chi2(like, srcName, cl=0.95, verbosity=0,
     #
     ###########################################################################
     
-    # Set the parameter value that corresponds to the desired C.L.
-    par.setValue(xlim)
-
-    # Evaluate the flux corresponding to this upper limit.
-    ul_flux = like[srcName].flux(emin, emax)
+    # Evaluate the flux corresponding to the desired C.L.
+    ul_flux = profile.flux(xlim, emin, emax)
 
-    saved_state.restore()
+    if shared_profile:
+        profile.reset()
+    else:
+        profile.restore()
 
     # Pack up all the results
     results = dict(all_frozen     = all_frozen,
@@ -1018,11 +1872,117 @@ def calc_chi2(like, srcName, cl=0.95, verbosity=0,
                    poi_probs      = poi_probs,
                    poi_dlogL      = poi_dlogL,
                    flux_emin      = emin,
-                   flux_emax      = emax)
+                   flux_emax      = emax,
+                   instrumentation = _stop_instrumentation(instrumentation))
 
     return ul_flux, results
     
 
+def calc_many(like, srcNames, method='bayesian', cl=0.95, verbosity=0,
+              skip_global_opt=False, cache=None, workers=None, **kwargs):
+    """Calculate upper limits for many sources in one likelihood.
+
+  Description:
+
+    Calculate upper limits for each of the sources in a list, by the
+    Bayesian (calc_int) or profile likelihood (calc_chi2) method. The
+    global maximum of the likelihood, with the normalizations of all
+    the sources free, is found only once, and the calculation for each
+    source starts from it.
+
+  Inputs:
+
+    like -- a binned or unbinned likelihood object which has the
+        desired model.
+
+    srcNames -- the list of the names of the sources for which to
+        compute limits.
+
+    method -- \"bayesian\" to use calc_int or \"chi2\" to use calc_chi2.
+
+    cl, verbosity -- as for calc_int and calc_chi2.
+
+    skip_global_opt -- if the model is already at the global minimum,
+        with the normalizations of all the sources free, skip the step
+        to find it.
+
+    cache -- a ProfileCache shared by the calculations, by default a new
+        one. Passing the same cache to later calls (for example with a
+        different cl) allows them to reuse the evaluations made here.
+
+    workers -- a ProfileWorkers pool; if given the limits of the
+        sources are calculated concurrently by the worker processes,
+        each with its own copy of the likelihood and of the cache.
+
+    Other keyword arguments are passed to calc_int or calc_chi2.
+
+  Outputs: results
+
+    results -- a dictionary, indexed by source name, of the (limit,
+        results) pairs returned by calc_int or calc_chi2.
+  """
+    if method not in ('bayesian', 'chi2'):
+        raise NameError("Unknown upper limit method: \""+method+"\"")
+
+    saved_state = LikelihoodState(like)
+
+    # Optimizer uses verbosity level one smaller than given here
+    optverbosity = max(verbosity-1, 0)
+
+    fitstat = None
+    if not skip_global_opt:
+        # Make sure the normalizations are free during global optimization
+        for srcName in srcNames:
+            like.normPar(srcName).setFree(1)
+            like.syncSrcParams(srcName)
+
+        # Perform global optimization
+        if verbosity:
+            print "Finding global maximum"
+        try:
+            like.fit(optverbosity)
+            fitstat = like.optObject.getRetCode()
+            if verbosity and fitstat != 0:
+                print "Minimizer returned with non-zero code: ",fitstat
+        except RuntimeError:
+            print "Failed to find global maximum, results may be wrong"
+            pass
+        pass
+
+    results = dict()
+    if workers != None:
+        state = _param_state(like)
+        tasks = map(lambda srcName: [state, like.optimizer, like.tol,
+                                     method, srcName,
+                                     dict(kwargs, cl=cl,
+                                          verbosity=verbosity)],
+                    srcNames)
+        limits = workers.limits(tasks)
+        for isrc in range(len(srcNames)):
+            results[srcNames[isrc]] = limits[isrc]
+    else:
+        if cache == None:
+            cache = ProfileCache()
+        global_state = LikelihoodState(like)
+        for srcName in srcNames:
+            if verbosity:
+                print "Calculating limit for:",srcName
+            global_state.restore()
+            if method == 'bayesian':
+                results[srcName] = \
+                    calc_int(like, srcName, cl=cl, verbosity=verbosity,
+                             skip_global_opt=True, cache=cache, **kwargs)
+            else:
+                results[srcName] = \
+                    calc_chi2(like, srcName, cl=cl, verbosity=verbosity,
+                              skip_global_opt=True, cache=cache, **kwargs)
+
+    for srcName in srcNames:
+        results[srcName][1]['peak_fitstatus'] = fitstat
+
+    saved_state.restore()
+    return results
+
 if __name__ == "__main__":
     import sys
 
@@ -16,14 +16,21 @@ import glob
 import os.path
 import math
 import copy
+import time
 import pickle
+import collections
+import multiprocessing
+import numpy
 import scipy.stats
+import scipy.special
 import sys
 import UnbinnedAnalysis
 import BinnedAnalysis
 import SummedLikelihood
 #import BinnedLikelihood
 import IntegralUpperLimit
+import ResultCheckpoint
+import ComponentCache
 
 class MyMath:
     _def_itmax  = 100
@@ -205,12 +212,342 @@ class MyMath:
     def chi2invc(p, a):
         return 2.0*MyMath.gammainvc(p, 0.5*a)    
 
+def chi2cdfc(x, ndof):
+    """Return the probability that a chi-squared variable with ndof
+    degrees of freedom is larger than x, Pr(>x). Both arguments can be
+    arrays (they are broadcast against each other), so that the
+    probabilities of many bins, sources or windows can be calculated at
+    once. Equivalent to MyMath.chi2cdfc for x>0."""
+    return scipy.special.gammaincc(0.5*numpy.asarray(ndof, dtype=float),
+                                   0.5*numpy.asarray(x, dtype=float))
+
+def chi2invc(p, ndof):
+    """Return the value which a chi-squared variable with ndof degrees
+    of freedom exceeds with probability p, i.e. the inverse of
+    chi2cdfc. Both arguments can be arrays. Equivalent to
+    MyMath.chi2invc for 0<p<1."""
+    return 2.0*scipy.special.gammainccinv(0.5*numpy.asarray(ndof, dtype=float),
+                                          numpy.asarray(p, dtype=float))
+
+def chi2sigma(x, ndof):
+    """Return the probability Pr(>x) of a chi-squared variable with ndof
+    degrees of freedom and the equivalent (two sided) Gaussian
+    significance. Both arguments can be arrays."""
+    prob = chi2cdfc(x, ndof)
+    return prob, numpy.sqrt(chi2invc(prob, 1))
+
+def checkChi2AgainstMyMath(x = None, ndof = None):
+    """Regression check of the vectorized chi2cdfc and chi2invc against
+    the scalar MyMath versions, over a grid of values of x and numbers of
+    degrees of freedom. The inverse is only checked for one degree of
+    freedom, as used in writeLC, since the MyMath inverse does not
+    converge over the full grid for more. Returns the largest relative
+    differences found in the probabilities and in the inverted values."""
+    if x is None:
+        x = numpy.logspace(-2, 3, 51)
+    if ndof is None:
+        ndof = numpy.array([1, 2, 3, 5, 10, 30, 100, 300])
+    X, N = numpy.meshgrid(x, ndof)
+    P = chi2cdfc(X, N)
+    Pref = numpy.vectorize(MyMath.chi2cdfc)(X, N)
+    dP = abs(P/Pref-1)
+    # Only invert probabilities that can be represented away from unity
+    P = P[(P > 1e-300) & (P < 1-1e-10)]
+    Xinv = chi2invc(P, 1)
+    Xref = numpy.vectorize(MyMath.chi2invc)(P, 1)
+    dX = abs(Xinv/Xref-1)
+    return dP.max(), dX.max()
+
+def _processObsWorker(lc, f, kwargs, checkpoint=None, key=None):
+    """Internal function run by the worker processes of
+    LightCurve.processAllObs to process one time bin. Not intended for
+    use outside of this package."""
+    result = lc.processObsMulti(f, **kwargs)
+    if checkpoint != None:
+        checkpoint.save(key, result)
+    return result
+
+def _firstPassWorker(lc, f, kwargs):
+    """Internal function run by the worker processes of
+    LightCurve.adaptiveBinning to run the first pass in one time bin.
+    Not intended for use outside of this package."""
+    return lc.processObs(f, profile_only=True, **kwargs)
+
+def _lcNuisanceSeed(lc):
+    """Internal function which returns the background parameters found
+    in the first fit of a time bin, or None if they were not recorded.
+    Not intended for use outside of this package."""
+    if lc.has_key('allfixed') and lc['allfixed'].has_key('nuisance'):
+        return lc['allfixed']['nuisance']
+    return None
+
+def _lcNuisanceSeeds(result):
+    """Internal function which returns the background parameters found
+    in the first fit of a time bin for each source, from the dictionary
+    of results indexed by source name. Not intended for use outside of
+    this package."""
+    seeds = dict()
+    for srcName in result.keys():
+        seeds[srcName] = _lcNuisanceSeed(result[srcName])
+    return seeds
+
+def lcSourceFilename(filename, srcName):
+    """Return the name of the file in which to write the results for one
+    of the sources of a multi-source light curve, formed by adding the
+    source name to the given filename before its extension."""
+    [ base, ext ] = os.path.splitext(filename)
+    return base + '_' + srcName.replace(' ','_') + ext
+
+# Scalar per-bin results stored in the columnar format, as (column name,
+# path in the dictionary of results for the bin)
+_lc_scalar_columns = [
+    ('t_min',                       ('t_min',)),
+    ('t_max',                       ('t_max',)),
+    ('e_min',                       ('e_min',)),
+    ('e_max',                       ('e_max',)),
+    ('original_normpar_init_value', ('original','normpar_init_value')),
+    ('original_nfree',              ('original','nfree')),
+    ('original_flux',               ('original','flux')),
+    ('original_logL',               ('original','logL')),
+    ('allfixed_logL',               ('allfixed','logL')),
+    ('allfixed_fitstat',            ('allfixed','fitstat')),
+    ('allfixed_flux',               ('allfixed','flux')),
+    ('allfixed_fit_time',           ('allfixed','fit_time')),
+    ('allfixed_nseeded',            ('allfixed','nseeded')),
+    ('normfree_logL',               ('normfree','logL')),
+    ('normfree_fitstat',            ('normfree','fitstat')),
+    ('normfree_ts',                 ('normfree','ts')),
+    ('normfree_flux',               ('normfree','flux')),
+    ('normfree_flux_dflux',         ('normfree','flux_dflux')),
+    ('normfree_nfree',              ('normfree','nfree')),
+    ('normfree_ul_flux',            ('normfree','ul','flux')),
+    ('normfree_ul_exact_calls',     ('normfree','ul','results',
+                                     'instrumentation','exact_calls')),
+    ('normfree_ul_total_time',      ('normfree','ul','results',
+                                     'instrumentation','total_time')),
+    ('allfree_logL',                ('allfree','logL')),
+    ('allfree_fitstat',             ('allfree','fitstat')),
+    ('allfree_ts',                  ('allfree','ts')),
+    ('allfree_flux',                ('allfree','flux')),
+    ('allfree_nfree',               ('allfree','nfree')) ]
+
+# String per-bin results stored in the columnar format
+_lc_string_columns = [
+    ('original_normpar_name',       ('original','normpar_name')),
+    ('normfree_ul_type',            ('normfree','ul','type')) ]
+
+# Profile vectors stored in the columnar format, padded with NaN
+_lc_profile_columns = [
+    ('profile_sigma',               ('profile','sigma')),
+    ('profile_value',               ('profile','value')),
+    ('profile_logL',                ('profile','logL')),
+    ('profile_flux',                ('profile','flux')),
+    ('normfree_ul_poi_chi2_equiv',  ('normfree','ul','results',
+                                     'poi_chi2_equiv')) ]
+
+def _lcLookup(lc, path, default=None):
+    """Internal function which returns the entry of the results
+    dictionary at the given path, or the default value if it is not
+    present. Not intended for use outside of this package."""
+    for k in path:
+        if type(lc) != dict or not lc.has_key(k):
+            return default
+        lc = lc[k]
+    if lc == None:
+        return default
+    return lc
+
+def _quadFit(X, Y):
+    """Internal function which fits a quadratic to each row of Y as a
+    function of the same row of X, ignoring points where either is NaN,
+    by solving all the normal equations at once. Returns an array of
+    coefficients, one row per row of X, lowest order first. Rows with
+    fewer than three distinct points, which do not determine a
+    quadratic, get NaN coefficients. Not intended for use outside of
+    this package."""
+    W = numpy.isfinite(X) & numpy.isfinite(Y)
+    X = numpy.where(W, X, 0)
+    Y = numpy.where(W, Y, 0)
+    S = numpy.array(map(lambda k: (W*X**k).sum(axis=1), range(5)))
+    T = numpy.array(map(lambda k: (W*X**k*Y).sum(axis=1), range(3)))
+    A = numpy.array([ [ S[0], S[1], S[2] ],
+                      [ S[1], S[2], S[3] ],
+                      [ S[2], S[3], S[4] ] ]).transpose(2,0,1)
+    Xs = numpy.sort(numpy.where(W, X, numpy.nan), axis=1)
+    ndistinct = W.any(axis=1) + (numpy.diff(Xs, axis=1) > 0).sum(axis=1)
+    good = (W.sum(axis=1) >= 3) & (ndistinct >= 3)
+    good[good] = numpy.linalg.det(A[good]) != 0
+    C = numpy.empty((X.shape[0], 3))
+    C[:] = numpy.nan
+    if good.any():
+        B = T.transpose()[good,:,numpy.newaxis]
+        C[good] = numpy.linalg.solve(A[good], B)[:,:,0]
+    return C
+
+def _quadEval(C, X):
+    """Internal function which evaluates the quadratics fitted by
+    _quadFit at X (broadcast against the rows of coefficients). Not
+    intended for use outside of this package."""
+    X = numpy.atleast_2d(X)
+    return C[:,0:1] + C[:,1:2]*X + C[:,2:3]*X**2
+
+def _quadBlockMax(B, umin):
+    """Internal function which returns the maximum, for u>=umin, of each
+    of the quadratics whose coefficients (lowest order first) are given
+    in the rows of B. Not intended for use outside of this package."""
+    c2 = numpy.where(B[:,2] < 0, B[:,2], -1.0)
+    u = numpy.where(B[:,2] < 0, -B[:,1]/(2*c2), umin)
+    u = numpy.maximum(u, umin)
+    return B[:,0] + B[:,1]*u + B[:,2]*u**2
+
+def bayesianBlocks(C, ncp_prior, umin=0.0):
+    """Find the optimal partition of a sequence of bins into blocks of
+    constant flux using the Bayesian blocks algorithm of Scargle et al.
+    (2013, ApJ 764, 167). The log likelihood of each bin as a function
+    of the flux variable u is the quadratic with coefficients (lowest
+    order first) given in the rows of C, and the fitness of a block is
+    the maximum, for u>=umin, of the sum of the quadratics of its bins.
+    ncp_prior is the penalty for each block. Returns the list of
+    blocks, each given by the index of its first bin and one past its
+    last bin."""
+    N = len(C)
+    S = numpy.zeros((N+1, 3))
+    S[1:] = numpy.cumsum(C, axis=0)
+    best = numpy.zeros(N)
+    last = numpy.zeros(N, dtype=int)
+    for r in range(N):
+        A = _quadBlockMax(S[r+1] - S[0:r+1], umin) - ncp_prior
+        A[1:] += best[0:r]
+        last[r] = int(numpy.argmax(A))
+        best[r] = A[last[r]]
+    starts = []
+    r = N
+    while r > 0:
+        r = last[r-1]
+        starts.insert(0, r)
+    return zip(starts, starts[1:] + [ N ])
+
+def tsBlocks(C, ts_min, umin=0.0):
+    """Partition a sequence of bins into blocks by merging consecutive
+    bins until the TS of the block (twice the difference between the
+    maximum log likelihood for u>=umin and that at u=umin) reaches
+    ts_min. The log likelihoods of the bins are given as for
+    bayesianBlocks. Trailing bins which do not reach ts_min are merged
+    with the last block. Returns the list of blocks as for
+    bayesianBlocks."""
+    N = len(C)
+    blocks = []
+    k = 0
+    B = numpy.zeros(3)
+    for r in range(N):
+        B = B + C[r]
+        ts = 2*(_quadBlockMax(B[numpy.newaxis,:], umin)[0]
+                - (B[0] + B[1]*umin + B[2]*umin**2))
+        if ts >= ts_min:
+            blocks.append((k, r+1))
+            k = r+1
+            B = numpy.zeros(3)
+    if k < N:
+        if blocks:
+            blocks[-1] = (blocks[-1][0], N)
+        else:
+            blocks.append((k, N))
+    return blocks
+
+def lcParNames(lcs):
+    """Return the names of the spectral parameters found in the results
+    of the time bins, the normalization parameter first."""
+    par_names = []
+    for lc in lcs:
+        np = lc['original']['normpar_name']
+        if not np in par_names:
+            par_names.insert(0, np)
+        for fit in ('allfixed', 'normfree', 'allfree'):
+            if not lc.has_key(fit):
+                continue
+            for pn in lc[fit]['pars']:
+                if not pn in par_names:
+                    par_names.append(pn)
+    return par_names
+
+def lcColumns(lcs):
+    """Convert a list of dictionaries of results of the time bins (as
+    stored in LightCurve.lc) into a dictionary of NumPy arrays, with one
+    entry per time bin in each array. Missing scalars are stored as NaN,
+    and the profile vectors as two dimensional arrays padded with NaN."""
+    columns = dict()
+    for name, path in _lc_scalar_columns:
+        columns[name] = numpy.array(map(lambda lc:
+                                        _lcLookup(lc, path, numpy.nan), lcs),
+                                    dtype=float)
+    for name, path in _lc_string_columns:
+        columns[name] = numpy.array(map(lambda lc:
+                                        str(_lcLookup(lc, path, '')), lcs))
+    npoint = 0
+    for name, path in _lc_profile_columns:
+        for lc in lcs:
+            npoint = max(npoint, len(_lcLookup(lc, path, [])))
+    for name, path in _lc_profile_columns:
+        a = numpy.zeros((len(lcs), npoint)) + numpy.nan
+        for ibin in range(len(lcs)):
+            v = _lcLookup(lcs[ibin], path, [])
+            a[ibin,0:len(v)] = v
+        columns[name] = a
+    for pn in lcParNames(lcs):
+        for fit in ('allfixed', 'normfree', 'allfree'):
+            for field in ('value', 'error', 'free'):
+                name = '%s_par_%s_%s'%(fit, pn, field)
+                columns[name] = \
+                    numpy.array(map(lambda lc:
+                                    _lcLookup(lc, (fit, 'pars', pn, field),
+                                              numpy.nan), lcs), dtype=float)
+    return columns
+
+def saveColumns(columns, dirname, meta=None):
+    """Save a dictionary of columns (see lcColumns) in a directory, with
+    one NumPy file per column so that they can be read individually,
+    and a small index of the columns and other information."""
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    names = columns.keys()
+    names.sort()
+    for name in names:
+        numpy.save(os.path.join(dirname, name + '.npy'), columns[name])
+    if meta == None:
+        meta = dict()
+    else:
+        meta = dict(meta)
+    meta['columns'] = names
+    file=open(os.path.join(dirname, 'meta.pickle'),'w')
+    pickle.dump(meta,file)
+    file.close()
+
+def loadColumns(dirname, columns=None, bins=None):
+    """Load columns saved with saveColumns. Only the columns named in
+    the "columns" list are read (all by default), and if "bins" is given
+    as (start, stop) only that range of time bins is read, since the
+    files are memory mapped. Returns a dictionary of arrays and the
+    dictionary of additional information saved with the columns."""
+    file=open(os.path.join(dirname, 'meta.pickle'),'r')
+    meta=pickle.load(file)
+    file.close()
+    if columns == None:
+        columns = meta['columns']
+    data = dict()
+    for name in columns:
+        a = numpy.load(os.path.join(dirname, name + '.npy'), mmap_mode='r')
+        if bins != None:
+            a = a[bins[0]:bins[1]]
+        data[name] = numpy.array(a)
+    return data, meta
+
 class LightCurve:
     """Class to calculate light curves and variability indexes."""
     def __init__(self, srcName=None, ft2=None, irfs=None, model=None,
                  optimizer="Minuit"):
         self.ver = "$Id$"
         self.lc = []
+        self.lcs = dict()
         if(srcName == None):
             return
         self.srcName = srcName
@@ -349,163 +686,584 @@ class LightCurve:
         else:
             raise NameError("Unknown analysis type: \""+f['analysis']+"\"")
 
+    def adaptiveBinning(self, method='bayesian', ncp_prior=None,
+                        ts_min=25.0, verbosity=0, workers=1, **kwargs):
+        """Merge consecutive time bins into blocks of (roughly) constant
+        flux, so that the full sequence of fits is only run on the
+        blocks. A cheap first pass runs only the first fit and the
+        likelihood profile (see processObs, to which kwargs are passed)
+        in each bin, and the profiles are approximated by quadratics in
+        the normalization of the source. If workers>1 the first pass is
+        run concurrently by a pool of that many processes. Bins whose
+        profile is not peaked, or has too few points to fit a
+        quadratic, are taken to carry no information on the flux, and
+        are merged with their neighbours. With method='bayesian' the
+        bins are partitioned into Bayesian blocks, with a penalty of
+        ncp_prior per block, by default the empirical value for point
+        measurements of Scargle et al. (2013), 1.32+0.577*log10(N),
+        which corresponds to a false detection rate of about 5%. With
+        method='ts' consecutive bins are merged until the TS of each
+        block reaches ts_min. Blocks are made from whole bins, which are
+        never split. self.obsfiles is replaced by the blocks and the
+        list of blocks, given as (first, one past last) indexes of the
+        original bins, is returned. The results of the first pass are
+        kept in self.first_pass."""
+        if self._sharedComponentCacheSize() > 0:
+            raise RuntimeError("Adaptive binning cannot be used with "
+                               "overlapping (sliding window) bins")
+        self.first_pass = []
+        if workers == None or workers <= 1:
+            for ifile in range(len(self.obsfiles)):
+                if verbosity:
+                    print 'First pass: bin %d of %d'\
+                          %(ifile+1,len(self.obsfiles))
+                self.first_pass.append(self.processObs(self.obsfiles[ifile],
+                                                       verbosity=verbosity,
+                                                       profile_only=True,
+                                                       **kwargs))
+        else:
+            if verbosity:
+                print 'First pass: %d bins with %d workers'\
+                      %(len(self.obsfiles),workers)
+            worker_lc = copy.copy(self)
+            worker_lc.lc = []
+            worker_lc.lcs = dict()
+            bin_kwargs = dict(kwargs)
+            bin_kwargs['verbosity'] = verbosity
+            pool = multiprocessing.Pool(workers)
+            try:
+                results = []
+                for f in self.obsfiles:
+                    results.append(pool.apply_async(_firstPassWorker,
+                                                     (worker_lc, f,
+                                                      bin_kwargs)))
+                for r in results:
+                    self.first_pass.append(r.get())
+            except:
+                pool.terminate()
+                pool.join()
+                raise
+            pool.close()
+            pool.join()
+        N = len(self.first_pass)
+        if N == 0:
+            return []
+
+        # Fit the profiles in a scaled variable, as in generateLC. Bins
+        # whose profile is not peaked carry no information on the flux
+        columns = lcColumns(self.first_pass)
+        X = columns['profile_value']
+        Y = columns['profile_logL']
+        xvalid = X[numpy.isfinite(X)]
+        x0 = xvalid.mean()
+        xs = xvalid.max()-xvalid.min()
+        if xs <= 0:
+            xs = 1.0
+        C = _quadFit((X-x0)/xs, Y)
+        bad = numpy.logical_not(numpy.all(numpy.isfinite(C), axis=1))
+        bad[~bad] = C[~bad,2] >= 0
+        C[bad] = 0
+        umin = -x0/xs
+
+        if method == 'bayesian':
+            if ncp_prior == None:
+                ncp_prior = 1.32 + 0.577*math.log10(N)
+            blocks = bayesianBlocks(C, ncp_prior, umin)
+        elif method == 'ts':
+            blocks = tsBlocks(C, ts_min, umin)
+        else:
+            raise NameError("Unknown adaptive binning method: \""+
+                            method+"\"")
+
+        obsfiles = []
+        for [ k0, k1 ] in blocks:
+            files = []
+            for f in self.obsfiles[k0:k1]:
+                if type(f) == list:
+                    files.extend(f)
+                else:
+                    files.append(f)
+            if len(files) == 1:
+                files = files[0]
+            obsfiles.append(files)
+        self.obsfiles = obsfiles
+        if verbosity:
+            print 'Adaptive binning: %d bins merged into %d blocks'\
+                  %(N,len(blocks))
+        return blocks
+
     def processAllObs(self, fix_shape=True, delete_below_ts=None,
                       ul_flux_dflux=0, ul_chi2_ts=None, ul_bayes_ts=4.0,
                       ul_cl=0.95, verbosity=0, emin=0, emax=0, 
-                      interim_save_filename=None):
-        for f in self.obsfiles:
-            lc = dict()
-            lc['version'] = self.ver
-            lc['config'] = dict()
-            lc['config']['fix_shape']       = fix_shape
-            lc['config']['delete_below_ts'] = delete_below_ts
-            lc['config']['ul_flux_dflux']   = ul_flux_dflux
-            lc['config']['ul_chi2_ts']      = ul_chi2_ts
-            lc['config']['ul_bayes_ts']     = ul_bayes_ts
-            lc['config']['ul_cl']           = ul_cl
-            lc['config']['emin']            = emin
-            lc['config']['emax']            = emax
-            lc['config']['files']           = f
-            lc['config']['argv']            = sys.argv
-
-            lc['e_min'] = emin;
-            lc['e_max'] = emax;
+                      interim_save_filename=None, workers=1,
+                      checkpoint_dir=None, warm_start=False,
+                      profile_tol=None, profile_max_points=9,
+                      component_cache_size=None, srcNames=None):
+        """Process all time bins, appending one result dictionary per
+        bin to self.lc in time order. If workers>1 the bins are
+        processed concurrently by a pool of that many processes. If
+        checkpoint_dir is given the result of each bin is stored there
+        as soon as it is finished, and bins whose results are already
+        in the directory (with the same configuration) are not
+        processed again. If warm_start is True the fits in each bin
+        start with the background parameters found in the first fit of
+        the previous bin rather than those of the model; with workers>1
+        they start from those of the bin "workers" places earlier,
+        waiting for it if needed, so that the results are reproducible
+        for a given number of workers.
+        If profile_tol is given the likelihood profile in each bin is
+        computed adaptively, to that tolerance in log likelihood, using
+        at most profile_max_points points. When the bins share
+        observations (sliding windows) up to component_cache_size loaded
+        observations are kept for reuse by later bins; by default this is
+        the number needed to load each observation once, and zero
+        disables the cache. The cache is not used with workers>1.
+
+        If srcNames is given, light curves are computed for each source
+        in the list, loading each time bin only once (see
+        processObsMulti). The results for each source are appended to
+        self.lcs[srcName], and self.lc holds those for the first source
+        in the list. The interim file holds the results for the first
+        source, and those for the others are saved in files named with
+        lcSourceFilename."""
+        if srcNames == None:
+            srcNames = [ self.srcName ]
+        if not self.lcs.has_key(srcNames[0]):
+            self.lcs[srcNames[0]] = self.lc
+        self.lc = self.lcs[srcNames[0]]
+        for srcName in srcNames[1:]:
+            if not self.lcs.has_key(srcName):
+                self.lcs[srcName] = []
+
+        kwargs = dict(srcNames=srcNames, fix_shape=fix_shape,
+                      delete_below_ts=delete_below_ts,
+                      ul_flux_dflux=ul_flux_dflux, ul_chi2_ts=ul_chi2_ts,
+                      ul_bayes_ts=ul_bayes_ts, ul_cl=ul_cl,
+                      verbosity=verbosity, emin=emin, emax=emax,
+                      profile_tol=profile_tol,
+                      profile_max_points=profile_max_points)
+
+        checkpoint = None
+        keys = [ None ] * len(self.obsfiles)
+        if checkpoint_dir != None:
+            checkpoint = ResultCheckpoint.ResultCheckpoint(checkpoint_dir)
+            config = dict(kwargs)
+            del config['verbosity']
+            config['model']     = self.model
+            config['optimizer'] = self.optimizer
+            config['warm_start'] = warm_start
+            if warm_start and workers != None and workers > 1:
+                config['warm_start_lag'] = workers
+            for ifile in range(len(self.obsfiles)):
+                keys[ifile] = checkpoint.key(self.obsfiles[ifile], config,
+                                             [ self.model ])
+
+        if workers == None or workers <= 1:
+            # Observations shared by overlapping (sliding) windows are
+            # loaded once and kept while they are still needed
+            if component_cache_size == None:
+                component_cache_size = self._sharedComponentCacheSize()
+            component_cache = None
+            if component_cache_size > 0:
+                component_cache = \
+                    ComponentCache.ComponentCache(component_cache_size)
+            result = None
+            for ifile in range(len(self.obsfiles)):
+                f = self.obsfiles[ifile]
+                if checkpoint != None and checkpoint.has(keys[ifile]):
+                    if verbosity:
+                        print 'Using checkpointed bin:',keys[ifile]
+                    result = checkpoint.load(keys[ifile])
+                else:
+                    seeds = None
+                    if warm_start and result != None:
+                        seeds = _lcNuisanceSeeds(result)
+                    result = \
+                        self.processObsMulti(f, seeds=seeds,
+                                             component_cache=component_cache,
+                                             **kwargs)
+                    if checkpoint != None:
+                        checkpoint.save(keys[ifile], result)
+                self._appendResult(result, srcNames, interim_save_filename)
+            if component_cache != None and verbosity:
+                print 'Observations loaded: %d, reused: %d'\
+                      %(component_cache.nload, component_cache.nreuse)
+            return
 
+        # Send the workers a copy of this object without the results
+        # accumulated so far, since they are pickled with every task
+        worker_lc = copy.copy(self)
+        worker_lc.lc = []
+        worker_lc.lcs = dict()
+
+        # Keep a bounded number of bins in flight and collect them in
+        # time order, so the interim file always holds a contiguous
+        # prefix of the light curve, as in the serial case. The
+        # workers write their results to the checkpoint directory
+        # themselves, so that bins finished out of order are not lost
+        pool = multiprocessing.Pool(workers)
+        try:
+            pending = collections.deque()
+            # Results of the latest bins collected, for the warm start
+            collected = dict()
+            ifile = 0
+            while ifile < len(self.obsfiles) or pending:
+                while ifile < len(self.obsfiles) and \
+                          len(pending) < 2*workers:
+                    if checkpoint != None and checkpoint.has(keys[ifile]):
+                        if verbosity:
+                            print 'Using checkpointed bin:',keys[ifile]
+                        pending.append([ checkpoint.load(keys[ifile]),
+                                         None ])
+                    else:
+                        bin_kwargs = kwargs
+                        if warm_start:
+                            bin_kwargs = dict(kwargs)
+                            bin_kwargs['seeds'] = \
+                                self._laggedSeeds(ifile-workers, ifile,
+                                                  pending, collected)
+                        pending.append([ None, pool.apply_async(
+                                    _processObsWorker,
+                                    (worker_lc, self.obsfiles[ifile],
+                                     bin_kwargs, checkpoint, keys[ifile])) ])
+                    ifile += 1
+                [ result, async_result ] = pending.popleft()
+                if async_result != None:
+                    result = async_result.get()
+                icollected = ifile-len(pending)-1
+                collected[icollected] = result
+                if collected.has_key(icollected-workers):
+                    del collected[icollected-workers]
+                self._appendResult(result, srcNames, interim_save_filename)
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+
+    def _appendResult(self, result, srcNames, interim_save_filename=None):
+        """Append the results of one time bin, a dictionary indexed by
+        source name, to the light curve of each source, and write the
+        interim files if requested."""
+        for srcName in srcNames:
+            self.lcs[srcName].append(result[srcName])
+        if interim_save_filename != None:
+            self.saveProcessedObs(interim_save_filename)
+            for srcName in srcNames[1:]:
+                self.saveProcessedObs(lcSourceFilename(interim_save_filename,
+                                                       srcName), srcName)
+
+    def _sharedComponentCacheSize(self):
+        """Return the number of loaded observations that must be kept so
+        that each observation shared by several bins is loaded only
+        once, or zero if no observation is shared."""
+        nshared = 0
+        last_seen = dict()
+        for ifile in range(len(self.obsfiles)):
+            f = self.obsfiles[ifile]
             if type(f) != list:
-                [ obs, like ] = self.loadObs(f,verbosity)
-                lc['t_min'] = obs.roiCuts().minTime()
-                lc['t_max'] = obs.roiCuts().maxTime()
-                if (emin == 0 or emax == 0):
-                    lc['e_min'] = obs.roiCuts().getEnergyCuts()[0];
-                    lc['e_max'] = obs.roiCuts().getEnergyCuts()[1];
-            else:
-                lc['t_min'] = None
-                lc['t_max'] = None
-                like = SummedLikelihood.SummedLikelihood(self.optimizer)
-                for ff in f:
+                continue
+            for ff in f:
+                key = ComponentCache._canonicalKey(ff)
+                if last_seen.has_key(key):
+                    nshared = max(nshared, len(f))
+                last_seen[key] = ifile
+        return nshared
+
+    def _laggedSeeds(self, iseed, ifile, pending, collected):
+        """Return the background parameters, for each source, of bin
+        iseed, to start the fits of bin ifile, waiting for it if it is
+        still pending, or None if iseed<0. The bins in the queue of
+        pending results precede ifile, and earlier bins are in the
+        dictionary of collected results."""
+        if iseed < 0:
+            return None
+        ipending = iseed - (ifile - len(pending))
+        if ipending < 0:
+            return _lcNuisanceSeeds(collected[iseed])
+        [ result, async_result ] = pending[ipending]
+        if result == None:
+            result = async_result.get()
+        return _lcNuisanceSeeds(result)
+
+    def processObs(self, f, fix_shape=True, delete_below_ts=None,
+                   ul_flux_dflux=0, ul_chi2_ts=None, ul_bayes_ts=4.0,
+                   ul_cl=0.95, verbosity=0, emin=0, emax=0, seed=None,
+                   profile_tol=None, profile_max_points=9,
+                   component_cache=None, profile_only=False):
+        """Process one time bin, which is either a single observation
+        or a list of observations to be summed, returning the
+        dictionary of results for the bin. If seed is given, it should
+        be the dictionary of background parameter values found in the
+        first fit of another bin (lc['allfixed']['nuisance']), which
+        are used as starting values for the fits in this bin. If
+        profile_tol is given the likelihood profile is computed
+        adaptively (see _adaptiveProfile) rather than at five fixed
+        points. If component_cache (a ComponentCache) is given, the
+        observations of a summed bin are taken from it when possible. If
+        profile_only is True, processing stops after the first fit and
+        the likelihood profile."""
+        seeds = None
+        if seed != None:
+            seeds = { self.srcName: seed }
+        result = self.processObsMulti(f, [ self.srcName ],
+                                      fix_shape=fix_shape,
+                                      delete_below_ts=delete_below_ts,
+                                      ul_flux_dflux=ul_flux_dflux,
+                                      ul_chi2_ts=ul_chi2_ts,
+                                      ul_bayes_ts=ul_bayes_ts, ul_cl=ul_cl,
+                                      verbosity=verbosity, emin=emin,
+                                      emax=emax, seeds=seeds,
+                                      profile_tol=profile_tol,
+                                      profile_max_points=profile_max_points,
+                                      component_cache=component_cache,
+                                      profile_only=profile_only)
+        return result[self.srcName]
+
+    def processObsMulti(self, f, srcNames, fix_shape=True,
+                        delete_below_ts=None, ul_flux_dflux=0,
+                        ul_chi2_ts=None, ul_bayes_ts=4.0, ul_cl=0.95,
+                        verbosity=0, emin=0, emax=0, seeds=None,
+                        profile_tol=None, profile_max_points=9,
+                        component_cache=None, profile_only=False):
+        """Process one time bin for each of the sources in the list
+        srcNames, loading the observations only once, and return a
+        dictionary of the results for the bin indexed by source name
+        (see processObs). The likelihood is put back in the state in
+        which it was loaded before each source is processed, so the
+        results for each source are those that would be found by
+        processing it alone, except that the other sources in the list
+        are never deleted from the model. If seeds is given, it is a
+        dictionary of background parameter values for each source."""
+        lc = dict()
+        lc['version'] = self.ver
+        lc['config'] = dict()
+        lc['config']['fix_shape']       = fix_shape
+        lc['config']['delete_below_ts'] = delete_below_ts
+        lc['config']['ul_flux_dflux']   = ul_flux_dflux
+        lc['config']['ul_chi2_ts']      = ul_chi2_ts
+        lc['config']['ul_bayes_ts']     = ul_bayes_ts
+        lc['config']['ul_cl']           = ul_cl
+        lc['config']['emin']            = emin
+        lc['config']['emax']            = emax
+        lc['config']['files']           = f
+        lc['config']['argv']            = sys.argv
+
+        lc['e_min'] = emin;
+        lc['e_max'] = emax;
+
+        if type(f) != list:
+            [ obs, like ] = self.loadObs(f,verbosity)
+            lc['t_min'] = obs.roiCuts().minTime()
+            lc['t_max'] = obs.roiCuts().maxTime()
+            if (emin == 0 or emax == 0):
+                lc['e_min'] = obs.roiCuts().getEnergyCuts()[0];
+                lc['e_max'] = obs.roiCuts().getEnergyCuts()[1];
+        else:
+            lc['t_min'] = None
+            lc['t_max'] = None
+            like = SummedLikelihood.SummedLikelihood(self.optimizer)
+            for ff in f:
+                if component_cache != None:
+                    [ obs, like1 ] = component_cache.get(ff, self.loadObs,
+                                                         verbosity)
+                else:
                     [ obs, like1 ] = self.loadObs(ff,verbosity)
-                    tmin = obs.roiCuts().minTime()
-                    tmax = obs.roiCuts().maxTime()
-                    if lc['t_min'] == None or tmin<lc['t_min']:
-                        lc['t_min'] = tmin 
-                    if lc['t_max'] == None or tmax>lc['t_max']:
-                        lc['t_max'] = tmax
-                    if (lc['e_min'] == 0 or lc['e_max'] == 0):
-                        ecuts = obs.roiCuts().getEnergyCuts()
-                        lc['e_min'] = ecuts[0]
-                        lc['e_max'] = ecuts[1]
-                    elif (emin == 0 or emax == 0):
-                        ecuts = obs.roiCuts().getEnergyCuts()
-                        lc['e_min'] = max(lc['e_min'], ecuts[0])
-                        lc['e_max'] = min(lc['e_max'], ecuts[1])
-                    like.addComponent(like1)
-
-            emin = lc['e_min']
-            emax = lc['e_max']
-            
-            like.tol = like.tol*0.01;
-
+                tmin = obs.roiCuts().minTime()
+                tmax = obs.roiCuts().maxTime()
+                if lc['t_min'] == None or tmin<lc['t_min']:
+                    lc['t_min'] = tmin 
+                if lc['t_max'] == None or tmax>lc['t_max']:
+                    lc['t_max'] = tmax
+                if (lc['e_min'] == 0 or lc['e_max'] == 0):
+                    ecuts = obs.roiCuts().getEnergyCuts()
+                    lc['e_min'] = ecuts[0]
+                    lc['e_max'] = ecuts[1]
+                elif (emin == 0 or emax == 0):
+                    ecuts = obs.roiCuts().getEnergyCuts()
+                    lc['e_min'] = max(lc['e_min'], ecuts[0])
+                    lc['e_max'] = min(lc['e_max'], ecuts[1])
+                like.addComponent(like1)
+
+        like.tol = like.tol*0.01;
+
+        if verbosity > 1:
+            print '- Time:',lc['t_min'],'to',lc['t_max']
+
+        # Sources deleted while processing one source are put back for
+        # the next, and before cached observations are used again
+        snapshot = None
+        if len(srcNames) > 1 or component_cache != None:
+            snapshot = ComponentCache.LikelihoodSnapshot(like)
+
+        result = dict()
+        for isrc in range(len(srcNames)):
+            srcName = srcNames[isrc]
+            if isrc > 0:
+                snapshot.restore()
+            seed = None
+            if seeds != None and seeds.has_key(srcName):
+                seed = seeds[srcName]
+            if verbosity > 1 and len(srcNames) > 1:
+                print '- Source:',srcName
+            srclc = copy.deepcopy(lc)
+            srclc['src_name'] = srcName
+            self._processSource(like, srcName, srclc, fix_shape=fix_shape,
+                                delete_below_ts=delete_below_ts,
+                                ul_flux_dflux=ul_flux_dflux,
+                                ul_chi2_ts=ul_chi2_ts,
+                                ul_bayes_ts=ul_bayes_ts, ul_cl=ul_cl,
+                                verbosity=verbosity, seed=seed,
+                                profile_tol=profile_tol,
+                                profile_max_points=profile_max_points,
+                                keep_sources=srcNames, snapshot=snapshot,
+                                profile_only=profile_only)
+            result[srcName] = srclc
+        if component_cache != None:
+            snapshot.restore()
+        return result
+
+    def _processSource(self, like, srcName, lc, fix_shape=True,
+                       delete_below_ts=None, ul_flux_dflux=0,
+                       ul_chi2_ts=None, ul_bayes_ts=4.0, ul_cl=0.95,
+                       verbosity=0, seed=None, profile_tol=None,
+                       profile_max_points=9, keep_sources=(),
+                       snapshot=None, profile_only=False):
+        """Run the sequence of fits for one source on a loaded time bin,
+        storing the results in the dictionary lc, which must already
+        hold the time and energy range of the bin. Background sources
+        are deleted through the snapshot, if one is given, and sources
+        in the keep_sources list are never deleted."""
+        emin = lc['e_min']
+        emax = lc['e_max']
+
+        src = like[srcName]
+        if src == None:
+            raise NameError("No source \""+srcName+"\" in model "+
+                            self.model)
+        srcfreepar=like.freePars(srcName)
+        srcnormpar=like.normPar(srcName)
+        if len(srcfreepar)>0:
+            like.setFreeFlag(srcName, srcfreepar, 0)
+            like.syncSrcParams(srcName)
+
+        meanvalue = srcnormpar.getValue()
+        meanerror = srcnormpar.error()
+        lc['original']=dict()
+        lc['original']['normpar_init_value'] = meanvalue
+        lc['original']['normpar_name'] = srcnormpar.getName()
+        lc['original']['nfree'] = len(like.freePars(srcName))
+        lc['original']['flux'] = like[srcName].flux(emin, emax)
+        lc['original']['logL'] = like.logLike.value()
+        if verbosity > 1:
+            print '- Original log Like:',lc['original']['logL']
+
+        if fix_shape:
             if verbosity > 1:
-                print '- Time:',lc['t_min'],'to',lc['t_max']
-
-            src = like[self.srcName]
-            if src == None:
-                raise NameError("No source \""+self.srcName+"\" in model "+
-                                self.model)
-            srcfreepar=like.freePars(self.srcName)
-            srcnormpar=like.normPar(self.srcName)
-            if len(srcfreepar)>0:
-                like.setFreeFlag(self.srcName, srcfreepar, 0)
-                like.syncSrcParams(self.srcName)
-
-            meanvalue = srcnormpar.getValue()
-            meanerror = srcnormpar.error()
-            lc['original']=dict()
-            lc['original']['normpar_init_value'] = meanvalue
-            lc['original']['normpar_name'] = srcnormpar.getName()
-            lc['original']['nfree'] = len(like.freePars(self.srcName))
-            lc['original']['flux'] = like[self.srcName].flux(emin, emax)
-            lc['original']['logL'] = like.logLike.value()
-            if verbosity > 1:
-                print '- Original log Like:',lc['original']['logL']
-
-            if fix_shape:
-                if verbosity > 1:
-                    print '- Fixing spectral shape parameters'
-                sync_name = ""
-                for p in like.params():
-                    if sync_name != "" and sync_name != p.srcName:
-                        like.syncSrcParams(sync_name)
-                        sync_name = ""
-                    if(p.isFree() and p.srcName!=self.srcName and
-                       p.getName()!=like.normPar(p.srcName).getName()):
-                        if verbosity > 2:
-                            print '-- '+p.srcName+'.'+p.getName()
-                        p.setFree(False)
-                        sync_name = p.srcName
+                print '- Fixing spectral shape parameters'
+            sync_name = ""
+            for p in like.params():
                 if sync_name != "" and sync_name != p.srcName:
                     like.syncSrcParams(sync_name)
                     sync_name = ""
+                if(p.isFree() and p.srcName!=srcName and
+                   p.getName()!=like.normPar(p.srcName).getName()):
+                    if verbosity > 2:
+                        print '-- '+p.srcName+'.'+p.getName()
+                    p.setFree(False)
+                    sync_name = p.srcName
+            if sync_name != "" and sync_name != p.srcName:
+                like.syncSrcParams(sync_name)
+                sync_name = ""
 
-            # ----------------------------- FIT 1 -----------------------------
+        # ----------------------------- FIT 1 -----------------------------
 
+        nseeded = 0
+        if seed != None:
+            nseeded = self._seedNuisance(like, srcName, seed, verbosity)
             if verbosity > 1:
-                print '- Fit 1 - All parameters of',self.srcName,'fixed'
-            like.fit(max(verbosity-3, 0))
-
-            lc['allfixed'] = dict()
-            lc['allfixed']['logL'] = like.logLike.value()
-            fitstat = like.optObject.getRetCode()
-            if verbosity > 1 and fitstat != 0:
-                print "- Fit 1 - Minimizer returned with code: ", fitstat
-            lc['allfixed']['fitstat'] = fitstat
+                print '- Fit 1 - %d background parameters seeded from '\
+                      'neighbouring bin'%nseeded
+
+        if verbosity > 1:
+            print '- Fit 1 - All parameters of',srcName,'fixed'
+        fit_start = time.time()
+        like.fit(max(verbosity-3, 0))
+        fit_time = time.time() - fit_start
+
+        lc['allfixed'] = dict()
+        lc['allfixed']['nseeded'] = nseeded
+        lc['allfixed']['fit_time'] = fit_time
+        lc['allfixed']['logL'] = like.logLike.value()
+        fitstat = like.optObject.getRetCode()
+        if verbosity > 1 and fitstat != 0:
+            print "- Fit 1 - Minimizer returned with code: ", fitstat
+        lc['allfixed']['fitstat'] = fitstat
+        if verbosity > 1:
+            print '- Fit 1 - log Like:',lc['allfixed']['logL']
+
+        if delete_below_ts:
+            frozensrc = []
             if verbosity > 1:
-                print '- Fit 1 - log Like:',lc['allfixed']['logL']
-
-            if delete_below_ts:
-                frozensrc = []
-                if verbosity > 1:
-                    print '- Deleting point sources with TS<'+str(delete_below_ts)
-                deletesrc = []
-                for s in like.sourceNames():
-                    freepars = like.freePars(s)
-                    if(s!=self.srcName and like[s].type == 'PointSource'
-                       and len(freepars)>0):
-                        ts = like.Ts(s)
-                        if ts<delete_below_ts:
-                            deletesrc.append(s)
-                            if verbosity > 2:
-                                print '--',s,'(TS='+str(ts)+')'
-                if deletesrc:
-                    for s in deletesrc:
+                print '- Deleting point sources with TS<'+str(delete_below_ts)
+            deletesrc = []
+            for s in like.sourceNames():
+                freepars = like.freePars(s)
+                if(s not in keep_sources and s!=srcName and
+                   like[s].type == 'PointSource'
+                   and len(freepars)>0):
+                    ts = like.Ts(s)
+                    if ts<delete_below_ts:
+                        deletesrc.append(s)
+                        if verbosity > 2:
+                            print '--',s,'(TS='+str(ts)+')'
+            if deletesrc:
+                for s in deletesrc:
+                    if snapshot != None:
+                        snapshot.deleteSource(s)
+                    else:
                         like.deleteSource(s)
-                    if verbosity > 1:
-                        print '- Fit 1 - refitting model'
-                    like.fit(max(verbosity-3, 0))
-                    lc['allfixed']['fitstat_initial'] = \
-                        lc['allfixed']['fitstat']
-                    fitstat = like.optObject.getRetCode()
-                    if verbosity > 1 and fitstat != 0:
-                        print "- Fit 1 - Minimizer returned with code: ",\
-                            fitstat
-                    lc['allfixed']['fitstat'] = fitstat
-                    lc['allfixed']['logL'] = like.logLike.value()
-                    if verbosity > 1:
-                        print '- Fit 1 - log Like:',lc['allfixed']['logL']
-                        
-
-            lc['allfixed']['flux']=like[self.srcName].flux(emin, emax)
-            pars = dict()
-            for pn in like[self.srcName].funcs['Spectrum'].paramNames:
-                p = like[self.srcName].funcs['Spectrum'].getParam(pn)
-                pars[p.getName()] = dict(name      = p.getName(),
-                                         value     = p.getTrueValue(),
-                                         error     = p.error()*p.getScale(),
-                                         free      = p.isFree())
-            lc['allfixed']['pars'] = pars
-
-            # ------------------ N SIGMA PROFILE LIKELIHOOD -------------------
-
+                if verbosity > 1:
+                    print '- Fit 1 - refitting model'
+                like.fit(max(verbosity-3, 0))
+                lc['allfixed']['fitstat_initial'] = \
+                    lc['allfixed']['fitstat']
+                fitstat = like.optObject.getRetCode()
+                if verbosity > 1 and fitstat != 0:
+                    print "- Fit 1 - Minimizer returned with code: ",\
+                        fitstat
+                lc['allfixed']['fitstat'] = fitstat
+                lc['allfixed']['logL'] = like.logLike.value()
+                if verbosity > 1:
+                    print '- Fit 1 - log Like:',lc['allfixed']['logL']
+                    
+
+        lc['allfixed']['flux']=like[srcName].flux(emin, emax)
+        lc['allfixed']['nuisance']=self._nuisanceValues(like, srcName)
+        pars = dict()
+        for pn in like[srcName].funcs['Spectrum'].paramNames:
+            p = like[srcName].funcs['Spectrum'].getParam(pn)
+            pars[p.getName()] = dict(name      = p.getName(),
+                                     value     = p.getTrueValue(),
+                                     error     = p.error()*p.getScale(),
+                                     free      = p.isFree())
+        lc['allfixed']['pars'] = pars
+
+        # ------------------ N SIGMA PROFILE LIKELIHOOD -------------------
+
+        if profile_tol != None:
+            if verbosity > 1:
+                print '- Fit 1 - generating adaptive likelihood profile'
+            lc['profile'] = \
+                self._adaptiveProfile(like, srcName, srcnormpar, meanvalue,
+                                      meanerror,
+                                      lc['allfixed']['logL'],
+                                      lc['allfixed']['flux'], emin, emax,
+                                      profile_tol, profile_max_points,
+                                      verbosity)
+            lc['profile']['tol'] = profile_tol
+        else:
             prof_sigma = (-1,-0.5,0,0.5,1.0)
             lc['profile'] = dict();
             lc['profile']['sigma'] = []
@@ -531,7 +1289,7 @@ class LightCurve:
                     lc['profile']['flux'].append(lc['allfixed']['flux'])
                 else:
                     srcnormpar.setValue(val)
-                    like.syncSrcParams(self.srcName)                    
+                    like.syncSrcParams(srcName)                    
                     like.fit(max(verbosity-3, 0))
                     fitstat = like.optObject.getRetCode()
                     if verbosity > 2 and fitstat != 0:
@@ -539,106 +1297,271 @@ class LightCurve:
                             fitstat
                     lc['profile']['fitstat'].append(fitstat)
                     lc['profile']['logL'].append(like.logLike.value())
-                    lc['profile']['flux'].append(like[self.srcName].\
+                    lc['profile']['flux'].append(like[srcName].\
                                               flux(emin, emax))
                 if verbosity > 2:
                     print '- Fit 1 - profile: %+g, %f -> %f'%\
                           (sigma,lc['profile']['value'][-1],
                            lc['profile']['logL'][-1]-lc['allfixed']['logL'])
 
-            srcnormpar.setValue(meanvalue)
-            like.syncSrcParams(self.srcName)                    
-
-            # ----------------------------- FIT 2 -----------------------------
-
-            if verbosity > 1:
-                print '- Fit 2 - Normalization parameter of',\
-                      self.srcName,'free'
-            srcnormpar.setFree(1)
-            like.syncSrcParams(self.srcName)
-            like.fit(max(verbosity-3, 0))
-            lc['normfree'] = dict()
-            fitstat = like.optObject.getRetCode()
-            if verbosity > 1 and fitstat != 0:
-                print "- Fit 2 - Minimizer returned with code: ", fitstat
-            lc['normfree']['fitstat'] = fitstat
-            lc['normfree']['logL'] = like.logLike.value()
-            lc['normfree']['ts'] = like.Ts(self.srcName)
-            lc['normfree']['flux_dflux'] = \
-                srcnormpar.getValue()/srcnormpar.error()
-            if verbosity > 1:
-                print '- Fit 2 - log Like:',lc['normfree']['logL'],\
-                      '(TS='+str(lc['normfree']['ts'])+')'
-
-            lc['normfree']['nfree']=len(like.freePars(self.srcName))
-            lc['normfree']['flux']=like[self.srcName].flux(emin, emax)
-            pars = dict()
-            for pn in like[self.srcName].funcs['Spectrum'].paramNames:
-                p = like[self.srcName].funcs['Spectrum'].getParam(pn)
-                pars[p.getName()] = dict(name      = p.getName(),
-                                         value     = p.getTrueValue(),
-                                         error     = p.error()*p.getScale(),
-                                         free      = p.isFree())
-            lc['normfree']['pars'] = pars
-
-            ul_type = None
-            if ul_bayes_ts != None and lc['normfree']['ts'] < ul_bayes_ts:
-                ul_type = 'bayesian'
-                [ul_flux, ul_results] = \
-                    IntegralUpperLimit.calc_int(like,self.srcName,cl=ul_cl,
-                                                skip_global_opt=True,
-                                                verbosity = max(verbosity-2,0),
-                                                emin=emin, emax=emax,
-                                            poi_values = lc['profile']['value'])
-            elif ( ul_flux_dflux != None and \
-                   lc['normfree']['flux_dflux'] < ul_flux_dflux ) or \
-                   ( ul_chi2_ts != None and lc['normfree']['ts'] < ul_chi2_ts):
-                ul_type = 'chi2'
-                [ul_flux, ul_results] = \
-                    IntegralUpperLimit.calc_chi2(like,self.srcName,cl=ul_cl,
-                                                 skip_global_opt=True,
-                                                 verbosity = max(verbosity-2,0),
-                                                 emin=emin, emax=emax)
-            if ul_type != None:
-                lc['normfree']['ul'] = dict(flux    = ul_flux,
-                                            results = ul_results,
-                                            type    = ul_type)
-
-            # ----------------------------- FIT 3 -----------------------------
+        srcnormpar.setValue(meanvalue)
+        like.syncSrcParams(srcName)                    
 
-            if verbosity > 1:
-                print '- Fit 3 - All parameters of',self.srcName,'free'
-            like.setFreeFlag(self.srcName, srcfreepar, 1)
-            like.syncSrcParams(self.srcName)
-            like.fit(max(verbosity-3, 0))
-            lc['allfree'] = dict()
-            fitstat = like.optObject.getRetCode()
-            if verbosity > 1 and fitstat != 0:
-                print "- Fit 3 - Minimizer returned with code: ", fitstat
-            lc['allfree']['fitstat'] = fitstat
-            lc['allfree']['logL'] = like.logLike.value()
-            lc['allfree']['ts'] = like.Ts(self.srcName)
-            if verbosity > 1:
-                print '- Fit 3 - log Like:',lc['allfree']['logL'],\
-                      '(TS='+str(lc['allfree']['ts'])+')'
-            lc['allfree']['nfree']=len(like.freePars(self.srcName))
-            lc['allfree']['flux']=like[self.srcName].flux(emin, emax)
-            pars = dict()
-            for pn in like[self.srcName].funcs['Spectrum'].paramNames:
-                p = like[self.srcName].funcs['Spectrum'].getParam(pn)
-                pars[p.getName()] = dict(name      = p.getName(),
-                                         value     = p.getTrueValue(),
-                                         error     = p.error()*p.getScale(),
-                                         free      = p.isFree())
-            lc['allfree']['pars'] = pars
-
-            self.lc.append(lc)
-            if interim_save_filename != None:
-                self.saveProcessedObs(interim_save_filename)
+        if profile_only:
+            return
 
-    def saveProcessedObs(self,filename):
+        # ----------------------------- FIT 2 -----------------------------
+
+        if verbosity > 1:
+            print '- Fit 2 - Normalization parameter of',\
+                  srcName,'free'
+        srcnormpar.setFree(1)
+        like.syncSrcParams(srcName)
+        like.fit(max(verbosity-3, 0))
+        lc['normfree'] = dict()
+        fitstat = like.optObject.getRetCode()
+        if verbosity > 1 and fitstat != 0:
+            print "- Fit 2 - Minimizer returned with code: ", fitstat
+        lc['normfree']['fitstat'] = fitstat
+        lc['normfree']['logL'] = like.logLike.value()
+        lc['normfree']['ts'] = like.Ts(srcName)
+        lc['normfree']['flux_dflux'] = \
+            srcnormpar.getValue()/srcnormpar.error()
+        if verbosity > 1:
+            print '- Fit 2 - log Like:',lc['normfree']['logL'],\
+                  '(TS='+str(lc['normfree']['ts'])+')'
+
+        lc['normfree']['nfree']=len(like.freePars(srcName))
+        lc['normfree']['flux']=like[srcName].flux(emin, emax)
+        pars = dict()
+        for pn in like[srcName].funcs['Spectrum'].paramNames:
+            p = like[srcName].funcs['Spectrum'].getParam(pn)
+            pars[p.getName()] = dict(name      = p.getName(),
+                                     value     = p.getTrueValue(),
+                                     error     = p.error()*p.getScale(),
+                                     free      = p.isFree())
+        lc['normfree']['pars'] = pars
+
+        ul_type = None
+        if ul_bayes_ts != None and lc['normfree']['ts'] < ul_bayes_ts:
+            ul_type = 'bayesian'
+            [ul_flux, ul_results] = \
+                IntegralUpperLimit.calc_int(like,srcName,cl=ul_cl,
+                                            skip_global_opt=True,
+                                            verbosity = max(verbosity-2,0),
+                                            emin=emin, emax=emax,
+                                        poi_values = lc['profile']['value'])
+        elif ( ul_flux_dflux != None and \
+               lc['normfree']['flux_dflux'] < ul_flux_dflux ) or \
+               ( ul_chi2_ts != None and lc['normfree']['ts'] < ul_chi2_ts):
+            ul_type = 'chi2'
+            [ul_flux, ul_results] = \
+                IntegralUpperLimit.calc_chi2(like,srcName,cl=ul_cl,
+                                             skip_global_opt=True,
+                                             verbosity = max(verbosity-2,0),
+                                             emin=emin, emax=emax)
+        if ul_type != None:
+            lc['normfree']['ul'] = dict(flux    = ul_flux,
+                                        results = ul_results,
+                                        type    = ul_type)
+
+        # ----------------------------- FIT 3 -----------------------------
+
+        if verbosity > 1:
+            print '- Fit 3 - All parameters of',srcName,'free'
+        like.setFreeFlag(srcName, srcfreepar, 1)
+        like.syncSrcParams(srcName)
+        like.fit(max(verbosity-3, 0))
+        lc['allfree'] = dict()
+        fitstat = like.optObject.getRetCode()
+        if verbosity > 1 and fitstat != 0:
+            print "- Fit 3 - Minimizer returned with code: ", fitstat
+        lc['allfree']['fitstat'] = fitstat
+        lc['allfree']['logL'] = like.logLike.value()
+        lc['allfree']['ts'] = like.Ts(srcName)
+        if verbosity > 1:
+            print '- Fit 3 - log Like:',lc['allfree']['logL'],\
+                  '(TS='+str(lc['allfree']['ts'])+')'
+        lc['allfree']['nfree']=len(like.freePars(srcName))
+        lc['allfree']['flux']=like[srcName].flux(emin, emax)
+        pars = dict()
+        for pn in like[srcName].funcs['Spectrum'].paramNames:
+            p = like[srcName].funcs['Spectrum'].getParam(pn)
+            pars[p.getName()] = dict(name      = p.getName(),
+                                     value     = p.getTrueValue(),
+                                     error     = p.error()*p.getScale(),
+                                     free      = p.isFree())
+        lc['allfree']['pars'] = pars
+
+
+    def _adaptiveProfile(self, like, srcName, srcnormpar, meanvalue,
+                         meanerror, logL0, flux0, emin, emax, tol,
+                         max_points=9, verbosity=0):
+        """Evaluate the profile likelihood of the normalization parameter
+        at as few points as possible. Starting from the points at +/-1
+        sigma (of the global fit) around the global value, the range is
+        extended by doubling until it brackets the maximum of a quadratic
+        fitted to the profile (or reaches the lower bound on the
+        parameter). The widest gap between the points is then split until
+        the quadratic predicts the newly evaluated point to within tol
+        (in log likelihood), or max_points points have been evaluated.
+        The nuisance parameters of each fit are started from values
+        interpolated from the previous fits, as in IntegralUpperLimit."""
+        limlo, limhi = srcnormpar.getBounds()
+        nuisance_cache = IntegralUpperLimit._NuisanceCache()
+        IntegralUpperLimit._cache_nuisance(meanvalue, like, nuisance_cache)
+        points = dict()
+        points[0.0] = [ meanvalue, logL0, flux0, None ]
+        for sigma in (-1.0, 1.0):
+            self._adaptiveProfilePoint(like, srcName, srcnormpar, sigma,
+                                       meanvalue, meanerror, limlo, limhi,
+                                       emin, emax, points, nuisance_cache,
+                                       verbosity)
+        while len(points) < max_points:
+            S = points.keys()
+            S.sort()
+            Y = map(lambda s: points[s][1], S)
+            p = scipy.polyfit(S, Y, 2)
+            lo_blocked = (points[S[0]][0] <= limlo)
+            hi_blocked = (points[S[-1]][0] >= limhi)
+            extend = 0
+            if p[0] >= 0:
+                if (Y[-1] > Y[0] or lo_blocked) and not hi_blocked: extend = 1
+                elif not lo_blocked: extend = -1
+            else:
+                svertex = -p[1]/(2*p[0])
+                if svertex > S[-1] and not hi_blocked: extend = 1
+                elif svertex < S[0] and not lo_blocked: extend = -1
+            if extend > 0:
+                self._adaptiveProfilePoint(like, srcName, srcnormpar,
+                                           2.0*S[-1],
+                                           meanvalue, meanerror, limlo, limhi,
+                                           emin, emax, points,
+                                           nuisance_cache, verbosity)
+                continue
+            elif extend < 0:
+                self._adaptiveProfilePoint(like, srcName, srcnormpar,
+                                           2.0*S[0],
+                                           meanvalue, meanerror, limlo, limhi,
+                                           emin, emax, points,
+                                           nuisance_cache, verbosity)
+                continue
+            igap = 0
+            for i in range(1,len(S)-1):
+                if S[i+1]-S[i] > S[igap+1]-S[igap]:
+                    igap = i
+            stest = 0.5*(S[igap]+S[igap+1])
+            ytest = self._adaptiveProfilePoint(like, srcName, srcnormpar,
+                                               stest,
+                                               meanvalue, meanerror, limlo,
+                                               limhi, emin, emax, points,
+                                               nuisance_cache, verbosity)
+            if abs(ytest - scipy.polyval(p, stest)) < tol:
+                break
+
+        # Start the following fits from the nuisance parameters of Fit 1
+        IntegralUpperLimit._reset_nuisance(meanvalue, like, nuisance_cache)
+
+        profile = dict()
+        profile['sigma'] = []
+        profile['value'] = []
+        profile['logL'] = []
+        profile['flux'] = []
+        profile['fitstat'] = []
+        S = points.keys()
+        S.sort()
+        for sigma in S:
+            [ val, logL, flux, fitstat ] = points[sigma]
+            profile['sigma'].append(sigma)
+            profile['value'].append(val)
+            profile['logL'].append(logL)
+            profile['flux'].append(flux)
+            if fitstat != None:
+                profile['fitstat'].append(fitstat)
+        if verbosity > 1:
+            print '- Fit 1 - adaptive profile: %d points in %+g to %+g sigma'\
+                  %(len(S),S[0],S[-1])
+        return profile
+
+    def _adaptiveProfilePoint(self, like, srcName, srcnormpar, sigma,
+                              meanvalue, meanerror, limlo, limhi, emin, emax,
+                              points, nuisance_cache, verbosity=0):
+        """Evaluate one point of the adaptive profile, storing it in the
+        points dictionary, and return its log likelihood."""
+        val = min(max(sigma*meanerror+meanvalue, limlo), limhi)
+        sigma = (val-meanvalue)/meanerror
+        if points.has_key(sigma):
+            return points[sigma][1]
+        srcnormpar.setValue(val)
+        like.syncSrcParams(srcName)
+        IntegralUpperLimit._guess_nuisance(val, like, nuisance_cache)
+        like.fit(max(verbosity-3, 0))
+        IntegralUpperLimit._cache_nuisance(val, like, nuisance_cache)
+        fitstat = like.optObject.getRetCode()
+        if verbosity > 2 and fitstat != 0:
+            print "- Fit 1 - profile: Minimizer returned code: ", fitstat
+        logL = like.logLike.value()
+        points[sigma] = [ val, logL, like[srcName].flux(emin, emax),
+                          fitstat ]
+        if verbosity > 2:
+            print '- Fit 1 - profile: %+g, %f -> %f'%\
+                  (sigma,val,logL-points[0.0][1])
+        return logL
+
+    def _nuisanceValues(self, like, srcName):
+        """Return the values of the free background parameters (those
+        of sources other than srcName) as a dictionary of dictionaries,
+        indexed by source and parameter name."""
+        nuisance = dict()
+        for p in like.params():
+            if p.isFree() and p.srcName != srcName:
+                if not nuisance.has_key(p.srcName):
+                    nuisance[p.srcName] = dict()
+                nuisance[p.srcName][p.getName()] = p.getValue()
+        return nuisance
+
+    def _seedNuisance(self, like, srcName, seed, verbosity=0):
+        """Set the free background parameters to the values given in
+        the seed dictionary, returning the number of parameters set."""
+        nseeded = 0
+        sync_name = ""
+        for p in like.params():
+            if sync_name != "" and sync_name != p.srcName:
+                like.syncSrcParams(sync_name)
+                sync_name = ""
+            if(p.isFree() and p.srcName != srcName and
+               seed.has_key(p.srcName) and
+               seed[p.srcName].has_key(p.getName())):
+                limlo, limhi = p.getBounds()
+                val = max(limlo, min(seed[p.srcName][p.getName()], limhi))
+                if verbosity > 2:
+                    print '-- '+p.srcName+'.'+p.getName()+': %g -> %g'\
+                          %(p.getValue(),val)
+                p.setValue(val)
+                sync_name = p.srcName
+                nseeded += 1
+        if sync_name != "":
+            like.syncSrcParams(sync_name)
+        return nseeded
+
+    def ulInstrumentation(self, srcName=None):
+        """Return the sum of the instrumentation records of the upper
+        limits calculated in the time bins (see
+        IntegralUpperLimit.aggregate_instrumentation), by default for
+        the results in self.lc, otherwise for those of source srcName."""
+        lcs = self.lc
+        if srcName != None:
+            lcs = self.lcs[srcName]
+        return IntegralUpperLimit.aggregate_instrumentation(
+            map(lambda lc: _lcLookup(lc, ('normfree','ul','results',
+                                          'instrumentation')), lcs))
+
+    def saveProcessedObs(self,filename,srcName=None):
+        lcs = self.lc
+        if srcName != None:
+            lcs = self.lcs[srcName]
         file=open(filename,'w')
-        pickle.dump(self.lc,file)
+        pickle.dump(lcs,file)
 
     def loadProcessedObs(self,filename):
         file=open(filename,'r')
@@ -646,30 +1569,85 @@ class LightCurve:
         for lc in lcs:
             self.lc.append(lc)
 
-    def generateLC(self, verbosity=0):
+    def saveProcessedColumns(self, dirname, srcName=None):
+        """Save the results in the columnar format (see saveColumns), by
+        default those in self.lc, otherwise those for source srcName."""
+        lcs = self.lc
+        if srcName != None:
+            lcs = self.lcs[srcName]
+        saveColumns(lcColumns(lcs), dirname,
+                    dict(version = self.ver, par_names = lcParNames(lcs)))
+
+    def loadProcessedColumns(self, dirname, columns=None, bins=None):
+        """Load results saved in the columnar format, optionally only
+        some columns or a range of time bins (see loadColumns)."""
+        return loadColumns(dirname, columns, bins)
+
+    def generateLC(self, verbosity=0, columns=None, par_names=None):
+        """Generate the light curve and the variability statistics from
+        the results of the time bins. By default the results in self.lc
+        are used, otherwise they can be given in the columnar format (see
+        lcColumns and loadColumns) with the list of parameter names."""
+        if columns == None:
+            columns = lcColumns(self.lc)
+            par_names = lcParNames(self.lc)
+        nbin = len(columns['t_min'])
+
         # First: calculate logL of fixed flux model at true minimum - hoping
-        # it lies somewhere in the profile we computed
-        first = True
-        profile_x = []
-        profile_y = []
-        for lc in self.lc:
-            if first:
-                profile_x = lc['profile']['value']
-                profile_y = lc['profile']['logL']
-                first = False
-            else:
-                profile_y = map(lambda x,y:x+y,lc['profile']['logL'],profile_y)
+        # it lies somewhere in the profile we computed. The profiles of
+        # the bins need not be evaluated at the same points (when they
+        # are computed adaptively) so fit a quadratic to each and sum
+        # the coefficients - with common points this is identical to
+        # fitting the summed profile. All the fits are done together,
+        # in a common scaled variable to keep them well conditioned.
+        # Bins whose profile does not determine a quadratic (too few
+        # distinct points) are left out of the sums, and reported.
+        X = columns['profile_value']
+        Y = columns['profile_logL']
+        xvalid = X[numpy.isfinite(X)]
+        x0 = xvalid.mean()
+        xs = xvalid.max()-xvalid.min()
+        if xs <= 0:
+            xs = 1.0
+        U = (X-x0)/xs
+
+        C = _quadFit(U, Y)
+        good = numpy.all(numpy.isfinite(C), axis=1)
+        bad_bins = map(int, numpy.nonzero(~good)[0])
+        if bad_bins:
+            print "Warning: %d bins with too few profile points are not"\
+                  " used in the profile fit:"%len(bad_bins), bad_bins
+        if not good.any():
+            raise RuntimeError("No time bin has enough profile points to "
+                               "fit the profile")
+        pu = numpy.nansum(C, axis=0)
+        prof_max_u = -pu[1]/(2*pu[2])
+        prof_max_val = x0 + prof_max_u*xs
+        prof_max_logL = pu[0]-pu[1]*pu[1]/(4*pu[2])
+        p = numpy.array([ pu[2]/xs**2, pu[1]/xs-2*pu[2]*x0/xs**2,
+                          pu[0]-pu[1]*x0/xs+pu[2]*x0**2/xs**2 ])
+
+        R = Y[good] - _quadEval(C[good], U[good])
+        Xg = X[good]
+        common_x = numpy.all((Xg == Xg[0]) | (numpy.isnan(Xg) &
+                                              numpy.isnan(Xg[0])))
+        if common_x:
+            profile_x = Xg[0][numpy.isfinite(Xg[0])]
+            profile_y = Y[good].sum(axis=0)[numpy.isfinite(Xg[0])]
+            profile_max_diff = abs(numpy.nansum(R, axis=0)).max()
+        else:
+            profile_x = numpy.unique(xvalid)
+            profile_y = scipy.polyval(p, profile_x)
+            profile_max_diff = numpy.nanmax(abs(R), axis=1).sum()
+        profile_x = list(profile_x)
+        profile_y = list(profile_y)
 
-        p = scipy.polyfit(profile_x, profile_y, 2);
-        prof_max_val = -p[1]/(2*p[0])
-        prof_max_logL = p[2]-p[1]*p[1]/(4*p[0])
         if (prof_max_val<min(profile_x)) or (prof_max_val>max(profile_x)):
             print "Warning: corrected minimum %f is outside profile range [%f to %f]" \
                   %(prof_max_val,min(profile_x),max(profile_x))
             print profile_x, profile_y
 
         profile_fity = scipy.polyval(p,profile_x)
-        profile_max_diff = max(map(lambda x,y:abs(x-y),profile_y,profile_fity))
         if profile_max_diff>0.5:
             print "Warning: large difference between profile and fit: %f"%profile_max_diff
             print profile_x, profile_y, profile_fity
@@ -680,70 +1658,57 @@ class LightCurve:
         # Second: process data for LC, accumulating required values to
         # allow calculation of variability stats
 
-        vals = []
-        pars = []
-        dchi2_specfree     = 0
-        dchi2_normfree     = 0
-        dchi2_normfree_alt = 0
-        dchi2_normfree_ul  = 0
-        allfixed_logL      = 0
-        allfixed_val       = 0
-        npar_specfree      = 0
-        npar_normfree      = 0
-        first = True
-
-        for lc in self.lc:
-            np=lc['original']['normpar_name']
-            if first:
-                pars.append(np)
-                allfixed_val = lc['original']['normpar_init_value']
-            scale=lc['normfree']['flux']/lc['normfree']['pars'][np]['value']
-            val = []
-            val.append(lc['t_min']/86400 + 51910)
-            val.append(lc['t_max']/86400 + 51910)
-            if lc['normfree'].has_key('ul'):
-                val.append(lc['normfree']['ul']['flux'])
-                val.append(0)
-            else:
-                val.append(lc['normfree']['flux'])
-                val.append(lc['normfree']['pars'][np]['error']*scale)
-            val.append(lc['normfree']['ts'])
-            val.append(lc['allfree']['flux'])
-            val.append(lc['allfree']['pars'][np]['error']*scale)
-            for p in lc['allfree']['pars']:
-                if p != np and lc['allfree']['pars'][p]['free'] == True:
-                    if first: pars.append(p)
-                    val.append(lc['allfree']['pars'][p]['value'])
-                    val.append(lc['allfree']['pars'][p]['error'])
-            val.append(lc['allfree']['ts'])
-
-            allfixed_logL += lc['allfixed']['logL']
-            dchi2_specfree += 2*(lc['allfree']['logL']-lc['normfree']['logL'])
-            dchi2_normfree_alt += lc['normfree']['logL']
-            
-            # Arbitrarily assume a quadratic is an OK fit
-            y = lc['profile']['logL']
-            p = scipy.polyfit(profile_x, y, 2);
-            dchi2_normfree += 2*(lc['normfree']['logL']
-                                 - scipy.polyval(p, prof_max_val))
-
-            if (lc['normfree'].has_key('ul') and
-                lc['normfree']['ul']['type'] == 'bayesian'):
-                # Arbitrarily assume a quadratic is an OK fit
-                y = lc['normfree']['ul']['results']['poi_chi2_equiv']
-                p = scipy.polyfit(profile_x, y, 2);
-                dchi2_normfree_ul += scipy.polyval(p, prof_max_val)
-            else:
-                dchi2_normfree_ul += 2*(lc['normfree']['logL']
-                                        - scipy.polyval(p, prof_max_val))
-            if not first:
-                npar_specfree += lc['allfree']['nfree']-lc['normfree']['nfree']
-                npar_normfree += lc['normfree']['nfree']
-            first = False
-
-            vals.append(val)
+        np = str(columns['original_normpar_name'][0])
+        pars = [ np ]
+        for pn in par_names:
+            if pn != np and columns['allfree_par_%s_free'%pn][0] == 1:
+                pars.append(pn)
+        allfixed_val = columns['original_normpar_init_value'][0]
+
+        scale = columns['normfree_flux']/columns['normfree_par_%s_value'%np]
+        has_ul = numpy.isfinite(columns['normfree_ul_flux'])
+        vals = [ columns['t_min']/86400 + 51910,
+                 columns['t_max']/86400 + 51910,
+                 numpy.where(has_ul, columns['normfree_ul_flux'],
+                             columns['normfree_flux']),
+                 numpy.where(has_ul, 0,
+                             columns['normfree_par_%s_error'%np]*scale),
+                 columns['normfree_ts'],
+                 columns['allfree_flux'],
+                 columns['allfree_par_%s_error'%np]*scale ]
+        for pn in pars[1:]:
+            vals.append(columns['allfree_par_%s_value'%pn])
+            vals.append(columns['allfree_par_%s_error'%pn])
+        vals.append(columns['allfree_ts'])
+        vals = numpy.column_stack(vals).tolist()
+
+        allfixed_logL = columns['allfixed_logL'].sum()
+        dchi2_specfree = 2*(columns['allfree_logL']-
+                            columns['normfree_logL']).sum()
+        dchi2_normfree_alt = 2*(columns['normfree_logL'][good].sum()-
+                                prof_max_logL)
+
+        # Arbitrarily assume a quadratic is an OK fit
+        dchi2_bin = 2*(columns['normfree_logL'] -
+                       _quadEval(C, numpy.array([prof_max_u])).flatten())
+        dchi2_normfree = numpy.nansum(dchi2_bin)
+
+        # Arbitrarily assume a quadratic is an OK fit
+        bayes = (columns['normfree_ul_type'] == 'bayesian')
+        dchi2_normfree_ul = numpy.nansum(dchi2_bin[~bayes])
+        good_ul = good & ~bayes
+        if bayes.any():
+            Cul = _quadFit(U[bayes], columns['normfree_ul_poi_chi2_equiv'][bayes])
+            dchi2_normfree_ul += \
+                numpy.nansum(_quadEval(Cul, numpy.array([prof_max_u])))
+            good_ul[bayes] = numpy.all(numpy.isfinite(Cul), axis=1)
+
+        # The bins left out of the sums do not count as degrees of freedom
+        npar_specfree = (columns['allfree_nfree'][1:] -
+                         columns['normfree_nfree'][1:]).sum()
+        npar_normfree = columns['normfree_nfree'][good][1:].sum()
+        npar_normfree_ul = columns['normfree_nfree'][good_ul][1:].sum()
 
-        dchi2_normfree_alt = 2*(dchi2_normfree_alt-prof_max_logL)
         corr_logL = prof_max_logL - allfixed_logL
         
         if(abs(dchi2_normfree-dchi2_normfree_alt) > 0.01):        
@@ -755,6 +1720,7 @@ class LightCurve:
                      dchi2_normfree_ul         = dchi2_normfree_ul,
                      npar_specfree             = npar_specfree,
                      npar_normfree             = npar_normfree,
+                     npar_normfree_ul          = npar_normfree_ul,
                      pars                      = pars,
                      prof_x                    = profile_x,
                      prof_y                    = profile_y,
@@ -762,13 +1728,17 @@ class LightCurve:
                      prof_max_logL             = prof_max_logL,
                      prof_corr_logL            = corr_logL,
                      allfixed_val              = allfixed_val,
-                     allfixed_logL             = allfixed_logL)
+                     allfixed_logL             = allfixed_logL,
+                     bad_profile_bins          = bad_bins)
         return vals, stats
 
     def writeLC(self, filename=None, lc=None, stats=None,
-                header=True, headstart='% ', verbosity=0):
+                header=True, headstart='% ', verbosity=0,
+                columns=None, par_names=None):
         if lc == None or stats == None:
-            [lc, stats] = self.generateLC(verbosity=verbosity)
+            [lc, stats] = self.generateLC(verbosity=verbosity,
+                                          columns=columns,
+                                          par_names=par_names)
         file = sys.stdout
         if filename != None:
             file=open(filename,'w')
@@ -776,18 +1746,15 @@ class LightCurve:
             # print >>file, '%sOptions: %s'%(headstart,' '.join(lc[0]['config']['argv'][1:]))
             chi2 = stats['dchi2_normfree']
             ndof = stats['npar_normfree']
-            prob = MyMath.chi2cdfc(chi2,ndof)
-            sigma = math.sqrt(MyMath.chi2invc(prob,1))
+            [prob, sigma] = chi2sigma(chi2,ndof)
             print >>file, '%sVariable flux (no UL): chi^2=%.3f (%d DOF) - Pr(>X)=%g (~%g sigma)'%(headstart,chi2,ndof,prob,sigma)
             chi2 = stats['dchi2_normfree_ul']
-            ndof = stats['npar_normfree']
-            prob = MyMath.chi2cdfc(chi2,ndof)
-            sigma = math.sqrt(MyMath.chi2invc(prob,1))
+            ndof = stats.get('npar_normfree_ul', stats['npar_normfree'])
+            [prob, sigma] = chi2sigma(chi2,ndof)
             print >>file, '%sVariable flux (w/UL):  chi^2=%.3f (%d DOF) - Pr(>X)=%g (~%g sigma)'%(headstart,chi2,ndof,prob,sigma)
             chi2 = stats['dchi2_specfree']
             ndof = stats['npar_specfree']
-            prob = MyMath.chi2cdfc(chi2,ndof)
-            sigma = math.sqrt(MyMath.chi2invc(prob,1))
+            [prob, sigma] = chi2sigma(chi2,ndof)
             print >>file, '%sVariable spectrum:     chi^2=%.3f (%d DOF) - Pr(>X)=%g (~%g sigma)'%(headstart,chi2,ndof,prob,sigma)
             print >>file, '%sProfile minimum: %f (search range: %f to %f)'%(headstart,stats['prof_max_val'],min(stats['prof_x']),max(stats['prof_x']))
             print >>file, '%sLogL correction: %f (WRT logL @ prescribed val of %g)'%(headstart,stats['prof_corr_logL'],stats['allfixed_val'])
@@ -806,12 +1773,10 @@ class LightCurve:
                 print >>file, '%sColumn %d: Optimized spectral shape: Error on %s'%(headstart,nc+i,pn)
                 nc+=2
             print >>file, '%sColumn %d: Optimized spectral shape: TS'%(headstart,nc+i-1)
-        for p in lc:
-            s = '%.3f %.3f %.3e %.3e %7.2f'%(p[0],p[1],p[2],p[3],p[4])
-            for i in range(5,len(p)-1):
-                s += ' %.3e'%(p[i])
-            s += ' %7.2f'%(p[-1])
-            print >>file, s
+        if lc:
+            fmt = '%.3f %.3f %.3e %.3e %7.2f' + ' %.3e'*(len(lc[0])-6) + \
+                  ' %7.2f'
+            file.write(''.join(map(lambda p: fmt%tuple(p)+'\n', lc)))
 
 
 if __name__ == "__main__":
@@ -831,8 +1796,8 @@ Compute lightcurves from Fermi data. The program opeartes in two modes:
 summary and compute, specified with the --summary (the default) or
 --compute options. In the compute mode one or many Fermi observations
 are analyzed using the pyLikelihood tools to produce a summary file. In
-the summary mode, these summary files are read and the lightcurve is
-produced.
+the summary mode, these summary files (or a single directory written
+with --columns) are read and the lightcurve is produced.
 
 General options:
 
@@ -882,6 +1847,39 @@ Compute mode options:
                  overlap
 
 --opt X          use optimizer X [defaul: %s]
+
+--jobs X         process X time bins concurrently using a pool of worker
+                 processes [default: 1]
+
+--checkpoint X   store the results of each time bin in directory X as it
+                 is finished, and skip bins already found there, so that
+                 an interrupted job can be resumed
+
+--warm_start     start the fits in each time bin from the background
+                 parameters found in the previous bin
+
+--columns X      also write the results in the columnar format to
+                 directory X
+
+--profile_tol X  compute the likelihood profile in each time bin
+                 adaptively, adding points until a quadratic describes it
+                 to within X in log likelihood, rather than at five fixed
+                 points
+
+--sources X      also compute the light curves of the sources in the comma
+                 separated list X, loading each time bin only once. Their
+                 results are written to files named after the output file
+                 with the source name added, e.g. lc_summary_X.dat
+
+--blocks         merge the time bins into Bayesian blocks of constant flux,
+                 found from a first pass which computes only the likelihood
+                 profile in each bin, before the full analysis
+
+--blocks_ts X    merge consecutive time bins until the TS of each block
+                 reaches X, using the same first pass as --blocks
+
+--ncp_prior X    set the penalty per block used by --blocks
+                 [default: 1.32+0.577*log10(number of bins)]
 """%(progname,progname,deflcfn,defsumfn,defirf,defft2,tsmin,\
      ulfluxerror,tsulbayes,tsulchi2,ulcl,opt)
         sys.exit(exitcode)
@@ -891,7 +1889,10 @@ Compute mode options:
         optspec = ( 'help', 'output=', 'v', 'vv', 'vvv',
                     'summary', 'compute', 'binned', 'ft2=', 'irf=', 'tsmin=',
                     'fluxerrorul=', 'tsulchi2=', 'tsulbayes=', 'ulcl=',
-                    'fitmodel=', 'rebin=', 'sliding_window', 'opt=')
+                    'fitmodel=', 'rebin=', 'sliding_window', 'opt=',
+                    'jobs=', 'checkpoint=', 'warm_start', 'profile_tol=',
+                    'columns=', 'sources=', 'blocks', 'blocks_ts=',
+                    'ncp_prior=')
         opts, args = getopt.gnu_getopt(sys.argv[1:], 'vho:', optspec)
     except getopt.GetoptError, err:
         print err
@@ -924,6 +1925,15 @@ Compute mode options:
     sliding    = False
     analysis   = 'unbinned'
     opt        = defopt
+    jobs       = 1
+    checkpoint = None
+    warm       = False
+    proftol    = None
+    columns    = None
+    sources    = []
+    blocks     = None
+    blocks_ts  = 25.0
+    ncp_prior  = None
 
     for o, a in opts:
         if o in ('-h', '--help'):
@@ -965,11 +1975,35 @@ Compute mode options:
             sliding = True
         elif o in ('--opt'):
             opt = a
+        elif o in ('--jobs'):
+            jobs = int(a)
+        elif o in ('--checkpoint'):
+            checkpoint = a
+        elif o in ('--warm_start'):
+            warm = True
+        elif o in ('--profile_tol'):
+            proftol = float(a)
+        elif o in ('--columns'):
+            columns = a
+        elif o in ('--sources'):
+            sources = a.split(',')
+        elif o in ('--blocks'):
+            blocks = 'bayesian'
+        elif o in ('--blocks_ts'):
+            blocks = 'ts'
+            blocks_ts = float(a)
+        elif o in ('--ncp_prior'):
+            ncp_prior = float(a)
 
     if mode=="summary":
         lc=LightCurve()
         if output == None:
             output = deflcfn
+        if len(args)==1 and os.path.isdir(args[0]):
+            [columns, meta] = lc.loadProcessedColumns(args[0])
+            lc.writeLC(output,verbosity=verbose,columns=columns,
+                       par_names=meta['par_names'])
+            sys.exit(0)
         if len(args)==0:
             lc.loadProcessedObs(defsumfn)
         for f in args:
@@ -981,6 +2015,7 @@ Compute mode options:
             smallHelp()
         source_name = args[0]
         args=args[1:]
+        sources = filter(lambda s: s != source_name, sources)
         if output == None:
             output = defsumfn
         lc=LightCurve(srcName=source_name,ft2=ft2,irfs=irf,model=srcmodel,\
@@ -990,8 +2025,35 @@ Compute mode options:
                                   sliding_window = sliding)
         if(ulchi2<0): ulchi2=None
         if(ulbayes<0): ulbayes=None
+        if blocks != None:
+            lc.adaptiveBinning(method=blocks, ncp_prior=ncp_prior,
+                               ts_min=blocks_ts, verbosity=verbose,
+                               delete_below_ts=tsmin, profile_tol=proftol,
+                               workers=jobs)
+        # The checkpoint directory replaces the (costly) interim save
+        interim = output
+        if checkpoint != None:
+            interim = None
         lc.processAllObs(verbosity=verbose, delete_below_ts=tsmin,
                          ul_chi2_ts=ulchi2, ul_flux_dflux = ulflxdf,
                          ul_bayes_ts=ulbayes, ul_cl=ulcl,
-                         interim_save_filename=output)
+                         interim_save_filename=interim, workers=jobs,
+                         checkpoint_dir=checkpoint, warm_start=warm,
+                         profile_tol=proftol,
+                         srcNames=[ source_name ] + sources)
+        if verbose:
+            instrumentation = lc.ulInstrumentation()
+            print 'Upper limits: %d, exact evaluations: %d (%.1f s), '\
+                  'total time: %.1f s'%(instrumentation['ncalc'],
+                                        instrumentation['exact_calls'],
+                                        instrumentation['exact_time'],
+                                        instrumentation['total_time'])
+        if checkpoint != None:
+            lc.saveProcessedObs(output)
+            for s in sources:
+                lc.saveProcessedObs(lcSourceFilename(output, s), s)
+        if columns != None:
+            lc.saveProcessedColumns(columns)
+            for s in sources:
+                lc.saveProcessedColumns(lcSourceFilename(columns, s), s)
         
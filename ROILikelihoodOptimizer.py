@@ -16,19 +16,62 @@ import os.path
 import numpy
 import math
 import pickle
+import time
+import multiprocessing
 
 import pyLikelihood as pyLike
 from LikelihoodState import LikelihoodState
 
+# Likelihood object inherited by the worker processes that calculate the
+# full TS, which are forked after it is fitted
+_ts_like = None
+
+def _fullTsWorker(sn):
+    """Internal function which calculates the full (reoptimized) TS of a
+    source in a worker process. Not intended for use outside of this
+    package."""
+    return _ts_like.Ts(sn,reoptimize=True)
+
 class ROILikelihoodOptimizer:
-    """Class to optimize Likelihood of ROI model (a replacement for gtlike)."""
+    """Class to optimize Likelihood of ROI model (a replacement for gtlike).
+
+    The approximate TS of each free point source (TS_approx) is
+    calculated without refitting the model. When the model is fitted by
+    run, the Wald estimate of the TS, (N/sigma_N)^2, is also calculated
+    from the normalization and its error (TS_wald). The full TS, which
+    refits the model without the source, is calculated for the sources
+    of interest, for all sources if calculate_full_ts_for_all is set,
+    and otherwise for the sources whose significance, sqrt(TS_wald), or
+    sqrt(TS_approx) without a fit, is within full_ts_margin_sigma of
+    sqrt(full_ts_threshold), using full_ts_workers processes.
+
+    With freeze_nuisance_sources_iteratively the model is first fitted
+    with a tolerance coarse_tol_factor times larger than tol, and the
+    sources that are uncorrelated with the sources of interest (all
+    correlation coefficients below nuisance_corr_max) or that pass the
+    Npred and separation cuts used for the other freezing options are
+    frozen. This is repeated, up to max_freeze_iterations times, until
+    no more sources are frozen, before the final fit with tolerance
+    tol. The sources frozen, the time taken and the change in log
+    likelihood are reported in res['nuisance_freezing']. If
+    check_nuisance_freezing is set the model is also fitted with all
+    sources free, to measure the speedup and the exact change in log
+    likelihood."""
     def __init__(self, like, sourcesOfInterest=None, optimizer="Minuit",
                  tol=1e-8, chatter=3, 
                  freeze_nuisance_sources_immediately = False,
                  freeze_nuisance_sources_after_optimize = False,
                  nuisance_npred_frac_max = 0.05,
                  nuisance_soi_sep_min_deg = 5.0,
-                 calculate_full_ts_for_all = False):
+                 calculate_full_ts_for_all = False,
+                 full_ts_threshold = None,
+                 full_ts_margin_sigma = 2.0,
+                 full_ts_workers = 1,
+                 freeze_nuisance_sources_iteratively = False,
+                 nuisance_corr_max = 0.1,
+                 coarse_tol_factor = 1000.0,
+                 max_freeze_iterations = 3,
+                 check_nuisance_freezing = False):
         self.ver = "$Id$"
         self.res = {}
         self._like = like
@@ -41,6 +84,15 @@ class ROILikelihoodOptimizer:
         self._nuisance_npred_frac_max = nuisance_npred_frac_max
         self._nuisance_soi_sep_min_deg = nuisance_soi_sep_min_deg
         self._calculate_full_ts_for_all = calculate_full_ts_for_all
+        self._full_ts_threshold = full_ts_threshold
+        self._full_ts_margin_sigma = full_ts_margin_sigma
+        self._full_ts_workers = full_ts_workers
+        self._freeze_nuisance_iteratively = \
+            freeze_nuisance_sources_iteratively
+        self._nuisance_corr_max = nuisance_corr_max
+        self._coarse_tol_factor = coarse_tol_factor
+        self._max_freeze_iterations = max_freeze_iterations
+        self._check_nuisance_freezing = check_nuisance_freezing
 
         if sourcesOfInterest is not None:
             if type(sourcesOfInterest) != list:
@@ -106,6 +158,191 @@ class ROILikelihoodOptimizer:
             self._like.syncSrcParams(sn)
         return nuisance_sources
 
+    def _uncorrelatedSourceNames(self, SOI = None, corr_max = None):
+        # Sources with free parameters whose correlation coefficients
+        # with all the free parameters of the sources of interest, from
+        # the covariance matrix of the last fit, are below corr_max. If
+        # the sources of interest have no free parameters there is
+        # nothing to be correlated with, and no source is returned
+        if SOI is None:
+            SOI = self._SOI
+        if type(SOI) != list:
+            SOI = [ SOI ]
+        if corr_max is None:
+            corr_max = self._nuisance_corr_max
+        cov = numpy.array(self._like.optObject.covarianceMatrix())
+        ifree = {}
+        nfree = 0
+        for p in self._like.params():
+            if p.isFree():
+                if not ifree.has_key(p.srcName):
+                    ifree[p.srcName] = []
+                ifree[p.srcName].append(nfree)
+                nfree += 1
+        if cov.shape != (nfree, nfree):
+            return []
+        sig = numpy.sqrt(numpy.abs(numpy.diag(cov)))
+        sig[sig==0] = 1
+        corr = numpy.abs(cov/numpy.outer(sig, sig))
+        isoi = []
+        for sn in SOI:
+            isoi.extend(ifree.get(sn, []))
+        if len(isoi) == 0:
+            return []
+        uncorrelated = []
+        for sn in self._like.sourceNames():
+            if sn in SOI or not ifree.has_key(sn):
+                continue
+            if corr[numpy.ix_(ifree[sn], isoi)].max() < corr_max:
+                uncorrelated.append(sn)
+        return uncorrelated
+
+    def _freezeIteratively(self):
+        # Fit with a coarse tolerance and freeze the nuisance sources,
+        # repeating until no more are frozen. The tolerance is put back
+        # for the final fit, which is done by run
+        L = self._like
+        info = {}
+        if self._check_nuisance_freezing:
+            state = LikelihoodState(L)
+            t0 = time.time()
+            L.fit(0)
+            info['time_full_fit'] = time.time()-t0
+            info['logL_full']     = L.logLike.value()
+            state.restore()
+        nfree_initial = 0
+        for p in L.params():
+            if p.isFree():
+                nfree_initial += 1
+        tol = L.tol
+        L.tol = tol*self._coarse_tol_factor
+        frozen = []
+        info['logL_coarse'] = []
+        t0 = time.time()
+        try:
+            for niter in range(self._max_freeze_iterations):
+                L.fit(0,covar=True)
+                info['logL_coarse'].append(L.logLike.value())
+                # Only sources that still have free parameters, since
+                # the Npred cut does not look at the free flags
+                freeze = []
+                for sn in self._uncorrelatedSourceNames() + \
+                        self._nuisanceSourceNames():
+                    if not sn in freeze and not sn in frozen and \
+                           len(L.freePars(sn)) > 0:
+                        freeze.append(sn)
+                if len(freeze) == 0:
+                    break
+                # Never freeze the whole model
+                nfree_left = 0
+                for sn in L.sourceNames():
+                    if not sn in freeze:
+                        nfree_left += len(L.freePars(sn))
+                if nfree_left == 0:
+                    if self._chatter > 0:
+                        print "Not freezing",len(freeze),"sources,",\
+                              "which would leave no free parameters"
+                    break
+                for sn in freeze:
+                    if self._chatter > 0:
+                        print "Freezing source:",sn
+                    srcfreepar = L.freePars(sn)
+                    L.setFreeFlag(sn, srcfreepar, False)
+                    L.syncSrcParams(sn)
+                frozen.extend(freeze)
+        finally:
+            L.tol = tol
+        info['time_coarse_fit'] = time.time()-t0
+        info['n_iterations']    = len(info['logL_coarse'])
+        info['frozen']          = frozen
+        info['nfree_initial']   = nfree_initial
+        nfree_final = 0
+        for p in L.params():
+            if p.isFree():
+                nfree_final += 1
+        info['nfree_final']     = nfree_final
+        return info
+
+    def _waldTS(self, sn):
+        # Wald estimate of the TS, (N/sigma_N)^2, from the normalization
+        # and its error given by the covariance matrix of the last fit,
+        # or None if the normalization has no error
+        normpar = self._like.normPar(sn)
+        if normpar.isFree() and normpar.error() > 0:
+            return (normpar.getValue()/normpar.error())**2
+        return None
+
+    def _fullTsSourceNames(self, ts_est):
+        # Sources for which the full TS is needed: the sources of
+        # interest, and those whose estimated significance is within
+        # full_ts_margin_sigma of that of the threshold, closest first
+        full = []
+        for sn in self._SOI:
+            if ts_est.has_key(sn):
+                full.append(sn)
+        sqrt_thresh = math.sqrt(self._full_ts_threshold or 0)
+        dsigma = {}
+        for sn in ts_est:
+            dsigma[sn] = abs(math.sqrt(max(ts_est[sn],0)) - sqrt_thresh)
+        near = []
+        for sn in ts_est:
+            if self._calculate_full_ts_for_all or \
+                   (self._full_ts_threshold is not None and
+                    dsigma[sn] <= self._full_ts_margin_sigma):
+                near.append(sn)
+        near.sort(key = lambda sn: dsigma[sn])
+        for sn in near:
+            if not sn in full:
+                full.append(sn)
+        return full
+
+    def _calculateTS(self, have_cov):
+        # Approximate TS of all free point sources, Wald estimate if the
+        # covariance matrix of the current fit is available, and full TS
+        # of the sources selected by _fullTsSourceNames from the Wald
+        # estimate (or the approximate TS where there is none),
+        # calculated in parallel by full_ts_workers processes forked
+        # from this one
+        global _ts_like
+        L = self._like
+        ts_approx = {}
+        ts_wald = {}
+        ts_select = {}
+        for sn in L.sourceNames():
+            ss = L[sn].src
+            if not ss.fixedSpectrum() and ss.getType() == 'Point':
+                if self._chatter > 0:
+                    print "Calculating approximate TS for:",sn
+                ts_approx[sn] = L.Ts(sn,reoptimize=False)
+                ts_select[sn] = ts_approx[sn]
+                if have_cov:
+                    ts = self._waldTS(sn)
+                    if ts is not None:
+                        ts_wald[sn] = ts
+                        ts_select[sn] = ts
+        full = self._fullTsSourceNames(ts_select)
+        ts_full = {}
+        if self._full_ts_workers > 1 and len(full) > 1:
+            if self._chatter > 0:
+                print "Calculating full TS for %d sources with %d workers"\
+                      %(len(full),self._full_ts_workers)
+            _ts_like = L
+            pool = multiprocessing.Pool(self._full_ts_workers)
+            try:
+                ts = pool.map(_fullTsWorker, full)
+            finally:
+                pool.terminate()
+                pool.join()
+                _ts_like = None
+            for isrc in range(len(full)):
+                ts_full[full[isrc]] = ts[isrc]
+        else:
+            for sn in full:
+                if self._chatter > 0:
+                    print "Calculating full TS for:",sn
+                ts_full[sn] = L.Ts(sn,reoptimize=True)
+        return [ ts_approx, ts_wald, ts_full ]
+
     def restoreOriginalState():
         self._original_state.restore()
 
@@ -126,8 +363,14 @@ class ROILikelihoodOptimizer:
                 for sn in nuisance_sources:
                     print "Freezing source:",sn 
 
+        freeze_info = None
+        if(self._freeze_nuisance_iteratively):
+            freeze_info = self._freezeIteratively()
+
+        t0 = time.time()
         if not noFit:
-            L.fit()
+            L.fit(covar=True)
+        t_fit = time.time()-t0
      
         res = {}
         res['version']                  = self.ver
@@ -135,6 +378,34 @@ class ROILikelihoodOptimizer:
         res['fit_state']                = L.optObject.getRetCode()
         res['cov_matrix']               = L.optObject.covarianceMatrix()
 
+        if freeze_info is not None:
+            # The change in log likelihood from the first coarse fit,
+            # with all sources free, is only an estimate since that fit
+            # is not fully converged; the full fit gives the exact value
+            freeze_info['time_final_fit'] = t_fit
+            freeze_info['time_total']     = \
+                freeze_info['time_coarse_fit'] + t_fit
+            freeze_info['dlogL_coarse']   = \
+                res['like_val'] - freeze_info['logL_coarse'][0]
+            if freeze_info.has_key('logL_full'):
+                freeze_info['dlogL']      = \
+                    res['like_val'] - freeze_info['logL_full']
+                if freeze_info['time_total'] > 0:
+                    freeze_info['speedup'] = \
+                        freeze_info['time_full_fit']/freeze_info['time_total']
+            res['nuisance_freezing']      = freeze_info
+            if self._chatter > 0:
+                print "Froze %d sources, %d of %d parameters free"\
+                      %(len(freeze_info['frozen']),
+                        freeze_info['nfree_final'],
+                        freeze_info['nfree_initial'])
+                if freeze_info.has_key('speedup'):
+                    print "Speedup: %.2f, change in log likelihood: %g"\
+                          %(freeze_info['speedup'],freeze_info['dlogL'])
+
+        [ ts_approx, ts_wald, ts_full ] = self._calculateTS(not noFit)
+        res['n_full_ts']                = len(ts_full)
+
         res['src'] = {}
         npred_total = 0
         nfree_param = 0
@@ -146,14 +417,12 @@ class ROILikelihoodOptimizer:
             src_info["type"]            = ss.getType()
             src_info["fixed"]           = ss.fixedSpectrum()
 
-            if not src_info["fixed"] and src_info["type"] == 'Point':
-                if self._chatter > 0:
-                    print "Calculating approximate TS for:",sn
-                src_info['TS_approx']   = L.Ts(sn,reoptimize=False)
-                if sn in self._SOI or self._calculate_full_ts_for_all:
-                    if self._chatter > 0:
-                        print "Calculating full TS for:",sn
-                    src_info['TS']      = L.Ts(sn,reoptimize=True)
+            if ts_approx.has_key(sn):
+                src_info['TS_approx']   = ts_approx[sn]
+            if ts_wald.has_key(sn):
+                src_info['TS_wald']     = ts_wald[sn]
+            if ts_full.has_key(sn):
+                src_info['TS']          = ts_full[sn]
 
             # Spectrum parameters
             spec = ss.spectrum()
@@ -0,0 +1,85 @@
+# -*-mode:python; mode:font-lock;-*-
+"""
+@file ResultCheckpoint.py
+
+@brief Class to store the results of processing individual observations
+       (light curve time bins, spectral bands) so that a long job can be
+       resumed.
+
+@author Stephen Fegan <sfegan@llr.in2p3.fr>
+
+$Id$
+"""
+
+import os
+import os.path
+import pickle
+import hashlib
+import tempfile
+
+def _canonical(x):
+    """Internal function which converts nested dictionaries and lists
+    into a form whose repr does not depend on dictionary ordering. Not
+    intended for use outside of this package."""
+    if type(x) == dict:
+        keys = x.keys()
+        keys.sort()
+        return tuple(map(lambda k: (k, _canonical(x[k])), keys))
+    elif type(x) in (list, tuple):
+        return tuple(map(_canonical, x))
+    return x
+
+class ResultCheckpoint:
+    """Class to store the results of processing observations, one record
+    per observation in its own file in a checkpoint directory. Each
+    record is keyed by a hash of the files that make up the observation
+    and of the configuration used to process it, including the contents
+    of files such as the model that may be rewritten under the same
+    name, so that results computed with a different configuration are
+    never reused. Records are written to a temporary file and renamed
+    into place, so a job that is killed never leaves a partial record
+    behind."""
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, files, config, contents=None):
+        """Return the key of the record for the observation made up
+        from the given files, processed with the given configuration.
+        The contents of the files named in the list "contents" (for
+        example the model) are also hashed; a missing file is hashed by
+        its name only."""
+        if contents is None:
+            contents = []
+        h = hashlib.md5()
+        h.update(repr(_canonical(files)))
+        h.update(repr(_canonical(config)))
+        for filename in contents:
+            h.update(filename)
+            if os.path.isfile(filename):
+                file = open(filename,'rb')
+                h.update(file.read())
+                file.close()
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def has(self, key):
+        return os.path.isfile(self.filename(key))
+
+    def load(self, key):
+        file = open(self.filename(key),'r')
+        record = pickle.load(file)
+        file.close()
+        return record
+
+    def save(self, key, record):
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, prefix='.tmp_')
+        file = os.fdopen(fd, 'w')
+        pickle.dump(record, file)
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        os.rename(tmpname, self.filename(key))
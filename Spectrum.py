@@ -17,11 +17,97 @@ import glob
 import os.path
 import math
 import pickle
+import copy
+import collections
+import multiprocessing
 import scipy.stats
 import UnbinnedAnalysis
 import BinnedAnalysis
 import SummedLikelihood
 import IntegralUpperLimit
+import ResultCheckpoint
+import ComponentCache
+
+def _bandObsFiles(f):
+    """Internal function which returns the files of the broadband
+    observation from which an energy band is taken, i.e. the files of
+    the band without its energy range. Not intended for use outside of
+    this package."""
+    f = dict(f)
+    for k in ('emin', 'emax'):
+        if f.has_key(k):
+            del f[k]
+    return f
+
+def _bandEdges(like, emin, emax):
+    """Internal function which returns the edges of the energy bins of
+    a binned likelihood closest to emin and emax. Not intended for use
+    outside of this package."""
+    energies = list(like.energies)
+    kmin = 0
+    kmax = len(energies)-1
+    for k in range(len(energies)):
+        if abs(energies[k]-emin) < abs(energies[kmin]-emin):
+            kmin = k
+        if abs(energies[k]-emax) < abs(energies[kmax]-emax):
+            kmax = k
+    if kmax <= kmin:
+        raise ValueError("Energy band %g to %g MeV contains no bins"
+                         %(emin,emax))
+    return [ energies[kmin], energies[kmax] ]
+
+def _seedParams(like, values):
+    """Internal function which sets the spectral parameters of the
+    sources in a likelihood object to the true values given in a
+    dictionary indexed by source and parameter name, clipped to the
+    bounds of the parameters. Not intended for use outside of this
+    package."""
+    nseed = 0
+    sync_name = ""
+    for p in like.params():
+        if not values.has_key(p.srcName) or \
+               not values[p.srcName].has_key(p.getName()):
+            continue
+        if sync_name != "" and sync_name != p.srcName:
+            like.syncSrcParams(sync_name)
+        [ lo, hi ] = p.getBounds()
+        v = values[p.srcName][p.getName()]/p.getScale()
+        p.setValue(min(max(v, lo), hi))
+        nseed += 1
+        sync_name = p.srcName
+    if sync_name != "":
+        like.syncSrcParams(sync_name)
+    return nseed
+
+def _freezeFaintSources(like, srcName, npred_frac_max):
+    """Internal function which freezes all the parameters of the sources,
+    other than srcName, whose Npred is below a fraction npred_frac_max of
+    the total Npred of the model, returning their names. Not intended for
+    use outside of this package."""
+    npred = dict()
+    npred_total = 0
+    for sn in like.sourceNames():
+        npred[sn] = like.NpredValue(sn)
+        npred_total += npred[sn]
+    npred_thresh = npred_total * npred_frac_max
+    frozen = []
+    for sn in like.sourceNames():
+        srcfreepar = like.freePars(sn)
+        if sn == srcName or len(srcfreepar) == 0 or npred[sn] >= npred_thresh:
+            continue
+        like.setFreeFlag(sn, srcfreepar, False)
+        like.syncSrcParams(sn)
+        frozen.append(sn)
+    return frozen
+
+def _processObsWorker(spec, f, kwargs, checkpoint=None, key=None):
+    """Internal function run by the worker processes of
+    Spectrum.processAllObs to process one energy band. Not intended for
+    use outside of this package."""
+    spect = spec.processObs(f, **kwargs)
+    if checkpoint != None:
+        checkpoint.save(key, spect)
+    return spect
 
 class Spectrum:
     """Class to calculate spectra."""
@@ -52,7 +138,7 @@ class Spectrum:
                           analysis='unbinned'):
         prefix = directory+"/"+self.srcName
         ecube = prefix + "_expCube.fits"
-        if self.model.find('/'):
+        if '/' in self.model:
             model = self.model
         else:
             model = directory + "/" + self.model
@@ -68,6 +154,40 @@ class Spectrum:
             raise NameError("Unknown analysis type: \""+f['analysis']+
                             "\" for directory \""+directory+"\"")
 
+    def addStandardBandsDir(self, directory, ebounds, irfs=None,
+                            analysis='binned'):
+        """Add the energy bands with edges ebounds (in MeV) from the
+        broadband observation in a standard directory, see
+        addBinnedBands. Only binned observations can be used."""
+        if analysis != 'binned':
+            raise NameError("Energy bands can only be taken from a binned "+
+                            "observation, not \""+analysis+
+                            "\", for directory \""+directory+"\"")
+        prefix = directory+"/"+self.srcName
+        ecube = prefix + "_expCube.fits"
+        if '/' in self.model:
+            model = self.model
+        else:
+            model = directory + "/" + self.model
+        smaps = prefix + "_srcMaps.fits"
+        bemap = prefix + "_binExpMap.fits"
+        self.addBinnedBands(smaps, bemap, ecube, model, ebounds, irfs)
+
+    def addBinnedBands(self, smaps, bemap, ecube, model, ebounds, irfs=None):
+        """Add energy bands with edges ebounds (a list of energies in
+        MeV) which are all fitted from one broadband binned observation.
+        The observation is loaded once (when the bands are processed
+        serially) and restricted to each band in turn with
+        setEnergyRange, so the data are prepared only once for the whole
+        spectrum. The edges are moved to the nearest edges of the energy
+        bins of the observation. Unbinned observations cannot be used in
+        this way, since their events and exposure are selected for a
+        fixed energy range."""
+        for iband in range(len(ebounds)-1):
+            self.addBinnedObs(smaps, bemap, ecube, model, irfs)
+            self.obsfiles[-1]['emin'] = ebounds[iband]
+            self.obsfiles[-1]['emax'] = ebounds[iband+1]
+
     def addUnbinnedObs(self, ft1, emap, ecube, model, ft2=None, irfs=None):
         if ft2 != None: _ft2 = ft2
         else: _ft2 = self.ft2
@@ -138,147 +258,338 @@ class Spectrum:
         else:
             raise NameError("Unknown analysis type: \""+f['analysis']+"\"")
 
+    def globalFit(self, verbosity=0):
+        """Fit the model to the full energy range of the observations,
+        returning the true values of the spectral parameters of all the
+        sources as a dictionary indexed by source and parameter name,
+        suitable for the global_fit argument of processAllObs. Energy
+        bands taken from one broadband observation are fitted together
+        by loading it once, otherwise the observations of all the bands
+        are summed."""
+        broadband = []
+        for f in self.obsfiles:
+            bf = _bandObsFiles(f)
+            if not bf in broadband:
+                broadband.append(bf)
+        if len(broadband) == 1:
+            [ obs, like ] = self.loadObs(broadband[0],verbosity)
+        else:
+            like = SummedLikelihood.SummedLikelihood(self.optimizer)
+            for bf in broadband:
+                [ obs, like1 ] = self.loadObs(bf,verbosity)
+                like.addComponent(like1)
+
+        if verbosity > 1:
+            print '- Global fit - starting'
+        like.fit(max(verbosity-3, 0))
+        if verbosity > 1:
+            print '- Global fit - log Like:',like.logLike.value()
+
+        values = dict()
+        for p in like.params():
+            if not values.has_key(p.srcName):
+                values[p.srcName] = dict()
+            values[p.srcName][p.getName()] = p.getTrueValue()
+        return values
+
     def processAllObs(self, fix_shape=True, delete_below_ts=None,
                       ul_flux_dflux=0,ul_chi2_ts=None, ul_bayes_ts=4.0,
-                      ul_cl = 0.95, verbosity=0, ul_optimizer=None):
-        for f in self.obsfiles:
-            spect = dict()
-            spect['config']=dict()
-            spect['config']['fix_shape'] = fix_shape
-            spect['config']['delete_below_ts'] = delete_below_ts
-            spect['config']['ul_flux_dflux'] = ul_flux_dflux
-            spect['config']['ul_chi2_ts'] = ul_chi2_ts
-            spect['config']['ul_bayes_ts'] = ul_bayes_ts
-            spect['config']['ul_cl'] = ul_cl
-            spect['config']['files'] = f
+                      ul_cl = 0.95, verbosity=0, ul_optimizer=None,
+                      checkpoint_dir=None, workers=1, max_loaded=None,
+                      global_fit=None, freeze_npred_frac=None):
+        """Process all energy bands, appending one result dictionary
+        per band to self.spectra. If checkpoint_dir is given the result
+        of each band is stored there as soon as it is finished, and
+        bands whose results are already in the directory (with the same
+        configuration) are not processed again. If workers>1 the bands
+        are processed concurrently by a pool of that many processes, and
+        their results appended in band order. Each process loads one
+        observation at a time and is replaced after each band, so that
+        the memory used by the observation is released; max_loaded, if
+        given, limits the number of processes and so the number of
+        observations loaded at once. Energy bands taken from one
+        broadband observation (see addBinnedBands) share the loaded
+        observation when they are processed serially; with workers>1
+        each band loads it again. If global_fit is True the model is
+        first fitted to the full energy range (see globalFit), and the
+        fit of each band is started from the resulting parameter values;
+        a dictionary returned by an earlier call to globalFit can also be
+        given. See processObs for freeze_npred_frac."""
+        if global_fit == True:
+            global_fit = self.globalFit(verbosity)
+        kwargs = dict(fix_shape=fix_shape, delete_below_ts=delete_below_ts,
+                      ul_flux_dflux=ul_flux_dflux, ul_chi2_ts=ul_chi2_ts,
+                      ul_bayes_ts=ul_bayes_ts, ul_cl=ul_cl,
+                      verbosity=verbosity, ul_optimizer=ul_optimizer,
+                      global_fit=global_fit,
+                      freeze_npred_frac=freeze_npred_frac)
+
+        checkpoint = None
+        keys = [ None ] * len(self.obsfiles)
+        if checkpoint_dir != None:
+            checkpoint = ResultCheckpoint.ResultCheckpoint(checkpoint_dir)
+            config = dict(kwargs)
+            del config['verbosity']
+            config['srcName']   = self.srcName
+            config['optimizer'] = self.optimizer
+            for ifile in range(len(self.obsfiles)):
+                f = self.obsfiles[ifile]
+                keys[ifile] = checkpoint.key(f, config, [ f['model'] ])
+
+        if max_loaded != None and workers != None:
+            workers = min(workers, max(max_loaded, 1))
+
+        if workers == None or workers <= 1:
+            # Bands taken from the same broadband observation share it
+            component_cache = ComponentCache.ComponentCache(1)
+            for ifile in range(len(self.obsfiles)):
+                if checkpoint != None and checkpoint.has(keys[ifile]):
+                    if verbosity:
+                        print 'Using checkpointed band:',keys[ifile]
+                    self.spectra.append(checkpoint.load(keys[ifile]))
+                    continue
+                spect = self.processObs(self.obsfiles[ifile],
+                                        component_cache=component_cache,
+                                        **kwargs)
+                if checkpoint != None:
+                    checkpoint.save(keys[ifile], spect)
+                self.spectra.append(spect)
+            return
 
+        # Send the workers a copy of this object without the results
+        # accumulated so far, since they are pickled with every task
+        worker_spec = copy.copy(self)
+        worker_spec.spectra = []
+
+        # Keep a bounded number of bands in flight and collect them in
+        # band order. The workers write their results to the checkpoint
+        # directory themselves, so that bands finished out of order are
+        # not lost
+        pool = multiprocessing.Pool(workers, maxtasksperchild=1)
+        try:
+            pending = collections.deque()
+            ifile = 0
+            while ifile < len(self.obsfiles) or pending:
+                while ifile < len(self.obsfiles) and \
+                          len(pending) < 2*workers:
+                    if checkpoint != None and checkpoint.has(keys[ifile]):
+                        if verbosity:
+                            print 'Using checkpointed band:',keys[ifile]
+                        pending.append([ checkpoint.load(keys[ifile]),
+                                         None ])
+                    else:
+                        pending.append([ None, pool.apply_async(
+                                    _processObsWorker,
+                                    (worker_spec, self.obsfiles[ifile],
+                                     kwargs, checkpoint, keys[ifile])) ])
+                    ifile += 1
+                [ spect, async_result ] = pending.popleft()
+                if async_result != None:
+                    spect = async_result.get()
+                self.spectra.append(spect)
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+
+    def processObs(self, f, fix_shape=True, delete_below_ts=None,
+                   ul_flux_dflux=0,ul_chi2_ts=None, ul_bayes_ts=4.0,
+                   ul_cl = 0.95, verbosity=0, ul_optimizer=None,
+                   component_cache=None, global_fit=None,
+                   freeze_npred_frac=None):
+        """Process one energy band, returning the dictionary of results
+        for the band. If the band is taken from a broadband observation
+        (it has "emin" and "emax" entries) the likelihood is restricted
+        to it, and the observation is taken from component_cache (a
+        ComponentCache), if given, and left there for other bands.
+
+        If global_fit is given (a dictionary returned by globalFit) the
+        spectral parameters of the sources are set to its values before
+        the band is fitted. Since the full spectral model is kept, this
+        scales each source to the band by its fitted spectral shape, and
+        the fit starts close to its minimum. If freeze_npred_frac is
+        given, all the parameters of the sources (other than the source
+        of interest) that predict fewer than this fraction of the counts
+        in the band are frozen before the fit."""
+        spect = dict()
+        spect['config']=dict()
+        spect['config']['fix_shape'] = fix_shape
+        spect['config']['delete_below_ts'] = delete_below_ts
+        spect['config']['ul_flux_dflux'] = ul_flux_dflux
+        spect['config']['ul_chi2_ts'] = ul_chi2_ts
+        spect['config']['ul_bayes_ts'] = ul_bayes_ts
+        spect['config']['ul_cl'] = ul_cl
+        spect['config']['global_fit'] = (global_fit != None)
+        spect['config']['freeze_npred_frac'] = freeze_npred_frac
+        spect['config']['files'] = f
+
+        snapshot = None
+        if f.has_key('emin'):
+            if f['analysis'] != 'binned':
+                raise NameError("Energy bands can only be taken from a "+
+                                "binned observation")
+            if component_cache != None:
+                [ obs, like ] = component_cache.get(_bandObsFiles(f),
+                                                    self.loadObs, verbosity)
+                snapshot = ComponentCache.LikelihoodSnapshot(like)
+            else:
+                [ obs, like ] = self.loadObs(_bandObsFiles(f),verbosity)
+            [emin, emax] = _bandEdges(like, f['emin'], f['emax'])
+            like.setEnergyRange(emin, emax)
+        else:
             [ obs, like ] = self.loadObs(f,verbosity)
-
-            spect['t_min'] = obs.roiCuts().minTime()
-            spect['t_max'] = obs.roiCuts().maxTime()
             [emin, emax] = obs.roiCuts().getEnergyCuts()
-            spect['e_min'] = emin
-            spect['e_max'] = emax
-            
-            if verbosity > 1:
-                print '- Time:',spect['t_min'],'to',spect['t_max']
-                print '- Energy:',emin,'to',emax,'MeV'
-
-            src = like[self.srcName]
-            if src == None:
-                raise NameError("No source \""+self.srcName+"\" in model "+
-                                self.model)
-            srcnormpar=like.normPar(self.srcName)
-
-            spect['original']=dict()
-            spect['original']['normpar_init_value'] = srcnormpar.getValue()
-            spect['original']['normpar_name'] = srcnormpar.getName()
-            spect['original']['flux'] = like[self.srcName].flux(emin, emax)
-            spect['original']['logL'] = like.logLike.value()
+
+        spect['t_min'] = obs.roiCuts().minTime()
+        spect['t_max'] = obs.roiCuts().maxTime()
+        spect['e_min'] = emin
+        spect['e_max'] = emax
+        
+        if verbosity > 1:
+            print '- Time:',spect['t_min'],'to',spect['t_max']
+            print '- Energy:',emin,'to',emax,'MeV'
+
+        src = like[self.srcName]
+        if src == None:
+            raise NameError("No source \""+self.srcName+"\" in model "+
+                            self.model)
+        if global_fit != None:
+            nseed = _seedParams(like, global_fit)
             if verbosity > 1:
-                print '- Original log Like:',spect['original']['logL']
+                print '- Starting from global fit:',nseed,'parameters'
 
-            if fix_shape:
-                if verbosity > 1:
-                    print '- Fixing spectral shape parameters'
-                sync_name = ""
-                for p in like.params():
-                    if sync_name != "" and sync_name != p.srcName:
-                        like.syncSrcParams(sync_name)
-                        sync_name = ""
-                    if(p.isFree() and #p.srcName!=self.srcName and
-                       p.getName()!=like.normPar(p.srcName).getName()):
-                        if verbosity > 2:
-                            print '-- '+p.srcName+'.'+p.getName()
-                        p.setFree(False)
-                        sync_name = p.srcName
+        srcnormpar=like.normPar(self.srcName)
+
+        spect['original']=dict()
+        spect['original']['normpar_init_value'] = srcnormpar.getValue()
+        spect['original']['normpar_name'] = srcnormpar.getName()
+        spect['original']['flux'] = like[self.srcName].flux(emin, emax)
+        spect['original']['logL'] = like.logLike.value()
+        if verbosity > 1:
+            print '- Original log Like:',spect['original']['logL']
+
+        if fix_shape:
+            if verbosity > 1:
+                print '- Fixing spectral shape parameters'
+            sync_name = ""
+            for p in like.params():
                 if sync_name != "" and sync_name != p.srcName:
                     like.syncSrcParams(sync_name)
                     sync_name = ""
+                if(p.isFree() and #p.srcName!=self.srcName and
+                   p.getName()!=like.normPar(p.srcName).getName()):
+                    if verbosity > 2:
+                        print '-- '+p.srcName+'.'+p.getName()
+                    p.setFree(False)
+                    sync_name = p.srcName
+            if sync_name != "" and sync_name != p.srcName:
+                like.syncSrcParams(sync_name)
+                sync_name = ""
 
-            # ------------------------------ FIT ------------------------------
-
+        faintsrc = []
+        if freeze_npred_frac:
+            faintsrc = _freezeFaintSources(like, self.srcName,
+                                           freeze_npred_frac)
             if verbosity > 1:
-                print '- Fit - starting'
-            like.fit(max(verbosity-3, 0))
-
-            spect['fit'] = dict()
-            spect['fit']['logL'] = like.logLike.value()
+                print '- Freezing',len(faintsrc),'sources with Npred<'+\
+                      str(freeze_npred_frac)+' of total'
+            if verbosity > 2:
+                for sn in faintsrc:
+                    print '--',sn
+
+        # ------------------------------ FIT ------------------------------
+
+        if verbosity > 1:
+            print '- Fit - starting'
+        like.fit(max(verbosity-3, 0))
+
+        spect['fit'] = dict()
+        spect['fit']['logL'] = like.logLike.value()
+        spect['fit']['frozen'] = faintsrc
+        if verbosity > 1:
+            print '- Fit - log Like:',spect['fit']['logL']
+
+        if delete_below_ts:
+            frozensrc = []
             if verbosity > 1:
-                print '- Fit - log Like:',spect['fit']['logL']
-
-            if delete_below_ts:
-                frozensrc = []
-                if verbosity > 1:
-                    print '- Deleting point sources with TS<'+str(delete_below_ts)
-                deletesrc = []
-                for s in like.sourceNames():
-                    freepars = like.freePars(s)
-                    if(s!=self.srcName and like[s].type == 'PointSource'
-                       and len(freepars)>0):
-                        ts = like.Ts(s)
-                        if ts<delete_below_ts:
-                            deletesrc.append(s)
-                            if verbosity > 2:
-                                print '--',s,'(TS='+str(ts)+')'
-                if deletesrc:
-                    for s in deletesrc:
+                print '- Deleting point sources with TS<'+str(delete_below_ts)
+            deletesrc = []
+            for s in like.sourceNames():
+                freepars = like.freePars(s)
+                if(s!=self.srcName and like[s].type == 'PointSource'
+                   and len(freepars)>0):
+                    ts = like.Ts(s)
+                    if ts<delete_below_ts:
+                        deletesrc.append(s)
+                        if verbosity > 2:
+                            print '--',s,'(TS='+str(ts)+')'
+            if deletesrc:
+                for s in deletesrc:
+                    if snapshot != None:
+                        snapshot.deleteSource(s)
+                    else:
                         like.deleteSource(s)
-                    if verbosity > 1:
-                        print '- Fit - refitting model'
-                    like.fit(max(verbosity-3, 0))
-                    spect['fit']['logL'] = like.logLike.value()
-                    if verbosity > 1:
-                        print '- Fit - log Like:',spect['fit']['logL']
-                        
-            spect['fit']['ts']=like.Ts(self.srcName)
-            if verbosity > 1:
-                print '- TS of %s: %f'%(self.srcName,spect['fit']['ts'])
-
-            spect['fit']['flux']=like[self.srcName].flux(emin, emax)
-            emid = math.sqrt(emin*emax)
-            spect['fit']['e_mid']=emid
-            # Note: be careful about the meaning here - it is the
-            # differential flux in the middle of the energy bin, not a
-            # flux error. This contradicts the meaning in 'flux_dflux' 
-            spect['fit']['dflux'] = \
-                like[self.srcName].flux(emid*(1-0.001),emid*(1+0.001))/(emid*0.002)
-            spect['fit']['flux_dflux'] = \
-                srcnormpar.getValue()/srcnormpar.error()
-            pars = dict()
-            for pn in like[self.srcName].funcs['Spectrum'].paramNames:
-                p = like[self.srcName].funcs['Spectrum'].getParam(pn)
-                pars[p.getName()] = dict(name      = p.getName(),
-                                         value     = p.getTrueValue(),
-                                         error     = p.error()*p.getScale(),
-                                         free      = p.isFree())
-            spect['fit']['pars'] = pars
-
-            ul_type = None
-            if ul_bayes_ts != None and spect['fit']['ts'] < ul_bayes_ts:
-                ul_type = 'bayesian'
-                [ul_flux, ul_results] = \
-                    IntegralUpperLimit.calc_int(like,self.srcName,cl=ul_cl,
-                                                skip_global_opt=True,
-                                                verbosity = max(verbosity-2,0),
-                                                emin=emin, emax=emax,
-                                                profile_optimizer=ul_optimizer)
-            elif ( ul_flux_dflux != None and \
-                   spect['fit']['flux_dflux'] < ul_flux_dflux ) or \
-                   ( ul_chi2_ts != None and spect['fit']['ts'] < ul_chi2_ts):
-                ul_type = 'chi2'
-                [ul_flux, ul_results] = \
-                    IntegralUpperLimit.calc_chi2(like,self.srcName,cl=ul_cl,
-                                                skip_global_opt=True,
-                                                verbosity = max(verbosity-2,0),
-                                                emin=emin, emax=emax,
-                                                profile_optimizer=ul_optimizer)
-            if ul_type != None:
-                spect['fit']['ul'] = dict(flux    = ul_flux,
-                                          results = ul_results,
-                                          type    = ul_type)
-
-            self.spectra.append(spect)
+                if verbosity > 1:
+                    print '- Fit - refitting model'
+                like.fit(max(verbosity-3, 0))
+                spect['fit']['logL'] = like.logLike.value()
+                if verbosity > 1:
+                    print '- Fit - log Like:',spect['fit']['logL']
+                    
+        spect['fit']['ts']=like.Ts(self.srcName)
+        if verbosity > 1:
+            print '- TS of %s: %f'%(self.srcName,spect['fit']['ts'])
+
+        spect['fit']['flux']=like[self.srcName].flux(emin, emax)
+        emid = math.sqrt(emin*emax)
+        spect['fit']['e_mid']=emid
+        # Note: be careful about the meaning here - it is the
+        # differential flux in the middle of the energy bin, not a
+        # flux error. This contradicts the meaning in 'flux_dflux' 
+        spect['fit']['dflux'] = \
+            like[self.srcName].flux(emid*(1-0.001),emid*(1+0.001))/(emid*0.002)
+        spect['fit']['flux_dflux'] = \
+            srcnormpar.getValue()/srcnormpar.error()
+        pars = dict()
+        for pn in like[self.srcName].funcs['Spectrum'].paramNames:
+            p = like[self.srcName].funcs['Spectrum'].getParam(pn)
+            pars[p.getName()] = dict(name      = p.getName(),
+                                     value     = p.getTrueValue(),
+                                     error     = p.error()*p.getScale(),
+                                     free      = p.isFree())
+        spect['fit']['pars'] = pars
+
+        ul_type = None
+        if ul_bayes_ts != None and spect['fit']['ts'] < ul_bayes_ts:
+            ul_type = 'bayesian'
+            [ul_flux, ul_results] = \
+                IntegralUpperLimit.calc_int(like,self.srcName,cl=ul_cl,
+                                            skip_global_opt=True,
+                                            verbosity = max(verbosity-2,0),
+                                            emin=emin, emax=emax,
+                                            profile_optimizer=ul_optimizer)
+        elif ( ul_flux_dflux != None and \
+               spect['fit']['flux_dflux'] < ul_flux_dflux ) or \
+               ( ul_chi2_ts != None and spect['fit']['ts'] < ul_chi2_ts):
+            ul_type = 'chi2'
+            [ul_flux, ul_results] = \
+                IntegralUpperLimit.calc_chi2(like,self.srcName,cl=ul_cl,
+                                            skip_global_opt=True,
+                                            verbosity = max(verbosity-2,0),
+                                            emin=emin, emax=emax,
+                                            profile_optimizer=ul_optimizer)
+        if ul_type != None:
+            spect['fit']['ul'] = dict(flux    = ul_flux,
+                                      results = ul_results,
+                                      type    = ul_type)
+
+        # Put back sources deleted from a shared broadband observation
+        if snapshot != None:
+            snapshot.restore()
+
+        return spect
 
     def saveProcessedObs(self,filename):
         file=open(filename,'w')
@@ -395,6 +706,26 @@ Compute mode options:
 
 --fitmodel X     specify filename of XML model from global fit
                  [default: source_name_fitmodel.xml].
+
+--checkpoint X   store the results of each energy band in directory X as
+                 it is finished, and skip bands already found there, so
+                 that an interrupted job can be resumed
+
+--ebounds X      comma separated list of the edges of the energy bands
+                 [MeV], which are all taken from the broadband binned
+                 observation in each directory (with --binned), rather
+                 than from one directory per band
+
+--globalfit      fit the model to the full energy range first and start
+                 the fit of each band from its parameters
+
+--freeze_npred X freeze the sources that predict less than fraction X
+                 of the counts in a band
+
+--jobs X         process X energy bands concurrently using a pool of
+                 worker processes [default: 1]
+
+--max_loaded X   load at most X observations at once when using --jobs
 """%(progname,progname,defspecfn,defsumfn,defirf,defft2,tsmin,\
      ulfluxerror,tsulbayes,tsulchi2,ulcl)
         sys.exit(exitcode)
@@ -404,7 +735,8 @@ Compute mode options:
         optspec = ( 'help', 'output=', 'v', 'vv', 'vvv',
                     'summary', 'compute', 'binned', 'ft2=', 'irf=', 'tsmin=',
                     'fluxerrorul=', 'tsulchi2=', 'tsulbayes=', 'ulcl=',
-                    'fitmodel=')
+                    'fitmodel=', 'checkpoint=', 'jobs=', 'max_loaded=',
+                    'ebounds=', 'globalfit', 'freeze_npred=')
         opts, args = getopt.gnu_getopt(sys.argv[1:], 'vho:', optspec)
     except getopt.GetoptError, err:
         print err
@@ -433,6 +765,12 @@ Compute mode options:
     ulbayes    = defulbayes
     ulcl       = defulcl
     analysis   = 'unbinned'
+    checkpoint = None
+    jobs       = 1
+    max_loaded = None
+    ebounds    = None
+    globalfit  = None
+    frzfrac    = None
 
     for o, a in opts:
         if o in ('-h', '--help'):
@@ -468,6 +806,18 @@ Compute mode options:
             ulbayes = float(a)
         elif o in ('--ulcl'):
             ulcl = float(a)
+        elif o in ('--checkpoint'):
+            checkpoint = a
+        elif o in ('--jobs'):
+            jobs = int(a)
+        elif o in ('--max_loaded'):
+            max_loaded = int(a)
+        elif o in ('--ebounds'):
+            ebounds = map(float, a.split(','))
+        elif o in ('--globalfit'):
+            globalfit = True
+        elif o in ('--freeze_npred'):
+            frzfrac = float(a)
 
     if mode=="summary":
         spec=Spectrum()
@@ -488,11 +838,20 @@ Compute mode options:
             output = defsumfn
         spec=Spectrum(srcName=source_name,ft2=ft2,irfs=irf,model=srcmodel)
         for d in args:
-            spec.globStandardObsDir(d, analysis=analysis)
+            if ebounds != None:
+                directories = glob.glob(d)
+                directories.sort()
+                for dd in directories:
+                    spec.addStandardBandsDir(dd, ebounds, analysis=analysis)
+            else:
+                spec.globStandardObsDir(d, analysis=analysis)
         if(ulchi2<0): ulchi2=None
         if(ulbayes<0): ulbayes=None
         spec.processAllObs(verbosity=verbose,delete_below_ts=tsmin,
                            ul_flux_dflux = ulflxdf, ul_chi2_ts=ulchi2,
-                           ul_bayes_ts=ulbayes, ul_cl=ulcl)
+                           ul_bayes_ts=ulbayes, ul_cl=ulcl,
+                           checkpoint_dir=checkpoint, workers=jobs,
+                           max_loaded=max_loaded, global_fit=globalfit,
+                           freeze_npred_frac=frzfrac)
         spec.saveProcessedObs(output)
 